@@ -1,7 +1,9 @@
 from astroNN.apogee.apogee_shared import apogee_default_dr, apogee_env
 from astroNN.apogee.chips import aspcap_mask
-from astroNN.apogee.chips import bitmask_boolean
-from astroNN.apogee.chips import bitmask_decompositor
+from astroNN.apogee.bitmask import bitmask_boolean
+from astroNN.apogee.bitmask import bitmask_combine
+from astroNN.apogee.bitmask import bitmask_decompositor
+from astroNN.apogee.bitmask import bitmask_planes
 from astroNN.apogee.chips import chips_pix_info
 from astroNN.apogee.chips import chips_split
 from astroNN.apogee.chips import continuum, apogee_continuum
@@ -13,5 +15,6 @@ from astroNN.apogee.downloader import allstar_cannon
 from astroNN.apogee.downloader import allvisit
 from astroNN.apogee.downloader import apogee_distances
 from astroNN.apogee.downloader import apogee_rc
+from astroNN.apogee.downloader import bulk_spectra
 from astroNN.apogee.downloader import combined_spectra
 from astroNN.apogee.downloader import visit_spectra
@@ -0,0 +1,96 @@
+# ---------------------------------------------------------#
+#   astroNN.apogee.bitmask: tools for dealing with apogee bitmask
+# ---------------------------------------------------------#
+
+import numpy as np
+
+
+def bitmask_combine(target_bit):
+    """
+    Combine a list of target bits into a single integer bitmask
+
+    :param target_bit: target bit(s) to combine
+    :type target_bit: Union(int, list[int], ndarray[int])
+    :return: combined bitmask
+    :rtype: int
+    """
+    target_bit = np.atleast_1d(target_bit)
+    if np.any(target_bit < 0):
+        raise ValueError(f"Bits must be non-negative, but got {target_bit}")
+    combined = 0
+    for bit in np.unique(target_bit):
+        combined |= 1 << int(bit)
+    return combined
+
+
+def bitmask_boolean(bitmask, target_bit):
+    """
+    Turn bitmask to boolean with provided bitmask array and target bit to mask
+
+    :param bitmask: bitmask
+    :type bitmask: ndarray
+    :param target_bit: target bit to mask
+    :type target_bit: list[int]
+    :return: boolean array, True for clean, False for masked
+    :rtype: ndarray[bool]
+    :History: 2018-Feb-03 - Written - Henry Leung (University of Toronto)
+    """
+    bitmask = np.atleast_2d(bitmask)
+    # combine target bits once and test the whole array in one pass, test as uint64 so bits wider than the dtype
+    # of bitmask do not overflow (those bits are never set)
+    target_mask = np.uint64(bitmask_combine(target_bit) & 0xFFFFFFFFFFFFFFFF)
+    return (bitmask.astype(np.uint64, copy=False) & target_mask) != 0
+
+
+def bitmask_decompositor(bit):
+    """
+    To decompose a bit from bitmask array to individual bit
+
+    :param bit: bitmask
+    :type bit: int
+    :return: boolean array, True for clean, False for masked
+    :rtype: ndarray[bool]
+    :History: 2018-Feb-03 - Written - Henry Leung (University of Toronto)
+    """
+    bitmask_num = int(bit)
+    if bitmask_num < 0:
+        raise ValueError(
+            f"Your number ({bit}) is not valid, this value must not from a bitmask"
+        )
+    if bitmask_num == 0:
+        print("0 corresponds to good pixel, thus this bit cannot be decomposed")
+        return None
+    return np.array(
+        [i for i in range(bitmask_num.bit_length()) if (bitmask_num >> i) & 1]
+    )
+
+
+def bitmask_planes(bitmask, bits=None):
+    """
+    Decompose a whole bitmask array into per-bit boolean planes
+
+    :param bitmask: bitmask array
+    :type bitmask: ndarray
+    :param bits: bits to decompose, None to decompose every bit up to the highest bit set in the bitmask array
+    :type bits: Union(int, list[int], ndarray[int], NoneType)
+    :return: boolean array with shape (number of bits,) + bitmask.shape, True where the bit is set
+    :rtype: ndarray[bool]
+    """
+    bitmask = np.asarray(bitmask)
+    if not np.issubdtype(bitmask.dtype, np.integer):
+        raise TypeError(f"Bitmask must be integer array, but got {bitmask.dtype}")
+    if np.issubdtype(bitmask.dtype, np.signedinteger) and np.any(bitmask < 0):
+        raise ValueError("Bitmask array must not contain negative values")
+
+    if bits is None:
+        bits = np.arange(int(np.max(bitmask, initial=0)).bit_length())
+    bits = np.atleast_1d(bits)
+
+    planes = np.empty((bits.shape[0],) + bitmask.shape, dtype=bool)
+    # test as uint64 so bits wider than the dtype of bitmask do not overflow
+    bitmask = bitmask.astype(np.uint64, copy=False)
+    for plane, bit in zip(planes, bits):
+        np.not_equal(
+            bitmask & np.uint64((1 << int(bit)) & 0xFFFFFFFFFFFFFFFF), 0, out=plane
+        )
+    return planes
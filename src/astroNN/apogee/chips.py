@@ -2,6 +2,7 @@
 #   astroNN.apogee.chips: tools for dealing with apogee camera chips
 # ---------------------------------------------------------#
 
+import concurrent.futures
 import os
 import warnings
 
@@ -10,6 +11,56 @@ import numpy as np
 import astroNN
 import astroNN.data
 from astroNN.apogee.apogee_shared import apogee_default_dr
+from astroNN.apogee.bitmask import bitmask_boolean, bitmask_decompositor
+
+# per-DR cache for static products which never change, arrays are set to read-only as they are shared by all callers
+_CHIPS_CACHE = {}
+
+
+def _chips_cache(name, dr, builder):
+    """
+    Get a static product from the per-DR cache, build and cache it if not exist
+
+    :param name: name of the product
+    :type name: str
+    :param dr: data release
+    :type dr: Union(int, NoneType)
+    :param builder: function without argument to build the product, returning ndarray or dict of ndarray
+    :type builder: function
+    :return: cached product
+    :rtype: Union(ndarray, dict)
+    """
+    key = (name, dr)
+    if key not in _CHIPS_CACHE:
+        product = builder()
+        for arr in product.values() if isinstance(product, dict) else [product]:
+            arr.setflags(write=False)
+        _CHIPS_CACHE[key] = product
+    return _CHIPS_CACHE[key]
+
+
+def _apstar_wavegrid():
+    """
+    Cached apStar 8575 pixels wavelength grid in Angstrom
+    """
+
+    def builder():
+        return 10.0 ** np.arange(
+            4.179, 4.179 + 8575 * 6.0 * 10.0**-6.0, 6.0 * 10.0**-6.0
+        )
+
+    return _chips_cache("apstar_wavegrid", None, builder)
+
+
+def _cont_mask(dr):
+    """
+    Cached default astroNN continuum mask on the gap deleted spectra
+    """
+
+    def builder():
+        return np.load(os.path.join(astroNN.data.datapath(), f"dr{dr}_contmask.npy"))
+
+    return _chips_cache("cont_mask", dr, builder)
 
 
 def chips_pix_info(dr=None):
@@ -64,7 +115,38 @@ def chips_pix_info(dr=None):
     ]
 
 
-def gap_delete(spectra, dr=None):
+def _chips_slices(spectra, dr):
+    """
+    Slices of RGB chips for spectra with or without gap between detectors
+
+    :param spectra: APOGEE spectra
+    :type spectra: ndarray
+    :param dr: data release
+    :type dr: int
+    :return: slices for blue, green and red chips
+    :rtype: tuple[slice]
+    """
+    info = chips_pix_info(dr=dr)
+    blue = info[1] - info[0]
+    green = info[3] - info[2]
+
+    if spectra.shape[1] == 8575:
+        return (
+            slice(info[0], info[1]),
+            slice(info[2], info[3]),
+            slice(info[4], info[5]),
+        )
+    elif spectra.shape[1] == info[6]:
+        return (
+            slice(0, blue),
+            slice(blue, blue + green),
+            slice(blue + green, info[6]),
+        )
+    else:
+        raise EnvironmentError("Are you sure you are giving astroNN APOGEE spectra?")
+
+
+def gap_delete(spectra, dr=None, out=None):
     """
     To delete the gap between APOGEE CCDs from the original 8575 pixels spectra
 
@@ -72,6 +154,8 @@ def gap_delete(spectra, dr=None):
     :type spectra: ndarray
     :param dr: data release
     :type dr: Union(int, NoneType)
+    :param out: preallocated array with gap deleted shape to write the result to
+    :type out: Union(ndarray, NoneType)
     :return: Gap deleted spectrum/spectra
     :rtype: ndarray
     :History:
@@ -85,9 +169,17 @@ def gap_delete(spectra, dr=None):
     if spectra.shape[1] != 8575 and spectra.shape[1] != info[6]:
         raise EnvironmentError("Are you sure you are giving astroNN APOGEE spectra?")
     if spectra.shape[1] != info[6]:
-        spectra = spectra[
-            :, np.r_[info[0] : info[1], info[2] : info[3], info[4] : info[5]]
-        ]
+        if out is None:
+            out = np.empty((spectra.shape[0], info[6]), dtype=spectra.dtype)
+        # copying chips by contiguous slices is much faster than fancy indexing
+        for raw_slice, deleted_slice in zip(
+            _chips_slices(spectra, dr), _chips_slices(out, dr)
+        ):
+            out[:, deleted_slice] = spectra[:, raw_slice]
+        spectra = out
+    elif out is not None:
+        out[...] = spectra
+        spectra = out
 
     return spectra
 
@@ -111,20 +203,20 @@ def wavelength_solution(dr=None):
     dr = apogee_default_dr(dr=dr)
     info = chips_pix_info(dr=dr)
 
-    apstar_wavegrid = 10.0 ** np.arange(
-        4.179, 4.179 + 8575 * 6.0 * 10.0**-6.0, 6.0 * 10.0**-6.0
-    )
+    apstar_wavegrid = _apstar_wavegrid()
 
-    lambda_blue = apstar_wavegrid[info[0] : info[1]]
-    lambda_green = apstar_wavegrid[info[2] : info[3]]
-    lambda_red = apstar_wavegrid[info[4] : info[5]]
+    # copies so the cached read-only grid is not exposed
+    lambda_blue = apstar_wavegrid[info[0] : info[1]].copy()
+    lambda_green = apstar_wavegrid[info[2] : info[3]].copy()
+    lambda_red = apstar_wavegrid[info[4] : info[5]].copy()
 
     return lambda_blue, lambda_green, lambda_red
 
 
 def chips_split(spectra, dr=None):
     """
-    To split APOGEE spectra into RGB chips, will delete the gap if detected
+    To split APOGEE spectra into RGB chips, will delete the gap if detected.
+    The chips are views of the provided spectra so no copy is made
 
     :param spectra: APOGEE spectrum/spectra
     :type spectra: ndarray
@@ -137,79 +229,73 @@ def chips_split(spectra, dr=None):
         | 2017-Dec-17 - Updated - Henry Leung (University of Toronto)
     """
     dr = apogee_default_dr(dr=dr)
-    info = chips_pix_info(dr=dr)
-    blue = info[1] - info[0]
-    green = info[3] - info[2]
-    red = info[5] - info[4]
-
     spectra = np.atleast_2d(spectra)
+    chips_slices = _chips_slices(spectra, dr)
 
     if spectra.shape[1] == 8575:
-        spectra = gap_delete(spectra, dr=dr)
         warnings.warn(
             "Raw spectra with gaps between detectors, gaps are removed automatically"
         )
-    elif spectra.shape[1] == info[6]:
-        pass
-    else:
-        raise EnvironmentError("Are you sure you are giving me APOGEE spectra?")
 
-    spectra_blue = spectra[:, 0:blue]
-    spectra_green = spectra[:, blue : (blue + green)]
-    spectra_red = spectra[:, (blue + green) : (blue + green + red)]
+    spectra_blue, spectra_green, spectra_red = (
+        spectra[:, chip_slice] for chip_slice in chips_slices
+    )
 
     return spectra_blue, spectra_green, spectra_red
 
 
-def bitmask_boolean(bitmask, target_bit):
+def _chebyshev_continuum(spectra, flux_ivars, cont_mask, deg=2):
     """
-    Turn bitmask to boolean with provided bitmask array and target bit to mask
+    Batched weighted least-squares Chebyshev fit to the continuum pixels of many spectra at once.
+    The design matrix is built once and every spectrum's normal equations are solved in one stacked call.
+    Weights follow ``np.polynomial.chebyshev.Chebyshev.fit`` convention (i.e. residuals are multiplied by the weights)
 
-    :param bitmask: bitmask
-    :type bitmask: ndarray
-    :param target_bit: target bit to mask
-    :type target_bit: list[int]
-    :return: boolean array, True for clean, False for masked
-    :rtype: ndarray[bool]
-    :History: 2018-Feb-03 - Written - Henry Leung (University of Toronto)
+    :param spectra: spectra
+    :type spectra: ndarray
+    :param flux_ivars: weights for every pixel, same shape as spectra
+    :type flux_ivars: ndarray
+    :param cont_mask: continuum mask
+    :type cont_mask: ndarray[bool]
+    :param deg: The degree of Chebyshev polynomial
+    :type deg: int
+    :return: fitted continuum evaluated on every pixel, NaN for spectra without enough valid continuum pixels
+    :rtype: ndarray
     """
-    target_bit = np.array(target_bit)
-    target_bit = np.sum(2**target_bit)
-    bitmask = np.atleast_2d(bitmask)
-    boolean_output = np.zeros(bitmask.shape, dtype=bool)
-    boolean_output[(bitmask & target_bit) != 0] = True
-    return boolean_output
-
+    pix_element = np.arange(spectra.shape[1])
+    cont_pix = pix_element[cont_mask]
 
-def bitmask_decompositor(bit):
-    """
-    To decompose a bit from bitmask array to individual bit
+    # Chebyshev basis on the continuum pixels range, shared by all spectra
+    x = np.polynomial.polyutils.mapdomain(
+        pix_element, [cont_pix.min(), cont_pix.max()], [-1.0, 1.0]
+    )
+    design = np.polynomial.chebyshev.chebvander(x, deg)
+    cont_design = design[cont_pix]
+    # outer product of design matrix rows so normal equations can be assembled by a single matmul
+    cont_design_outer = (cont_design[:, :, None] * cont_design[:, None, :]).reshape(
+        cont_pix.shape[0], -1
+    )
 
-    :param bit: bitmask
-    :type bit: int
-    :return: boolean array, True for clean, False for masked
-    :rtype: ndarray[bool]
-    :History: 2018-Feb-03 - Written - Henry Leung (University of Toronto)
-    """
-    bitmask_num = int(bit)
-    if bitmask_num < 0:
-        raise ValueError(
-            f"Your number ({bit}) is not valid, this value must not from a bitmask"
-        )
-    if bitmask_num == 0:
-        print("0 corresponds to good pixel, thus this bit cannot be decomposed")
-        return None
-    decomposited_bits = [int(np.log2(bitmask_num))]
-    while True:
-        if bitmask_num - 2 ** decomposited_bits[-1] == 0:
-            decomposited_bits.sort()
-            decomposited_bits = np.array(decomposited_bits)
-            break
-        bitmask_num -= 2 ** decomposited_bits[-1]
-        if bitmask_num != 0:
-            decomposited_bits.append(int(np.log2(bitmask_num)))
+    y = np.asarray(spectra[:, cont_pix], dtype=np.float64)
+    w = np.asarray(flux_ivars[:, cont_pix], dtype=np.float64)
+    good = np.isfinite(y) & np.isfinite(w)
+    y = np.where(good, y, 0.0)
+    w = np.where(good, w, 0.0)
+    # rescale weights for every spectrum for numerical stability, does not change the solution
+    w_max = np.max(np.abs(w), axis=1, keepdims=True)
+    w = np.divide(w, w_max, out=np.zeros_like(w), where=w_max > 0.0)
+    w2 = np.square(w)
+
+    lhs = (w2 @ cont_design_outer).reshape(-1, deg + 1, deg + 1)
+    rhs = (w2 * y) @ cont_design
+
+    coeffs = np.full((spectra.shape[0], deg + 1), np.nan)
+    fittable = np.count_nonzero(w2, axis=1) > deg
+    if np.any(fittable):
+        coeffs[fittable] = np.linalg.solve(lhs[fittable], rhs[fittable][..., None])[
+            ..., 0
+        ]
 
-    return decomposited_bits
+    return coeffs @ design.T
 
 
 def continuum(spectra, spectra_err, cont_mask, deg=2):
@@ -234,73 +320,32 @@ def continuum(spectra, spectra_err, cont_mask, deg=2):
     """
     spectra = np.atleast_2d(np.array(spectra))
     spectra_err = np.atleast_2d(np.array(spectra_err))
-    flux_ivars = 1 / (
-        np.square(np.array(spectra_err)) + 1e-8
-    )  # for numerical stability
+    flux_ivars = 1 / (np.square(spectra_err) + 1e-8)  # for numerical stability
 
-    pix_element = np.arange(spectra.shape[1])  # Array with size spectra
-
-    for counter, (spectrum, spectrum_err, flux_ivar) in enumerate(
-        zip(spectra, spectra_err, flux_ivars)
-    ):
-        no_nan_mask = ~np.isnan(spectrum[cont_mask])
-        fit = np.polynomial.chebyshev.Chebyshev.fit(
-            x=np.arange(spectrum.shape[0])[cont_mask][no_nan_mask],
-            y=spectrum[cont_mask][no_nan_mask],
-            w=flux_ivar[cont_mask][no_nan_mask],
-            deg=deg,
-        )
-        spectra[counter] = spectrum / fit(pix_element)
-        spectra_err[counter] = spectrum_err / fit(pix_element)
+    fit = _chebyshev_continuum(spectra, flux_ivars, cont_mask, deg=deg)
+    spectra[:] = spectra / fit
+    spectra_err[:] = spectra_err / fit
 
     return spectra, spectra_err
 
 
-def apogee_continuum(
-    spectra,
-    spectra_err,
-    cont_mask=None,
-    deg=2,
-    dr=None,
-    bitmask=None,
-    target_bit=None,
-    mask_value=1.0,
+def _apogee_continuum_chunk(
+    spectra, spectra_err, cont_mask, deg, dr, bitmask, target_bit, mask_value
 ):
     """
-    It is designed only for apogee spectra by fitting Chebyshev polynomials to the flux values in the continuum mask
-    by chips. The resulting continuum will have the same shape as `fluxes`.
+    Continuum normalize a block of APOGEE spectra chips by chips, used by ``apogee_continuum``
 
-    :param spectra: spectra
-    :type spectra: ndarray
-    :param spectra_err: spectra uncertainty, same shape as spectra
-    :type spectra_err: ndarray
-    :param cont_mask: continuum mask
-    :type cont_mask: ndarray[bool]
-    :param deg: The degree of Chebyshev polynomial to use in each region, default is 2 which works the best so far
-    :type deg: int
-    :param dr: apogee dr
-    :type dr: int
-    :param bitmask: bitmask array of the spectra, same shape as spectra
-    :type bitmask: ndarray
-    :param target_bit: a list of bit to be masked
-    :type target_bit: Union(int, list[int], ndarray[int])
-    :param mask_value: if a pixel is determined to be a bad pixel, this value will be used to replace that pixel flux
-    :type mask_value: Union(int, float)
     :return: normalized spectra, normalized spectra uncertainty
     :rtype: ndarray, ndarray
-    :History: 2018-Mar-21 - Written - Henry Leung (University of Toronto)
     """
-    dr = apogee_default_dr(dr=dr)
-
-    spectra = gap_delete(spectra, dr=dr)
-    flux_errs = gap_delete(spectra_err, dr=dr)
-
-    spectra_blue, spectra_green, spectra_red = chips_split(spectra, dr=dr)
-    yerrs_blue, yerrs_green, yerrs_red = chips_split(flux_errs, dr=dr)
-
-    if cont_mask is None:
-        maskpath = os.path.join(astroNN.data.datapath(), f"dr{dr}_contmask.npy")
-        cont_mask = np.load(maskpath)
+    # chips views of the spectra, no need to delete the gap first
+    spectra, spectra_err = np.atleast_2d(spectra), np.atleast_2d(spectra_err)
+    spectra_blue, spectra_green, spectra_red = (
+        spectra[:, chip_slice] for chip_slice in _chips_slices(spectra, dr)
+    )
+    yerrs_blue, yerrs_green, yerrs_red = (
+        spectra_err[:, chip_slice] for chip_slice in _chips_slices(spectra_err, dr)
+    )
 
     con_mask_blue, con_mask_green, con_mask_red = chips_split(cont_mask, dr=dr)
     con_mask_blue, con_mask_green, con_mask_red = (
@@ -339,9 +384,6 @@ def apogee_continuum(
 
     if bitmask is not None:
         bitmask = gap_delete(bitmask, dr=dr)
-        if target_bit is None:
-            target_bit = [0, 1, 2, 3, 4, 5, 6, 7, 12]
-
         mask = bitmask_boolean(bitmask, target_bit)
         normalized_spectra[mask] = mask_value
         normalized_spectra_err[mask] = mask_value
@@ -349,6 +391,133 @@ def apogee_continuum(
     return normalized_spectra, normalized_spectra_err
 
 
+def apogee_continuum(
+    spectra,
+    spectra_err,
+    cont_mask=None,
+    deg=2,
+    dr=None,
+    bitmask=None,
+    target_bit=None,
+    mask_value=1.0,
+    chunk_size=None,
+    workers=1,
+    out=None,
+):
+    """
+    It is designed only for apogee spectra by fitting Chebyshev polynomials to the flux values in the continuum mask
+    by chips. The resulting continuum will have the same shape as `fluxes`.
+
+    :param spectra: spectra
+    :type spectra: ndarray
+    :param spectra_err: spectra uncertainty, same shape as spectra
+    :type spectra_err: ndarray
+    :param cont_mask: continuum mask
+    :type cont_mask: ndarray[bool]
+    :param deg: The degree of Chebyshev polynomial to use in each region, default is 2 which works the best so far
+    :type deg: int
+    :param dr: apogee dr
+    :type dr: int
+    :param bitmask: bitmask array of the spectra, same shape as spectra
+    :type bitmask: ndarray
+    :param target_bit: a list of bit to be masked
+    :type target_bit: Union(int, list[int], ndarray[int])
+    :param mask_value: if a pixel is determined to be a bad pixel, this value will be used to replace that pixel flux
+    :type mask_value: Union(int, float)
+    :param chunk_size: | number of spectra to normalize at a time, None to normalize all spectra at once if
+                       | ``workers=1`` and ``out`` is not given, otherwise up to 4096 spectra at a time
+    :type chunk_size: Union(int, NoneType)
+    :param workers: number of processes to normalize chunks in parallel
+    :type workers: int
+    :param out: | preallocated normalized spectra and normalized spectra uncertainty arrays with gap deleted shape
+                | to write results to, can be ``np.memmap`` to keep the results on disk
+    :type out: Union(tuple[ndarray, ndarray], NoneType)
+    :return: normalized spectra, normalized spectra uncertainty
+    :rtype: ndarray, ndarray
+    :History: 2018-Mar-21 - Written - Henry Leung (University of Toronto)
+    """
+    dr = apogee_default_dr(dr=dr)
+
+    if cont_mask is None:
+        cont_mask = _cont_mask(dr)
+
+    if bitmask is not None and target_bit is None:
+        target_bit = [0, 1, 2, 3, 4, 5, 6, 7, 12]
+
+    if chunk_size is None and workers == 1 and out is None:
+        return _apogee_continuum_chunk(
+            spectra,
+            spectra_err,
+            cont_mask,
+            deg,
+            dr,
+            bitmask,
+            target_bit,
+            mask_value,
+        )
+
+    # slicing keeps np.memmap or h5py inputs on disk until the chunk is needed
+    if not hasattr(spectra, "shape") or len(spectra.shape) == 1:
+        spectra = np.atleast_2d(spectra)
+    if not hasattr(spectra_err, "shape") or len(spectra_err.shape) == 1:
+        spectra_err = np.atleast_2d(spectra_err)
+    if bitmask is not None and (
+        not hasattr(bitmask, "shape") or len(bitmask.shape) == 1
+    ):
+        bitmask = np.atleast_2d(bitmask)
+
+    num_spectra = spectra.shape[0]
+    if chunk_size is None:
+        # a fixed chunk size bounds memory usage no matter how many spectra, smaller if not enough for every worker
+        chunk_size = max(min(4096, -(-num_spectra // workers)), 1)
+
+    if out is None:
+        out_dtype = np.result_type(spectra.dtype, spectra_err.dtype, np.float32)
+        out_shape = (num_spectra, chips_pix_info(dr=dr)[6])
+        out = (
+            np.empty(out_shape, dtype=out_dtype),
+            np.empty(out_shape, dtype=out_dtype),
+        )
+    normalized_spectra, normalized_spectra_err = out
+
+    def _chunk_args(start):
+        return (
+            spectra[start : start + chunk_size],
+            spectra_err[start : start + chunk_size],
+            cont_mask,
+            deg,
+            dr,
+            None if bitmask is None else bitmask[start : start + chunk_size],
+            target_bit,
+            mask_value,
+        )
+
+    def _write_chunk(start, result):
+        normalized_spectra[start : start + chunk_size] = result[0]
+        normalized_spectra_err[start : start + chunk_size] = result[1]
+
+    if workers == 1:
+        for start in range(0, num_spectra, chunk_size):
+            _write_chunk(start, _apogee_continuum_chunk(*_chunk_args(start)))
+    else:
+        # only keep a few chunks in flight so memory usage does not grow with number of spectra
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            for start in range(0, num_spectra, chunk_size):
+                if len(pending) >= 2 * workers:
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        _write_chunk(pending.pop(future), future.result())
+                future = executor.submit(_apogee_continuum_chunk, *_chunk_args(start))
+                pending[future] = start
+            for future in concurrent.futures.as_completed(pending):
+                _write_chunk(pending[future], future.result())
+
+    return normalized_spectra, normalized_spectra_err
+
+
 def aspcap_mask(elem, dr=None):
     """
     | To load ASPCAP elements window masks
@@ -404,18 +573,23 @@ def aspcap_mask(elem, dr=None):
     else:
         raise ValueError("Only DR14-DR16 is supported currently")
 
-    masks = np.load(
-        os.path.join(astroNN.data.datapath(), f"aspcap_{aspcap_code}_masks.npy")
-    )
+    def builder():
+        masks = np.load(
+            os.path.join(astroNN.data.datapath(), f"aspcap_{aspcap_code}_masks.npy")
+        )
+        return {
+            elem_name.lower(): (masks & 2**index) != 0
+            for index, elem_name in enumerate(elem_list)
+        }
+
+    elem_masks = _chips_cache(f"aspcap_{aspcap_code}_masks", None, builder)
 
     try:
         # turn everything to lowercase to avoid case-related issue
-        index = [x.lower() for x in elem_list].index(elem.lower())
-    except ValueError:
+        return elem_masks[elem.lower()].copy()
+    except KeyError:
         # nicely handle if element not found
         print(
             f"Element not found, the only elements for dr{dr} supported are {elem_list}"
         )
         return None
-
-    return [(masks & 2**index) != 0][0]
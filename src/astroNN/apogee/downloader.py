@@ -2,6 +2,8 @@
 #   astroNN.apogee.downloader: download apogee files
 # ---------------------------------------------------------#
 
+import base64
+import concurrent.futures
 import getpass
 import os
 import urllib.request, urllib.error
@@ -9,15 +11,34 @@ import warnings
 
 import numpy as np
 from astroNN.apogee.apogee_shared import apogee_env, apogee_default_dr
-from astroNN.shared.downloader_tools import TqdmUpTo, filehash
+from astroNN.shared.downloader_tools import (
+    TqdmUpTo,
+    cached_filehash,
+    filehashes,
+    http_download,
+)
 from astropy.io import fits
 from astroNN.shared import logging as logging
+from tqdm import tqdm
 
 currentdir = os.getcwd()
 
 # global var
 warning_flag = False
-_ALLSTAR_TEMP = {}
+_SAS_URL = "https://data.sdss.org/sas/"
+_ALLSTAR_SLIM = {}
+# allStar columns needed by astroNN downloaders and loaders, cached to disk so the full allStar is not loaded
+_ALLSTAR_SLIM_COLUMNS_DTYPE = {
+    "APOGEE_ID": str,
+    "TELESCOPE": str,
+    "FIELD": str,
+    "LOCATION_ID": int,
+    "RA": float,
+    "DEC": float,
+    "K": float,
+    "AK_TARG": float,
+}
+_ALLSTAR_SLIM_COLUMNS = list(_ALLSTAR_SLIM_COLUMNS_DTYPE.keys())
 __apogee_credentials_username = None
 __apogee_credentials_pw = None
 
@@ -72,74 +93,63 @@ def __apogee_credentials_downloader(url, fullfilename):
     return fullfilename
 
 
-def allstar(dr=None, flag=None):
+def _allstar_path(dr):
     """
-    Download the allStar file (catalog of ASPCAP stellar parameters and abundances from combined spectra)
+    Path of allStar file relative to SAS root which is the same for local mirror
 
     :param dr: APOGEE DR
     :type dr: int
-    :param flag: 0: normal, 1: force to re-download
-    :type flag: int
-    :return: full file path and download in background if not found locally, False if cannot be found on server
-    :rtype: str
-    :History: 2017-Oct-09 - Written - Henry Leung (University of Toronto)
+    :return: folder relative to SAS root, filename, sha1 hash of the file
+    :rtype: tuple[str]
     """
-    dr = apogee_default_dr(dr=dr)
-
     if dr == 13:
         file_hash = "1718723ada3018de94e1022cd57d4d950a74f91f"
-
-        # Check if directory exists
-        fullfoldername = os.path.join(
-            apogee_env(), "dr13/apogee/spectro/redux/r6/stars/l30e/l30e.2/"
-        )
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
+        folder = "dr13/apogee/spectro/redux/r6/stars/l30e/l30e.2/"
         filename = "allStar-l30e.2.fits"
-        fullfilename = os.path.join(fullfoldername, filename)
-        url = f"https://data.sdss.org/sas/dr13/apogee/spectro/redux/r6/stars/l30e/l30e.2/{filename}"
     elif dr == 14:
         file_hash = "a7e1801924661954da792e377ad54f412219b105"
-
-        fullfoldername = os.path.join(
-            apogee_env(), "dr14/apogee/spectro/redux/r8/stars/l31c/l31c.2/"
-        )
-        # Check if directory exists
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
+        folder = "dr14/apogee/spectro/redux/r8/stars/l31c/l31c.2/"
         filename = "allStar-l31c.2.fits"
-        fullfilename = os.path.join(fullfoldername, filename)
-        url = f"https://data.sdss.org/sas/dr14/apogee/spectro/redux/r8/stars/l31c/l31c.2/{filename}"
     elif dr == 16:
         file_hash = "66fe854bd000ca1c0a6b50a998877e4a3e41d184"
-
-        fullfoldername = os.path.join(
-            apogee_env(), "dr16/apogee/spectro/aspcap/r12/l33/"
-        )
-        # Check if directory exists
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
+        folder = "dr16/apogee/spectro/aspcap/r12/l33/"
         filename = "allStar-r12-l33.fits"
-        fullfilename = os.path.join(fullfoldername, filename)
-        url = f"https://data.sdss.org/sas/dr16/apogee/spectro/aspcap/r12/l33/{filename}"
     elif dr == 17:
         file_hash = "7aa2f381de0e8e246f9833cc7da540ef45096702"
-
-        fullfoldername = os.path.join(
-            apogee_env(), "dr17/apogee/spectro/aspcap/dr17/synspec_rev1/"
-        )
-        # Check if directory exists
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
+        folder = "dr17/apogee/spectro/aspcap/dr17/synspec_rev1/"
         filename = "allStar-dr17-synspec_rev1.fits"
-        fullfilename = os.path.join(fullfoldername, filename)
-        url = f"https://data.sdss.org/sas/dr17/apogee/spectro/aspcap/dr17/synspec_rev1/{filename}"
     else:
         raise ValueError("allstar() only supports APOGEE DR13-DR17")
 
+    return folder, filename, file_hash
+
+
+def allstar(dr=None, flag=None):
+    """
+    Download the allStar file (catalog of ASPCAP stellar parameters and abundances from combined spectra)
+
+    :param dr: APOGEE DR
+    :type dr: int
+    :param flag: 0: normal, 1: force to re-download
+    :type flag: int
+    :return: full file path and download in background if not found locally, False if cannot be found on server
+    :rtype: str
+    :History: 2017-Oct-09 - Written - Henry Leung (University of Toronto)
+    """
+    dr = apogee_default_dr(dr=dr)
+
+    folder, filename, file_hash = _allstar_path(dr)
+
+    # Check if directory exists
+    fullfoldername = os.path.join(apogee_env(), folder)
+    if not os.path.exists(fullfoldername):
+        os.makedirs(fullfoldername)
+    fullfilename = os.path.join(fullfoldername, filename)
+    url = _SAS_URL + folder + filename
+
     # check file integrity
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm="sha1")
+        checksum = cached_filehash(fullfilename, algorithm="sha1")
         if checksum != file_hash.lower():
             warnings.warn(
                 "File corruption detected, astroNN is attempting to download again"
@@ -158,7 +168,7 @@ def allstar(dr=None, flag=None):
                 logging.info(
                     f"Downloaded DR{dr:d} allStar file catalog successfully to {fullfilename}"
                 )
-                checksum = filehash(fullfilename, algorithm="sha1")
+                checksum = cached_filehash(fullfilename, algorithm="sha1")
                 if checksum != file_hash.lower():
                     warnings.warn(
                         "File corruption detected, astroNN is attempting to download again"
@@ -219,7 +229,7 @@ def apogee_astronn(dr=None, flag=None):
 
     # check file integrity
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm="sha1")
+        checksum = cached_filehash(fullfilename, algorithm="sha1")
         if checksum != file_hash.lower():
             warnings.warn(
                 "File corruption detected, astroNN is attempting to download again"
@@ -238,7 +248,7 @@ def apogee_astronn(dr=None, flag=None):
                 logging.info(
                     f"Downloaded DR{dr:d} apogee_astroNN file catalog successfully to {fullfilename}"
                 )
-                checksum = filehash(fullfilename, algorithm="sha1")
+                checksum = cached_filehash(fullfilename, algorithm="sha1")
                 if checksum != file_hash.lower():
                     warnings.warn(
                         "File corruption detected, astroNN is attempting to download again"
@@ -289,7 +299,7 @@ def allstar_cannon(dr=None, flag=None):
 
     # check file integrity
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm="sha1")
+        checksum = cached_filehash(fullfilename, algorithm="sha1")
         if checksum != file_hash.lower():
             warnings.warn(
                 "File corruption detected, astroNN is attempting to download again"
@@ -307,7 +317,7 @@ def allstar_cannon(dr=None, flag=None):
             logging.info(
                 f"Downloaded DR{dr:d} allStarCannon file catalog successfully to {fullfilename}"
             )
-            checksum = filehash(fullfilename, algorithm="sha1")
+            checksum = cached_filehash(fullfilename, algorithm="sha1")
             if checksum != file_hash.lower():
                 warnings.warn(
                     "File corruption detected, astroNN is attempting to download again"
@@ -378,7 +388,7 @@ def allvisit(dr=None, flag=None):
 
     # check file integrity
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm="sha1")
+        checksum = cached_filehash(fullfilename, algorithm="sha1")
         if checksum != file_hash.lower():
             warnings.warn(
                 "File corruption detected, astroNN is attempting to download again"
@@ -394,7 +404,7 @@ def allvisit(dr=None, flag=None):
             logging.info(
                 f"Downloaded DR{dr:d} allVisit file catalog successfully to {fullfilepath}"
             )
-            checksum = filehash(fullfilename, algorithm="sha1")
+            checksum = cached_filehash(fullfilename, algorithm="sha1")
             if checksum != file_hash.lower():
                 warnings.warn(
                     "File corruption detected, astroNN is attempting to download again"
@@ -404,6 +414,240 @@ def allvisit(dr=None, flag=None):
     return fullfilename
 
 
+def _allstar_slim_files(fullfilename):
+    """
+    Folder and npy files of the slim allStar cache next to an allStar file
+    """
+    slim_folder = f"{os.path.splitext(fullfilename)[0]}_astroNN_slim"
+    slim_files = {
+        column: os.path.join(slim_folder, f"{column}.npy")
+        for column in _ALLSTAR_SLIM_COLUMNS + ["SORTER"]
+    }
+    return slim_folder, slim_files
+
+
+def _allstar_slim_is_valid(fullfilename):
+    """
+    Whether the slim allStar cache exists and is not older than the allStar file, the cache is considered valid if
+    the allStar file itself does not exist (e.g. deleted to save disk space after the cache is built)
+    """
+    slim_files = _allstar_slim_files(fullfilename)[1].values()
+    if not all(os.path.isfile(f) for f in slim_files):
+        return False
+    if not os.path.isfile(fullfilename):
+        return True
+    allstar_mtime = os.path.getmtime(fullfilename)
+    return all(os.path.getmtime(f) >= allstar_mtime for f in slim_files)
+
+
+def _load_allstar_slim(fullfilename):
+    """
+    Load slim allStar columns needed by astroNN downloaders and loaders as memory-mapped arrays in allStar row order.
+    The columns are extracted from the allStar file once and cached to disk next to the allStar file as npy files.
+    A ``SORTER`` array which sorts ``APOGEE_ID`` is included for looking up stars
+
+    :param fullfilename: full file path to allStar file
+    :type fullfilename: str
+    :return: dictionary of memory-mapped columns
+    :rtype: dict
+    """
+    slim_folder, slim_files = _allstar_slim_files(fullfilename)
+
+    # rebuild the cache if it does not exist or the allStar file is newer than the cache
+    if not _allstar_slim_is_valid(fullfilename):
+        if not os.path.exists(slim_folder):
+            os.makedirs(slim_folder)
+        with fits.open(fullfilename) as F:
+            data = F[1].data
+            for column, dtype in _ALLSTAR_SLIM_COLUMNS_DTYPE.items():
+                if column not in data.columns.names:
+                    default = np.nan if dtype is float else dtype()
+                    column_data = np.full(data.shape[0], default, dtype=dtype)
+                elif dtype is str:
+                    column_data = np.char.rstrip(np.asarray(data[column], dtype=str))
+                else:
+                    # keep the original precision but in native byte order
+                    column_data = np.asarray(data[column])
+                    column_data = column_data.astype(
+                        column_data.dtype.newbyteorder("=")
+                    )
+                np.save(slim_files[column], column_data)
+                if column == "APOGEE_ID":
+                    # stable sort so rows with the same APOGEE_ID keep allStar order
+                    np.save(
+                        slim_files["SORTER"], np.argsort(column_data, kind="stable")
+                    )
+        logging.info(f"Built slim allStar cache to {slim_folder}")
+
+    return {column: np.load(f, mmap_mode="r") for column, f in slim_files.items()}
+
+
+def _allstar_slim(dr):
+    """
+    Get slim allStar columns of a DR, loaded once per DR. allStar file is only checked or downloaded if the cache
+    does not exist or is outdated
+
+    :param dr: APOGEE DR
+    :type dr: int
+    :return: dictionary of memory-mapped columns
+    :rtype: dict
+    """
+    global _ALLSTAR_SLIM
+    if not str(f"dr{dr}") in _ALLSTAR_SLIM:
+        folder, filename, _ = _allstar_path(dr)
+        fullfilename = os.path.join(apogee_env(), folder, filename)
+        # allStar file is only needed (and downloaded if missing) to build the cache
+        if not _allstar_slim_is_valid(fullfilename):
+            fullfilename = allstar(dr=dr)
+        _ALLSTAR_SLIM[f"dr{dr}"] = _load_allstar_slim(fullfilename)
+    return _ALLSTAR_SLIM[f"dr{dr}"]
+
+
+def _allstar_lookup(allstar_slim, apogee, telescope=None):
+    """
+    Look up the first allStar entry of a star with slim allStar columns from ``_load_allstar_slim``
+
+    :param allstar_slim: dictionary of slim allStar columns
+    :type allstar_slim: dict
+    :param apogee: Apogee ID
+    :type apogee: str
+    :param telescope: Telescope ID, for example 'apo25m' or 'lco25m'
+    :type telescope: Union(str, NoneType)
+    :return: location, field and telescope of the star, None if not found
+    :rtype: Union(tuple, NoneType)
+    """
+    sorter = allstar_slim["SORTER"]
+    left = np.searchsorted(allstar_slim["APOGEE_ID"], apogee, "left", sorter=sorter)
+    right = np.searchsorted(allstar_slim["APOGEE_ID"], apogee, "right", sorter=sorter)
+    matched_idx = np.asarray(sorter[left:right])
+    if telescope is not None:
+        matched_idx = matched_idx[allstar_slim["TELESCOPE"][matched_idx] == telescope]
+    if len(matched_idx) == 0:
+        return None
+    return (
+        allstar_slim["LOCATION_ID"][matched_idx[0]],
+        allstar_slim["FIELD"][matched_idx[0]],
+        allstar_slim["TELESCOPE"][matched_idx[0]],
+    )
+
+
+def _allstar_star_info(dr, apogee, telescope=None):
+    """
+    Get location, field and telescope of a star from allStar
+
+    :param dr: APOGEE DR
+    :type dr: int
+    :param apogee: Apogee ID
+    :type apogee: str
+    :param telescope: Telescope ID, for example 'apo25m' or 'lco25m'
+    :type telescope: Union(str, NoneType)
+    :return: location, field and telescope of the star
+    :rtype: tuple
+    """
+    star_info = _allstar_lookup(_allstar_slim(dr), apogee, telescope)
+    if star_info is None:
+        raise ValueError(
+            f"No entry found in allstar DR{dr} met with your requirement!!"
+        )
+    return star_info
+
+
+def _combined_spectra_path(dr, location, field, apogee, telescope):
+    """
+    Path of a combined spectra file and its checksum file, relative to SAS root which is the same for local mirror
+
+    :param dr: APOGEE DR
+    :type dr: int
+    :param location: Location ID
+    :type location: int
+    :param field: Field
+    :type field: str
+    :param apogee: Apogee ID
+    :type apogee: str
+    :param telescope: Telescope ID, for example 'apo25m' or 'lco25m'
+    :type telescope: str
+    :return: folder relative to SAS root, filename, checksum filename
+    :rtype: tuple[str]
+    """
+    if dr == 13 or dr == 14:
+        reduce_prefix, aspcap_code = ("r6", "l30e") if dr == 13 else ("r8", "l31c")
+        folder = f"dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/{location}/"
+        filename = f"aspcapStar-{reduce_prefix}-{aspcap_code}.2-{apogee}.fits"
+        hash_filename = f"stars_{aspcap_code}_{aspcap_code}.2_{location}.sha1sum"
+    elif dr == 16:
+        reduce_prefix = "r12"
+        aspcap_code = "l33"
+        folder = f"dr16/apogee/spectro/aspcap/{reduce_prefix}/{aspcap_code}/{telescope}/{field}/"
+        filename = f"aspcapStar-{reduce_prefix}-{apogee}.fits"
+        hash_filename = f"{reduce_prefix}_{aspcap_code}_{telescope}_{field}.sha1sum"
+    elif dr == 17:
+        reduce_prefix = "dr17"
+        aspcap_code = "synspec_rev1"
+        folder = f"dr17/apogee/spectro/aspcap/{reduce_prefix}/{aspcap_code}/{telescope}/{field}/"
+        filename = f"aspcapStar-{reduce_prefix}-{apogee}.fits"
+        if telescope == "lco25m":  # syncspec_rev1 only affected lco25m
+            hash_filename = f"{reduce_prefix}_{aspcap_code}_{telescope}_{field}.sha1sum"
+        else:
+            hash_filename = (
+                f"{reduce_prefix}_{aspcap_code[:7]}_{telescope}_{field}.sha1sum"
+            )
+    else:
+        raise ValueError("combined_spectra() only supports APOGEE DR13-DR17")
+
+    return folder, filename, hash_filename
+
+
+def _visit_spectra_path(dr, location, field, apogee, telescope, commission=False):
+    """
+    Path of an individual visit spectra file and its checksum file, relative to SAS root which is the same for local
+    mirror
+
+    :param dr: APOGEE DR
+    :type dr: int
+    :param location: Location ID
+    :type location: int
+    :param field: Field
+    :type field: str
+    :param apogee: Apogee ID
+    :type apogee: str
+    :param telescope: Telescope ID, for example 'apo25m' or 'lco25m'
+    :type telescope: str
+    :param commission: whether the spectra is taken during commissioning
+    :type commission: bool
+    :return: folder relative to SAS root, filename, checksum filename, name to look for in checksum file
+    :rtype: tuple[str]
+    """
+    if dr == 13 or dr == 14:
+        reduce_prefix = "r6" if dr == 13 else "r8"
+        folder = f"dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/{location}/"
+        if commission:
+            filename = f"apStarC-{reduce_prefix}-{apogee}.fits"
+        else:
+            filename = f"apStar-{reduce_prefix}-{apogee}.fits"
+        hash_filename = f"{reduce_prefix}_stars_apo25m_{location}.sha1sum"
+    elif dr == 16 or dr == 17:
+        reduce_prefix = "r12" if dr == 16 else "dr17"
+        folder = (
+            f"dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{telescope}/{field}/"
+        )
+        if telescope == "lco25m":
+            if commission:
+                filename = f"asStarC-{reduce_prefix}-{apogee}.fits"
+            else:
+                filename = f"asStar-{reduce_prefix}-{apogee}.fits"
+        else:
+            if commission:
+                filename = f"apStarC-{reduce_prefix}-{apogee}.fits"
+            else:
+                filename = f"apStar-{reduce_prefix}-{apogee}.fits"
+        hash_filename = f"{reduce_prefix}_stars_{telescope}_{field}.sha1sum"
+    else:
+        raise ValueError("visit_spectra() only supports APOGEE DR13-DR17")
+
+    # visit spectra has a different filename in checksum
+    return folder, filename, hash_filename, f"apStar-{reduce_prefix}-{apogee}"
+
+
 def combined_spectra(
     dr=None,
     location=None,
@@ -443,125 +687,25 @@ def combined_spectra(
     if (location is None and dr < 16) or (
         field is None and dr >= 16
     ):  # try to load info if not enough info
-        global _ALLSTAR_TEMP
-        if not str(f"dr{dr}") in _ALLSTAR_TEMP:
-            _ALLSTAR_TEMP[f"dr{dr}"] = fits.getdata(allstar(dr=dr))
-        if telescope is None:
-            matched_idx = [
-                np.nonzero(_ALLSTAR_TEMP[f"dr{dr}"]["APOGEE_ID"] == apogee)[0]
-            ][0]
-        else:
-            matched_idx = [
-                np.nonzero(
-                    [
-                        (_ALLSTAR_TEMP[f"dr{dr}"]["APOGEE_ID"] == apogee)
-                        & (_ALLSTAR_TEMP[f"dr{dr}"]["TELESCOPE"] == telescope)
-                    ]
-                )
-            ][0][1]
-        if len(matched_idx) == 0:
-            raise ValueError(
-                f"No entry found in allstar DR{dr} met with your requirement!!"
-            )
-
-        location = (
-            _ALLSTAR_TEMP[f"dr{dr}"]["LOCATION_ID"][matched_idx][0]
-            if not location
-            else location
-        )
-        field = (
-            _ALLSTAR_TEMP[f"dr{dr}"]["FIELD"][matched_idx][0] if not field else field
-        )
-        telescope = (
-            _ALLSTAR_TEMP[f"dr{dr}"]["TELESCOPE"][matched_idx][0]
-            if not telescope
-            else telescope
+        allstar_location, allstar_field, allstar_telescope = _allstar_star_info(
+            dr, apogee, telescope
         )
+        location = allstar_location if not location else location
+        field = allstar_field if not field else field
+        telescope = allstar_telescope if not telescope else telescope
 
-    if dr == 13:
-        reduce_prefix = "r6"
-        aspcap_code = "l30e"
-        str1 = f"https://data.sdss.org/sas/dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/{location}/"
-
-        filename = f"aspcapStar-{reduce_prefix}-{aspcap_code}.2-{apogee}.fits"
-        hash_filename = f"stars_{aspcap_code}_{aspcap_code}.2_{location}.sha1sum"
-        urlstr = str1 + filename
-
-        # check folder existence
-        fullfoldername = os.path.join(
-            apogee_env(),
-            f"dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/",
-            str(location),
-        )
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
-
-        fullfilename = os.path.join(fullfoldername, filename)
-
-    elif dr == 14:
-        reduce_prefix = "r8"
-        aspcap_code = "l31c"
-        str1 = f"https://data.sdss.org/sas/dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/{location}/"
-
-        filename = f"aspcapStar-{reduce_prefix}-{aspcap_code}.2-{apogee}.fits"
-        hash_filename = f"stars_{aspcap_code}_{aspcap_code}.2_{location}.sha1sum"
-        urlstr = str1 + filename
-
-        # check folder existence
-        fullfoldername = os.path.join(
-            apogee_env(),
-            f"dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{aspcap_code}/{aspcap_code}.2/",
-            str(location),
-        )
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
-
-        fullfilename = os.path.join(fullfoldername, filename)
-    elif dr == 16:
-        reduce_prefix = "r12"
-        aspcap_code = "l33"
-        str1 = f"https://data.sdss.org/sas/dr16/apogee/spectro/aspcap/{reduce_prefix}/{aspcap_code}/{telescope}/{field}/"
-
-        filename = f"aspcapStar-{reduce_prefix}-{apogee}.fits"
-        hash_filename = f"{reduce_prefix}_{aspcap_code}_{telescope}_{field}.sha1sum"
-        urlstr = str1 + filename
-
-        # check folder existence
-        fullfoldername = os.path.join(
-            apogee_env(),
-            f"dr{dr}/apogee/spectro/aspcap/{reduce_prefix}/{aspcap_code}/{telescope}",
-            str(f"{field}"),
-        )
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
-
-        fullfilename = os.path.join(fullfoldername, filename)
-    elif dr == 17:
-        reduce_prefix = "dr17"
-        aspcap_code = "synspec_rev1"
-        str1 = f"https://data.sdss.org/sas/dr17/apogee/spectro/aspcap/{reduce_prefix}/{aspcap_code}/{telescope}/{field}/"
-
-        filename = f"aspcapStar-{reduce_prefix}-{apogee}.fits"
-        if telescope == "lco25m":  # syncspec_rev1 only affected lco25m
-            hash_filename = f"{reduce_prefix}_{aspcap_code}_{telescope}_{field}.sha1sum"
-        else:
-            hash_filename = (
-                f"{reduce_prefix}_{aspcap_code[:7]}_{telescope}_{field}.sha1sum"
-            )
-        urlstr = str1 + filename
+    folder, filename, hash_filename = _combined_spectra_path(
+        dr, location, field, apogee, telescope
+    )
+    str1 = _SAS_URL + folder
+    urlstr = str1 + filename
 
-        # check folder existence
-        fullfoldername = os.path.join(
-            apogee_env(),
-            f"dr{dr}/apogee/spectro/aspcap/{reduce_prefix}/{aspcap_code}/{telescope}",
-            str(f"{field}"),
-        )
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
+    # check folder existence
+    fullfoldername = os.path.join(apogee_env(), folder)
+    if not os.path.exists(fullfoldername):
+        os.makedirs(fullfoldername)
 
-        fullfilename = os.path.join(fullfoldername, filename)
-    else:
-        raise ValueError("combined_spectra() only supports APOGEE DR13-DR17")
+    fullfilename = os.path.join(fullfoldername, filename)
 
     # check hash file
     full_hash_filename = os.path.join(fullfoldername, hash_filename)
@@ -579,7 +723,7 @@ def combined_spectra(
     file_hash = hash_list[0][np.argwhere(hash_list[1] == filename)]
 
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm="sha1")
+        checksum = cached_filehash(fullfilename, algorithm="sha1")
         if checksum != file_hash and len(file_hash) != 0:
             warnings.warn(
                 "File corruption detected, astroNN is attempting to download again"
@@ -597,7 +741,7 @@ def combined_spectra(
             logging.info(
                 f"Downloaded DR{dr} combined file successfully to {fullfilename}"
             )
-            checksum = filehash(fullfilename, algorithm="sha1")
+            checksum = cached_filehash(fullfilename, algorithm="sha1")
             if checksum != file_hash and len(file_hash) != 0:
                 warnings.warn(
                     "File corruption detected, astroNN is attempting to download again"
@@ -660,127 +804,22 @@ def visit_spectra(
     if (location is None and dr < 16) or (
         field is None and dr >= 16
     ):  # try to load info if not enough info
-        global _ALLSTAR_TEMP
-        if not str(f"dr{dr}") in _ALLSTAR_TEMP:
-            _ALLSTAR_TEMP[f"dr{dr}"] = fits.getdata(allstar(dr=dr))
-        if telescope is None:
-            matched_idx = [
-                np.nonzero(_ALLSTAR_TEMP[f"dr{dr}"]["APOGEE_ID"] == apogee)[0]
-            ][0]
-        else:
-            matched_idx = [
-                np.nonzero(
-                    [
-                        (_ALLSTAR_TEMP[f"dr{dr}"]["APOGEE_ID"] == apogee)
-                        & (_ALLSTAR_TEMP[f"dr{dr}"]["TELESCOPE"] == telescope)
-                    ]
-                )
-            ][0][1]
-        if len(matched_idx) == 0:
-            raise ValueError(
-                f"No entry found in allstar DR{dr} met with your requirement!!"
-            )
-
-        location = (
-            _ALLSTAR_TEMP[f"dr{dr}"]["LOCATION_ID"][matched_idx][0]
-            if not location
-            else location
-        )
-        field = (
-            _ALLSTAR_TEMP[f"dr{dr}"]["FIELD"][matched_idx][0] if not field else field
+        allstar_location, allstar_field, allstar_telescope = _allstar_star_info(
+            dr, apogee, telescope
         )
-        telescope = (
-            _ALLSTAR_TEMP[f"dr{dr}"]["TELESCOPE"][matched_idx][0]
-            if not telescope
-            else telescope
-        )
-
-    if dr == 13:
-        reduce_prefix = "r6"
-        str1 = f"https://data.sdss.org/sas/dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/{location}/"
-        if commission:
-            filename = f"apStarC-{reduce_prefix}-{apogee}.fits"
-        else:
-            filename = f"apStar-{reduce_prefix}-{apogee}.fits"
-        urlstr = str1 + filename
-        hash_filename = f"{reduce_prefix}_stars_apo25m_{location}.sha1sum"
-
-        fullfoldername = os.path.join(
-            apogee_env(),
-            f"dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/",
-            str(location),
-        )
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
-
-    elif dr == 14:
-        reduce_prefix = "r8"
-        str1 = f"https://data.sdss.org/sas/dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/{location}/"
-        if commission:
-            filename = f"apStarC-{reduce_prefix}-{apogee}.fits"
-        else:
-            filename = f"apStar-{reduce_prefix}-{apogee}.fits"
-        urlstr = str1 + filename
-        hash_filename = f"{reduce_prefix}_stars_apo25m_{location}.sha1sum"
-
-        fullfoldername = os.path.join(
-            apogee_env(),
-            f"dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/apo25m/",
-            str(location),
-        )
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
+        location = allstar_location if not location else location
+        field = allstar_field if not field else field
+        telescope = allstar_telescope if not telescope else telescope
 
-    elif dr == 16:
-        reduce_prefix = "r12"
-        str1 = f"https://data.sdss.org/sas/dr16/apogee/spectro/redux/{reduce_prefix}/stars/{telescope}/{field}/"
-        if telescope == "lco25m":
-            if commission:
-                filename = f"asStarC-{reduce_prefix}-{apogee}.fits"
-            else:
-                filename = f"asStar-{reduce_prefix}-{apogee}.fits"
-        else:
-            if commission:
-                filename = f"apStarC-{reduce_prefix}-{apogee}.fits"
-            else:
-                filename = f"apStar-{reduce_prefix}-{apogee}.fits"
-        urlstr = str1 + filename
-        hash_filename = f"{reduce_prefix}_stars_{telescope}_{field}.sha1sum"
-
-        fullfoldername = os.path.join(
-            apogee_env(),
-            f"dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{telescope}/",
-            str(f"{field}"),
-        )
-
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
-    elif dr == 17:
-        reduce_prefix = "dr17"
-        str1 = f"https://data.sdss.org/sas/dr17/apogee/spectro/redux/{reduce_prefix}/stars/{telescope}/{field}/"
-        if telescope == "lco25m":
-            if commission:
-                filename = f"asStarC-{reduce_prefix}-{apogee}.fits"
-            else:
-                filename = f"asStar-{reduce_prefix}-{apogee}.fits"
-        else:
-            if commission:
-                filename = f"apStarC-{reduce_prefix}-{apogee}.fits"
-            else:
-                filename = f"apStar-{reduce_prefix}-{apogee}.fits"
-        urlstr = str1 + filename
-        hash_filename = f"{reduce_prefix}_stars_{telescope}_{field}.sha1sum"
+    folder, filename, hash_filename, hash_key = _visit_spectra_path(
+        dr, location, field, apogee, telescope, commission
+    )
+    str1 = _SAS_URL + folder
+    urlstr = str1 + filename
 
-        fullfoldername = os.path.join(
-            apogee_env(),
-            f"dr{dr}/apogee/spectro/redux/{reduce_prefix}/stars/{telescope}/",
-            str(f"{field}"),
-        )
-
-        if not os.path.exists(fullfoldername):
-            os.makedirs(fullfoldername)
-    else:
-        raise ValueError("visit_spectra() only supports APOGEE DR13-DR17")
+    fullfoldername = os.path.join(apogee_env(), folder)
+    if not os.path.exists(fullfoldername):
+        os.makedirs(fullfoldername)
 
     # check hash file
     full_hash_filename = os.path.join(fullfoldername, hash_filename)
@@ -799,15 +838,11 @@ def visit_spectra(
     # In some rare case, the hash cant be found, so during checking, check len(file_has)!=0 too
     # visit spectra has a different filename in checksum
     # handle the case where apogee_id cannot be found
-    hash_idx = [
-        i
-        for i, item in enumerate(hash_list[1])
-        if f"apStar-{reduce_prefix}-{apogee}" in item
-    ]
+    hash_idx = [i for i, item in enumerate(hash_list[1]) if hash_key in item]
     file_hash = hash_list[0][hash_idx]
 
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm="sha1")
+        checksum = cached_filehash(fullfilename, algorithm="sha1")
         if checksum != file_hash and len(file_hash) != 0:
             warnings.warn(
                 "File corruption detected, astroNN is attempting to download again"
@@ -825,7 +860,7 @@ def visit_spectra(
             logging.info(
                 f"Downloaded DR{dr} individual visit file successfully to {fullfilename}"
             )
-            checksum = filehash(fullfilename, algorithm="sha1")
+            checksum = cached_filehash(fullfilename, algorithm="sha1")
             if checksum != file_hash and len(file_hash) != 0:
                 warnings.warn(
                     "File corruption detected, astroNN is attempting to download again"
@@ -846,6 +881,208 @@ def visit_spectra(
     return fullfilename
 
 
+def _bulk_download_file(url, fullfilename, file_hash, retries, headers):
+    """
+    Download a single file for ``bulk_spectra``, skipped if the file exists locally and is not corrupted
+
+    :return: full file path, False if cannot be downloaded
+    :rtype: Union(str, bool)
+    """
+    if os.path.isfile(fullfilename) and (
+        file_hash is None
+        or cached_filehash(fullfilename, algorithm="sha1") == file_hash
+    ):
+        return fullfilename
+    try:
+        return http_download(
+            url, fullfilename, file_hash=file_hash, retries=retries, headers=headers
+        )
+    except urllib.error.HTTPError as emsg:
+        if "404" in str(emsg):
+            warnings.warn(f"{url} cannot be found on server, skipped")
+        else:
+            warnings.warn(f"Unknown error occurred - {emsg}")
+    except ConnectionError as emsg:
+        warnings.warn(str(emsg))
+    return warning_flag
+
+
+def bulk_spectra(
+    dr=None,
+    apogee=None,
+    location=None,
+    field=None,
+    telescope=None,
+    spectra="combined",
+    commission=False,
+    workers=8,
+    retries=3,
+    verbose=1,
+    sas_url=None,
+):
+    """
+    Download many combined spectra (aspcapStar) or individual spectra (apStar/asStar) files concurrently with a
+    bounded pool of keep-alive HTTP connections. Every file is verified with the checksum files on SAS and partially
+    downloaded files are resumed in later calls
+
+    :param dr: APOGEE DR
+    :type dr: int
+    :param apogee: Apogee IDs, or a slice of allStar with APOGEE_ID, FIELD, TELESCOPE and LOCATION_ID columns
+    :type apogee: Union(ndarray, list[str], astropy.io.fits.FITS_rec)
+    :param location: Location IDs [Optional], same length as apogee or a single value
+    :type location: Union(ndarray, list[int], int)
+    :param field: Fields [Optional], same length as apogee or a single value
+    :type field: Union(ndarray, list[str], str)
+    :param telescope: Telescope IDs [Optional], for example 'apo25m' or 'lco25m', same length as apogee or a single value
+    :type telescope: Union(ndarray, list[str], str)
+    :param spectra: 'combined' for combined spectra or 'visit' for individual spectra
+    :type spectra: str
+    :param commission: whether the spectra is taken during commissioning, only used for individual spectra
+    :type commission: bool
+    :param workers: number of concurrent connections
+    :type workers: int
+    :param retries: number of retries for every file on connection error or checksum mismatch
+    :type retries: int
+    :param verbose: verbose, set 0 to silent progress bar
+    :type verbose: int
+    :param sas_url: root URL of SAS or a mirror, default is https://data.sdss.org/sas/
+    :type sas_url: Union(str, NoneType)
+    :return: list of full file paths, False for files cannot be downloaded
+    :rtype: list
+    """
+    dr = apogee_default_dr(dr=dr)
+    sas_url = _SAS_URL if sas_url is None else sas_url.rstrip("/") + "/"
+    if spectra not in ["combined", "visit"]:
+        raise ValueError("spectra must be either 'combined' or 'visit'")
+
+    # take columns from allStar slice if it is provided
+    if getattr(getattr(apogee, "dtype", None), "names", None) is not None:
+        allstar_slice = apogee
+        apogee = allstar_slice["APOGEE_ID"]
+        if location is None and "LOCATION_ID" in allstar_slice.dtype.names:
+            location = allstar_slice["LOCATION_ID"]
+        if field is None and "FIELD" in allstar_slice.dtype.names:
+            field = allstar_slice["FIELD"]
+        if telescope is None and "TELESCOPE" in allstar_slice.dtype.names:
+            telescope = allstar_slice["TELESCOPE"]
+
+    apogee = np.char.rstrip(np.atleast_1d(np.asarray(apogee, dtype=str)))
+    num_stars = apogee.shape[0]
+
+    def _per_star(arr, dtype):
+        if arr is None:
+            return [None] * num_stars
+        arr = np.atleast_1d(np.asarray(arr, dtype=dtype))
+        if dtype is str:
+            arr = np.char.rstrip(arr)
+        return list(np.broadcast_to(arr, (num_stars,)))
+
+    location, field, telescope = (
+        _per_star(location, int),
+        _per_star(field, str),
+        _per_star(telescope, str),
+    )
+
+    headers = None
+    if __apogee_credentials_username is not None:
+        credentials = f"{__apogee_credentials_username}:{__apogee_credentials_pw}"
+        headers = {
+            "Authorization": f"Basic {base64.b64encode(credentials.encode()).decode()}"
+        }
+
+    # resolve paths of every star, look up allStar index only if not enough info
+    fullfilenames = [warning_flag] * num_stars
+    star_paths = {}
+    for i in range(num_stars):
+        if (location[i] is None and dr < 16) or (field[i] is None and dr >= 16):
+            try:
+                star_info = _allstar_star_info(dr, apogee[i], telescope[i])
+            except ValueError as emsg:
+                warnings.warn(f"{apogee[i]} skipped - {emsg}")
+                continue
+            location[i] = star_info[0] if location[i] is None else location[i]
+            field[i] = star_info[1] if field[i] is None else field[i]
+            telescope[i] = star_info[2] if telescope[i] is None else telescope[i]
+        if spectra == "combined":
+            folder, filename, hash_filename = _combined_spectra_path(
+                dr, location[i], field[i], apogee[i], telescope[i]
+            )
+            hash_key = None
+        else:
+            folder, filename, hash_filename, hash_key = _visit_spectra_path(
+                dr, location[i], field[i], apogee[i], telescope[i], commission
+            )
+        star_paths[i] = (folder, filename, hash_filename, hash_key)
+
+    folders = {(paths[0], paths[2]) for paths in star_paths.values()}
+    for folder, _ in folders:
+        fullfoldername = os.path.join(apogee_env(), folder)
+        if not os.path.exists(fullfoldername):
+            os.makedirs(fullfoldername)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        # checksum files first, every folder has one checksum file
+        hash_futures = {
+            (folder, hash_filename): executor.submit(
+                _bulk_download_file,
+                sas_url + folder + hash_filename,
+                os.path.join(apogee_env(), folder, hash_filename),
+                None,
+                retries,
+                headers,
+            )
+            for folder, hash_filename in folders
+        }
+        hash_tables = {}
+        for key, future in hash_futures.items():
+            full_hash_filename = future.result()
+            if full_hash_filename is warning_flag:
+                hash_tables[key] = {}
+                continue
+            hash_list = np.loadtxt(full_hash_filename, dtype="str", ndmin=2).T
+            hash_tables[key] = dict(zip(hash_list[1], hash_list[0]))
+
+        star_tasks = {}
+        for i, (folder, filename, hash_filename, hash_key) in star_paths.items():
+            hash_table = hash_tables[(folder, hash_filename)]
+            if hash_key is None:
+                file_hash = hash_table.get(filename)
+            else:
+                # individual spectra has a different filename in checksum
+                file_hash = next(
+                    (v for k, v in hash_table.items() if hash_key in k), None
+                )
+            star_tasks[i] = (
+                sas_url + folder + filename,
+                os.path.join(apogee_env(), folder, filename),
+                file_hash,
+            )
+
+        # verify files already exist locally in parallel, only download the missing or corrupted ones
+        local_stars = [i for i, task in star_tasks.items() if os.path.isfile(task[1])]
+        local_hashes = filehashes(
+            [star_tasks[i][1] for i in local_stars], algorithm="sha1", workers=workers
+        )
+        for i, checksum in zip(local_stars, local_hashes):
+            if star_tasks[i][2] is None or checksum == star_tasks[i][2]:
+                fullfilenames[i] = star_tasks.pop(i)[1]
+
+        star_futures = {
+            executor.submit(_bulk_download_file, *task, retries, headers): i
+            for i, task in star_tasks.items()
+        }
+
+        for future in tqdm(
+            concurrent.futures.as_completed(star_futures),
+            total=len(star_futures),
+            desc=f"DR{dr} {spectra} spectra",
+            disable=not verbose,
+        ):
+            fullfilenames[star_futures[future]] = future.result()
+
+    return fullfilenames
+
+
 def apogee_rc(dr=None, flag=None):
     """
     Download the APOGEE red clumps catalogue
@@ -909,7 +1146,7 @@ def apogee_rc(dr=None, flag=None):
 
     # check file integrity
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm="sha1")
+        checksum = cached_filehash(fullfilename, algorithm="sha1")
         if checksum != file_hash.lower():
             warnings.warn(
                 "File corruption detected, astroNN is attempting to download again"
@@ -927,7 +1164,7 @@ def apogee_rc(dr=None, flag=None):
                 logging.info(
                     f"Downloaded DR{dr} Red Clumps Catalog successfully to {fullfilename}"
                 )
-                checksum = filehash(fullfilename, algorithm="sha1")
+                checksum = cached_filehash(fullfilename, algorithm="sha1")
                 if checksum != file_hash.lower():
                     warnings.warn(
                         "File corruption detected, astroNN is attempting to download again"
@@ -997,7 +1234,7 @@ def apogee_distances(dr=None, flag=None):
 
     # check file integrity
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm="sha1")
+        checksum = cached_filehash(fullfilename, algorithm="sha1")
         if checksum != file_hash.lower():
             warnings.warn(
                 "File corruption detected, astroNN is attempting to download again"
@@ -1015,7 +1252,7 @@ def apogee_distances(dr=None, flag=None):
                 logging.info(
                     f"Downloaded DR{dr} Distances successfully to {fullfilename}"
                 )
-                checksum = filehash(fullfilename, algorithm="sha1")
+                checksum = cached_filehash(fullfilename, algorithm="sha1")
                 if checksum != file_hash.lower():
                     warnings.warn(
                         "File corruption detected, astroNN is attempting to download again"
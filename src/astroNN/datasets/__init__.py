@@ -2,6 +2,6 @@ from astroNN.datasets.apogee import load_apogee_distances, load_apogee_rc
 from astroNN.datasets.galaxy10 import load_data as load_galaxy10
 from astroNN.datasets.galaxy10sdss import load_data as load_galaxy10sdss
 from astroNN.datasets.h5 import H5Loader
-from astroNN.datasets.xmatch import xmatch
+from astroNN.datasets.xmatch import SkyIndex, xmatch
 
 # from astroNN.datasets.utils import Dataset
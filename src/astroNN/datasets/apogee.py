@@ -2,8 +2,8 @@ import numpy as np
 from astropy import units as u
 from astropy.io import fits
 
-from astroNN.apogee import allstar
-from astroNN.apogee.downloader import apogee_distances, apogee_rc
+from astroNN.apogee import apogee_default_dr
+from astroNN.apogee.downloader import _allstar_slim, apogee_distances, apogee_rc
 from astroNN.gaia import mag_to_absmag, mag_to_fakemag, extinction_correction
 
 
@@ -33,6 +33,7 @@ def load_apogee_distances(
         | 2018-Jan-25 - Written - Henry Leung (University of Toronto)
         | 2021-Jan-29 - Updated - Henry Leung (University of Toronto)
     """
+    dr = apogee_default_dr(dr=dr)
     fullfilename = apogee_distances(dr=dr)
 
     with fits.open(fullfilename) as F:
@@ -41,14 +42,13 @@ def load_apogee_distances(
         distance = hdulist["BPG_dist50"] * 1000
         dist_err = (hdulist["BPG_dist84"] - hdulist["BPG_dist16"]) * 1000
 
-    allstarfullpath = allstar(dr=dr)
-
-    with fits.open(allstarfullpath) as F:
-        k_mag = F[1].data["K"]
-        if extinction:
-            k_mag = extinction_correction(k_mag, F[1].data["AK_TARG"])
-        ra = F[1].data["RA"]
-        dec = F[1].data["DEC"]
+    # only load the needed columns from the slim allStar cache
+    allstar_slim = _allstar_slim(dr)
+    k_mag = np.array(allstar_slim["K"])
+    if extinction:
+        k_mag = extinction_correction(k_mag, allstar_slim["AK_TARG"])
+    ra = np.array(allstar_slim["RA"])
+    dec = np.array(allstar_slim["DEC"])
 
     # Bad index refers to nan index
     bad_index = np.argwhere(np.isnan(distance))
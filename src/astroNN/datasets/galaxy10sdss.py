@@ -9,7 +9,7 @@ import h5py
 import numpy as np
 
 from astroNN.config import astroNN_CACHE_DIR
-from astroNN.shared.downloader_tools import TqdmUpTo, filehash
+from astroNN.shared.downloader_tools import TqdmUpTo, cached_filehash
 
 Galaxy10Class = {
     0: "Disk, Face-on, No Spiral",
@@ -57,7 +57,7 @@ def load_data(flag=None):
 
     # Check if files exists
     if os.path.isfile(fullfilename) and flag is None:
-        checksum = filehash(fullfilename, algorithm="sha256")
+        checksum = cached_filehash(fullfilename, algorithm="sha256")
         if checksum != file_hash.lower():
             print("File corruption detected, astroNN is attempting to download again")
             load_data(flag=1)
@@ -71,7 +71,7 @@ def load_data(flag=None):
                 complete_url, fullfilename, reporthook=t.update_to
             )
             print(f"Downloaded Galaxy10 successfully to {fullfilename}")
-            checksum = filehash(fullfilename, algorithm="sha256")
+            checksum = cached_filehash(fullfilename, algorithm="sha256")
             if checksum != file_hash.lower():
                 load_data(flag=1)
 
@@ -3,11 +3,16 @@
 # ---------------------------------------------------------#
 
 import os
-from functools import reduce
 
 import h5py
 import numpy as np
 
+# read rows from HDF5 in blocks of about this many bytes
+_H5_BLOCK_BYTES = 64 * 1024**2
+
+# allowed index of h5 files, keyed by (path, size, mtime, target, exclude9999, load_combined)
+_ALLOWED_INDEX_CACHE = {}
+
 
 def h5name_check(h5name):
     if h5name is None:
@@ -15,6 +20,56 @@ def h5name_check(h5name):
     return None
 
 
+def _h5_block_rows(dataset):
+    """
+    Number of rows in a read block of a HDF5 dataset, aligned to HDF5 chunks if the dataset is chunked
+    """
+    row_bytes = int(np.prod(dataset.shape[1:], dtype=np.int64)) * dataset.dtype.itemsize
+    rows = max(1, _H5_BLOCK_BYTES // max(1, row_bytes))
+    if dataset.chunks is not None:
+        chunk_rows = dataset.chunks[0]
+        rows = max(chunk_rows, rows // chunk_rows * chunk_rows)
+    return rows
+
+
+def _h5_read_rows(dataset, index, dtype=None):
+    """
+    Read rows of a HDF5 dataset with sorted index block by block, only blocks with requested rows are read and
+    a contiguous run of rows is read directly into the output without an intermediate copy
+
+    :param dataset: HDF5 dataset
+    :type dataset: h5py.Dataset
+    :param index: sorted row index
+    :type index: ndarray[int]
+    :param dtype: dtype of the output, None to use the dtype of the dataset
+    :type dtype: Union(numpy.dtype, NoneType)
+    :return: requested rows
+    :rtype: ndarray
+    """
+    index = np.asarray(index, dtype=np.int64)
+    out = np.empty(
+        (index.shape[0],) + dataset.shape[1:],
+        dtype=dataset.dtype if dtype is None else dtype,
+    )
+    if index.shape[0] == 0:
+        return out
+
+    block_rows = _h5_block_rows(dataset)
+    # split the index where it crosses a block boundary
+    splits = np.flatnonzero(np.diff(index // block_rows)) + 1
+    for start, stop in zip(
+        np.concatenate(([0], splits)), np.concatenate((splits, [index.shape[0]]))
+    ):
+        first, last = index[start], index[stop - 1]
+        if last - first + 1 == stop - start:
+            dataset.read_direct(
+                out, source_sel=np.s_[first : last + 1], dest_sel=np.s_[start:stop]
+            )
+        else:
+            out[start:stop] = dataset[first : last + 1][index[start:stop] - first]
+    return out
+
+
 class H5Loader(object):
     def __init__(self, filename, target="all"):
         self.filename = filename
@@ -23,6 +78,8 @@ class H5Loader(object):
         self.load_combined = True
         self.load_err = False
         self.exclude9999 = False
+        self.dtype = None
+        self.order = "C"
 
         if os.path.isfile(os.path.join(self.currentdir, self.filename)) is True:
             self.h5path = os.path.join(self.currentdir, self.filename)
@@ -37,63 +94,133 @@ class H5Loader(object):
             )
 
     def load_allowed_index(self):
-        with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
-            if self.exclude9999 is True:
-                index_not9999 = None
-                for counter, tg in enumerate(self.target):
-                    if index_not9999 is None:
-                        index_not9999 = np.arange(F[f"{tg}"].shape[0])
-                    temp_index = np.where(np.array(F[f"{tg}"]) != -9999)[0]
-                    index_not9999 = reduce(np.intersect1d, (index_not9999, temp_index))
-
-                in_flag = index_not9999
-                if self.load_combined is True:
-                    in_flag = np.where(np.array(F["in_flag"]) == 0)[0]
-                elif self.load_combined is False:
-                    in_flag = np.where(np.array(F["in_flag"]) == 1)[0]
-
-                allowed_index = reduce(np.intersect1d, (index_not9999, in_flag))
+        """
+        NAME:
+            load_allowed_index
+        PURPOSE:
+            get the index of rows allowed by exclude9999 and load_combined, cached until the h5 file is changed
+        INPUT:
+        OUTPUT:
+            (ndarray): sorted read-only index
+        """
+        stat = os.stat(self.h5path)
+        key = (
+            self.h5path,
+            stat.st_size,
+            stat.st_mtime_ns,
+            tuple(self.target),
+            self.exclude9999,
+            self.load_combined,
+        )
+        if key in _ALLOWED_INDEX_CACHE:
+            return _ALLOWED_INDEX_CACHE[key]
 
+        with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
+            # in_flag is only read if needed, files without in_flag can be loaded with load_combined=None
+            if self.load_combined is True:
+                in_flag = np.asarray(F["in_flag"])
+                allowed = in_flag.reshape(in_flag.shape[0]) == 0
+            elif self.load_combined is False:
+                in_flag = np.asarray(F["in_flag"])
+                allowed = in_flag.reshape(in_flag.shape[0]) == 1
             else:
-                in_flag = []
-                if self.load_combined is True:
-                    in_flag = np.where(np.array(F["in_flag"]) == 0)[0]
-                elif self.load_combined is False:
-                    in_flag = np.where(np.array(F["in_flag"]) == 1)[0]
-
-                allowed_index = in_flag
-
-            F.close()
+                num_rows = F["spectra"].shape[0]
+                # only rows with target not -9999 are allowed, nothing is allowed without exclude9999
+                allowed = np.full(num_rows, self.exclude9999 is True)
 
+            if self.exclude9999 is True:
+                # a row is kept if any of its value of every target is not -9999
+                for tg in self.target:
+                    tg_data = np.asarray(F[f"{tg}"])
+                    allowed &= (tg_data.reshape(tg_data.shape[0], -1) != -9999).any(
+                        axis=1
+                    )
+
+        allowed_index = np.flatnonzero(allowed)
+        allowed_index.flags.writeable = False
+        _ALLOWED_INDEX_CACHE[key] = allowed_index
         return allowed_index
 
-    def load(self):
-        allowed_index = self.load_allowed_index()
-        with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
-            allowed_index_list = allowed_index.tolist()
-            spectra = np.array(F["spectra"])[allowed_index_list]
-            spectra_err = np.array(F["spectra_err"])[allowed_index_list]
-
-            y = np.array((spectra.shape[1]))
-            y_err = np.array((spectra.shape[1]))
-            for counter, tg in enumerate(self.target):
-                temp = np.array(F[f"{tg}"])[allowed_index_list]
-                if counter == 0:
-                    y = temp[:]
-                else:
-                    y = np.column_stack((y, temp[:]))
-                if self.load_err is True:
-                    temp_err = np.array(F[f"{tg}_err"])[allowed_index_list]
-                    if counter == 0:
-                        y_err = temp_err[:]
-                    else:
-                        y_err = np.column_stack((y_err, temp_err[:]))
+    def _load_rows(self, F, index):
+        """
+        NAME:
+            _load_rows
+        PURPOSE:
+            load spectra and targets of the rows of index from an opened h5 file
+        INPUT:
+            F (h5py.File): opened h5 file
+            index (ndarray): sorted row index
+        OUTPUT:
+            (tuple): same as the output from load()
+        """
+        spectra = _h5_read_rows(F["spectra"], index, dtype=self.dtype)
+        spectra_err = (
+            _h5_read_rows(F["spectra_err"], index, dtype=self.dtype)
+            if self.load_err
+            else None
+        )
+
+        # preallocate labels and fill target by target
+        target_shapes = [F[f"{tg}"].shape[1:] for tg in self.target]
+        target_widths = [int(np.prod(shape, dtype=np.int64)) for shape in target_shapes]
+        labels_shape = (index.shape[0], sum(target_widths))
+        labels_dtype = (
+            np.result_type(*[F[f"{tg}"].dtype for tg in self.target])
+            if self.dtype is None
+            else self.dtype
+        )
+        y = np.empty(labels_shape, dtype=labels_dtype, order=self.order)
+        y_err = (
+            np.empty(labels_shape, dtype=labels_dtype, order=self.order)
+            if self.load_err
+            else None
+        )
+        column = 0
+        for tg, width in zip(self.target, target_widths):
+            y[:, column : column + width] = _h5_read_rows(F[f"{tg}"], index).reshape(
+                -1, width
+            )
+            if self.load_err is True:
+                y_err[:, column : column + width] = _h5_read_rows(
+                    F[f"{tg}_err"], index
+                ).reshape(-1, width)
+            column += width
+
+        # single target keeps the shape of the dataset
+        if len(target_shapes) == 1:
+            y = y.reshape((index.shape[0],) + target_shapes[0], order=self.order)
+            if self.load_err is True:
+                y_err = y_err.reshape(
+                    (index.shape[0],) + target_shapes[0], order=self.order
+                )
 
         if self.load_err is True:
             return spectra, y, spectra_err, y_err
         else:
             return spectra, y
 
+    def load(self):
+        allowed_index = self.load_allowed_index()
+        with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
+            return self._load_rows(F, allowed_index)
+
+    def batches(self, batch_size=1024):
+        """
+        NAME:
+            batches
+        PURPOSE:
+            lazily load the dataset batch by batch straight from the h5 file without loading the whole dataset,
+            the order will be the same as the output from load()
+        INPUT:
+            batch_size (int): number of rows in every batch
+        OUTPUT:
+            (generator): every batch is a tuple the same as the output from load()
+        """
+        allowed_index = self.load_allowed_index()
+        with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
+            for start in range(0, allowed_index.shape[0], batch_size):
+                yield self._load_rows(F, allowed_index[start : start + batch_size])
+
     def load_entry(self, name):
         """
         NAME:
@@ -108,6 +235,5 @@ class H5Loader(object):
             2018-Feb-08 - Written - Henry Leung (University of Toronto)
         """
         allowed_index = self.load_allowed_index()
-        allowed_index_list = allowed_index.tolist()
         with h5py.File(self.h5path) as F:  # ensure the file will be cleaned up
-            return np.array(F[f"{name}"])[allowed_index_list]
+            return _h5_read_rows(F[f"{name}"], allowed_index)
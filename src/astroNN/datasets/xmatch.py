@@ -2,12 +2,225 @@
 #   astroNN.datasets.xmatch: matching function between catalog
 # ---------------------------------------------------------#
 
+import contextlib
+import os
 import pathlib
+import tempfile
+
 import numpy as np
 import h5py
 from astropy.io import fits
 from astropy import units as u
 import astropy.coordinates as acoords
+from scipy.spatial import KDTree
+
+
+def _radec_to_unitvec(ra, dec):
+    """
+    Convert RA/DEC in degree to unit vectors
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    cos_dec = np.cos(dec)
+    return np.stack((cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)), axis=-1)
+
+
+def _arcsec_to_chord(sep):
+    """
+    Convert angular separation in arcsecond to chord length between unit vectors
+    """
+    return 2.0 * np.sin(np.minimum(np.radians(np.asarray(sep) / 3600.0), np.pi) / 2.0)
+
+
+def _chord_to_arcsec(chord):
+    """
+    Convert chord length between unit vectors to angular separation in arcsecond
+    """
+    with np.errstate(invalid="ignore"):
+        return np.degrees(2.0 * np.arcsin(np.minimum(chord, 2.0) / 2.0)) * 3600.0
+
+
+class SkyIndex(object):
+    """
+    Reusable spatial index of a catalog for cross-matching, built once as a KD-tree on unit vectors of RA/DEC
+    and queried by other catalogs in chunks
+    """
+
+    def __init__(self, ra, dec, leafsize=16):
+        """
+        To build a spatial index of a catalog
+
+        :param ra: 1d array for the catalog RA in degree
+        :type ra: ndarray
+        :param dec: 1d array for the catalog DEC in degree
+        :type dec: ndarray
+        :param leafsize: leafsize of the KD-tree
+        :type leafsize: int
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+        dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+        self.size = ra.shape[0]
+        # objects without valid coordinates can never be matched
+        self.valid_index = np.flatnonzero(np.isfinite(ra) & np.isfinite(dec))
+        self.tree = KDTree(
+            _radec_to_unitvec(ra[self.valid_index], dec[self.valid_index]),
+            leafsize=leafsize,
+            balanced_tree=False,
+        )
+
+    def _query_chunks(self, ra, dec, chunk_size):
+        """
+        Iterate over chunks of coordinates as unit vectors, coordinates that are not finite are skipped
+
+        :return: generator of index in ra/dec and the unit vectors
+        """
+        ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+        dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+        for start in range(0, ra.shape[0], chunk_size):
+            chunk_index = start + np.flatnonzero(
+                np.isfinite(ra[start : start + chunk_size])
+                & np.isfinite(dec[start : start + chunk_size])
+            )
+            yield chunk_index, _radec_to_unitvec(ra[chunk_index], dec[chunk_index])
+
+    def match(self, ra, dec, maxdist=2.0, chunk_size=1048576, workers=1):
+        """
+        Cross-matching coordinates to the nearest neighbour in the index
+
+        :param ra: 1d array for RA in degree
+        :type ra: ndarray
+        :param dec: 1d array for DEC in degree
+        :type dec: ndarray
+        :param maxdist: Maximium distance in arcsecond
+        :type maxdist: float
+        :param chunk_size: number of coordinates queried at once
+        :type chunk_size: int
+        :param workers: number of threads to query the index, -1 to use all CPUs
+        :type workers: int
+
+        :return: index in ra/dec, index in the catalog of the index and separation
+        :rtype: ndarrays
+        """
+        # small margin to the upper bound so rounding never drops a match, exact cut on the separation below
+        upper_bound = _arcsec_to_chord(maxdist) * (1.0 + 1e-8)
+        idx1, idx2 = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+        sep = [np.empty(0)]
+        for chunk_index, vec in self._query_chunks(ra, dec, chunk_size):
+            chord, tree_idx = self.tree.query(
+                vec, k=1, distance_upper_bound=upper_bound, workers=workers
+            )
+            chunk_sep = _chord_to_arcsec(chord)
+            good = chunk_sep < maxdist
+            idx1.append(chunk_index[good])
+            idx2.append(self.valid_index[tree_idx[good]])
+            sep.append(chunk_sep[good])
+
+        return (
+            np.concatenate(idx1, dtype=np.int64),
+            np.concatenate(idx2, dtype=np.int64),
+            acoords.Angle(np.concatenate(sep, dtype=np.float64) / 3600.0, unit=u.deg),
+        )
+
+    def query_radius(self, ra, dec, maxdist=2.0, chunk_size=1048576):
+        """
+        Find every object in the index within a radius, results are compact arrays in CSR-style where matches of
+        the i-th coordinates are ``idx[offsets[i]:offsets[i + 1]]`` sorted by separation
+
+        :param ra: 1d array for RA in degree
+        :type ra: ndarray
+        :param dec: 1d array for DEC in degree
+        :type dec: ndarray
+        :param maxdist: Maximium distance in arcsecond
+        :type maxdist: float
+        :param chunk_size: number of coordinates queried at once
+        :type chunk_size: int
+
+        :return: offsets with length of ra/dec plus one, index in the catalog of the index and separation
+        :rtype: ndarrays
+        """
+        upper_bound = _arcsec_to_chord(maxdist) * (1.0 + 1e-8)
+        num_coords = np.atleast_1d(ra).shape[0]
+        counts = np.zeros(num_coords, dtype=np.int64)
+        idx, sep = [np.empty(0, dtype=np.int64)], [np.empty(0)]
+        for chunk_index, vec in self._query_chunks(ra, dec, chunk_size):
+            # all pairs within the radius at once with a tree of the query coordinates
+            pairs = KDTree(vec).sparse_distance_matrix(
+                self.tree, upper_bound, output_type="ndarray"
+            )
+            pairs_sep = _chord_to_arcsec(pairs["v"])
+            good = pairs_sep < maxdist
+            pairs_i, pairs_j, pairs_sep = (
+                pairs["i"][good],
+                pairs["j"][good],
+                pairs_sep[good],
+            )
+            order = np.lexsort((pairs_j, pairs_sep, pairs_i))
+            counts[chunk_index] = np.bincount(pairs_i, minlength=chunk_index.shape[0])
+            idx.append(self.valid_index[pairs_j[order]])
+            sep.append(pairs_sep[order])
+
+        offsets = np.zeros(num_coords + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return (
+            offsets,
+            np.concatenate(idx),
+            acoords.Angle(np.concatenate(sep) / 3600.0, unit=u.deg),
+        )
+
+    def query_knn(self, ra, dec, k=1, maxdist=None, chunk_size=1048576, workers=1):
+        """
+        Find k-nearest neighbours in the index
+
+        :param ra: 1d array for RA in degree
+        :type ra: ndarray
+        :param dec: 1d array for DEC in degree
+        :type dec: ndarray
+        :param k: number of nearest neighbours
+        :type k: int
+        :param maxdist: Maximium distance in arcsecond, None for no limit
+        :type maxdist: Union(float, NoneType)
+        :param chunk_size: number of coordinates queried at once
+        :type chunk_size: int
+        :param workers: number of threads to query the index, -1 to use all CPUs
+        :type workers: int
+
+        :return: index in the catalog of the index and separation with shape (length of ra/dec, k) sorted by
+            separation, index is -1 and separation is infinity if there is no more neighbour
+        :rtype: ndarrays
+        """
+        upper_bound = (
+            np.inf if maxdist is None else _arcsec_to_chord(maxdist) * (1.0 + 1e-8)
+        )
+        num_coords = np.atleast_1d(ra).shape[0]
+        idx = np.full((num_coords, k), -1, dtype=np.int64)
+        sep = np.full((num_coords, k), np.inf)
+        for chunk_index, vec in self._query_chunks(ra, dec, chunk_size):
+            chord, tree_idx = self.tree.query(
+                vec,
+                k=np.arange(1, k + 1),
+                distance_upper_bound=upper_bound,
+                workers=workers,
+            )
+            chunk_sep = _chord_to_arcsec(chord)
+            found = tree_idx < self.tree.n
+            if maxdist is not None:
+                found &= chunk_sep < maxdist
+            chunk_idx = np.full(found.shape, -1, dtype=np.int64)
+            chunk_idx[found] = self.valid_index[tree_idx[found]]
+            idx[chunk_index] = chunk_idx
+            sep[chunk_index] = np.where(found, chunk_sep, np.inf)
+        return idx, acoords.Angle(sep / 3600.0, unit=u.deg)
+
+
+def _epoch_shift(ra2, dec2, epoch1, epoch2, pmra2, pmdec2):
+    """
+    Use proper motion to get the second catalog at the same time of the first catalog
+    """
+    depoch = epoch2 - epoch1
+    if np.any(depoch != 0.0):
+        dra = pmra2 / np.cos(dec2 / 180.0 * np.pi) / 3600000.0 * depoch
+        ddec = pmdec2 / 3600000.0 * depoch
+        return ra2 - dra, dec2 - ddec
+    return ra2, dec2
 
 
 def xmatch(
@@ -49,26 +262,74 @@ def xmatch(
         | 2018-Jan-25 - Written - Henry Leung (University of Toronto)
         | 2021-Jan-29 - Updated - Henry Leung (University of Toronto)
     """
-    depoch = epoch2 - epoch1
-    if np.any(depoch != 0.0):
-        # Use proper motion to get both catalogs at the same time
-        dra = pmra2 / np.cos(dec2 / 180.0 * np.pi) / 3600000.0 * depoch
-        ddec = pmdec2 / 3600000.0 * depoch
-    else:
-        dra = 0.0
-        ddec = 0.0
-    mc1 = acoords.SkyCoord(ra1, dec1, unit=(u.degree, u.degree), frame="icrs")
-    mc2 = acoords.SkyCoord(
-        ra2 - dra, dec2 - ddec, unit=(u.degree, u.degree), frame="icrs"
-    )
+    ra2, dec2 = _epoch_shift(ra2, dec2, epoch1, epoch2, pmra2, pmdec2)
+    return SkyIndex(ra2, dec2).match(ra1, dec1, maxdist=maxdist)
 
-    idx, d2d, d3d = mc1.match_to_catalog_sky(mc2)
-    # to make sure filtering out all neg ones which are untouched
-    mindx = (d2d < maxdist * u.arcsec) & (0.0 * u.arcsec <= d2d)
-    m1 = np.arange(len(ra1))[mindx]
-    m2 = idx[mindx]
 
-    return m1, m2, d2d[mindx]
+def _xmatch_grouped(ra1, dec1, group1, ra2, dec2, group2, maxdist=2.0):
+    """
+    Cross-matching objects only within the same group, every object is touched once by sorting both catalogs by group
+
+    :return: numpy array of index in catalog 1, index in catalog 2 and separation, sorted by index in catalog 1
+    :rtype: ndarrays
+    """
+    sorter1 = np.argsort(group1, kind="stable")
+    sorter2 = np.argsort(group2, kind="stable")
+    group1, group2 = group1[sorter1], group2[sorter2]
+
+    uniques, starts1 = np.unique(group1, return_index=True)
+    ends1 = np.append(starts1[1:], group1.shape[0])
+    starts2 = np.searchsorted(group2, uniques, side="left")
+    ends2 = np.searchsorted(group2, uniques, side="right")
+
+    idx1, idx2, sep = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], []
+    for start1, end1, start2, end2 in zip(starts1, ends1, starts2, ends2):
+        if start2 == end2:  # no object in the same group in catalog 2
+            continue
+        members1, members2 = sorter1[start1:end1], sorter2[start2:end2]
+        m1, m2, d2d = SkyIndex(ra2[members2], dec2[members2]).match(
+            ra1[members1], dec1[members1], maxdist=maxdist
+        )
+        idx1.append(members1[m1])
+        idx2.append(members2[m2])
+        sep.append(d2d.deg)
+
+    idx1, idx2 = np.concatenate(idx1), np.concatenate(idx2)
+    sep = np.concatenate(sep) if sep else np.empty(0)
+    order = np.argsort(idx1, kind="stable")
+    return idx1[order], idx2[order], acoords.Angle(sep[order], unit=u.deg)
+
+
+@contextlib.contextmanager
+def _load_catalog(cat):
+    """
+    Open a catalog if a path is given, fits files are memory-mapped and h5 files are read lazily. h5 files opened
+    from a path are closed when the context exits, catalogs given already opened are left open
+
+    :param cat: path to `.fits` or `.h5` or opened fits or h5 files
+    :type cat: Union(str, pathlib.Path, h5py.File, astropy.io.fits.FITS_rec)
+    :return: context manager of catalog
+    """
+    if isinstance(cat, (str, pathlib.Path)):
+        cat_ext = pathlib.Path(cat).suffix
+        if cat_ext.lower() == ".h5":
+            with h5py.File(cat, mode="r") as F:
+                yield F
+            return
+        elif cat_ext.lower() in (".fits", ".fit"):
+            cat = fits.getdata(cat, memmap=True)
+        else:
+            raise TypeError(f"Unsupported file type {cat_ext}")
+    yield cat
+
+
+def _h5_append(dataset, values):
+    """
+    Append values to a resizable 1d HDF5 dataset
+    """
+    size = dataset.shape[0]
+    dataset.resize((size + values.shape[0],))
+    dataset[size:] = values
 
 
 def xmatch_cat(
@@ -113,64 +374,191 @@ def xmatch_cat(
     :History:
         | 2021-Jan-29 - Written - Henry Leung (University of Toronto)
     """
-    if isinstance(cat1, (str, pathlib.Path)):
-        cat1_ext = pathlib.Path(cat1).suffix
-        if cat1_ext.lower == ".h5":
-            cat1 = h5py.File(cat1, mode="r")
-        elif cat1_ext.lower == ".fits" or cat1_ext.lower == ".fit":
-            cat1 = fits.getdata(cat1)
-        else:
-            raise TypeError(f"Unsupported file type {cat1_ext}")
-
-    if isinstance(cat2, (str, pathlib.Path)):
-        cat2_ext = pathlib.Path(cat2).suffix
-        if cat2_ext.lower == ".h5":
-            cat2 = h5py.File(cat2, mode="r")
-        elif cat2_ext.lower == ".fits" or cat2_ext.lower == ".fit":
-            cat2 = fits.getdata(cat2)
-        else:
-            raise TypeError(f"Unsupported file type {cat2_ext}")
+    with _load_catalog(cat1) as cat1, _load_catalog(cat2) as cat2:
+        depoch = epoch2 - epoch1
+        ra2_shifted, dec2_shifted = _epoch_shift(
+            np.asarray(cat2[ra2]),
+            np.asarray(cat2[dec2]),
+            epoch1,
+            epoch2,
+            None if np.all(depoch == 0.0) else np.asarray(cat2[pmra2]),
+            None if np.all(depoch == 0.0) else np.asarray(cat2[pmdec2]),
+        )
 
-    depoch = epoch2 - epoch1
+        if field is not None:
+            try:  # check if the field actually exists in both cat1/cat2
+                cat1[field]
+                cat2[field]
+            except KeyError:  # python 2/3 format string
+                raise KeyError(f"'{field}' does not exist in both catalog")
 
-    if field is not None:
-        try:  # check if the field actually exists in both cat1/cat2
-            cat1[field]
-            cat2[field]
-        except KeyError:  # python 2/3 format string
-            raise KeyError(f"'{field}' does not exist in both catalog")
-
-        uniques = np.unique(cat1[field])
-
-        d2d = np.ones(len(cat1)) * -1.0
-        idx = np.zeros(len(cat1), dtype=int)
-
-        for unique in uniques:  # loop over the class
-            idx_1 = np.arange(cat1[ra1].shape[0])[cat1[field] == unique]
-            idx_2 = np.arange(cat2[ra2].shape[0])[cat2[field] == unique]
-            idx1, idx2, sep = xmatch(
-                cat1[ra1],
-                cat1[dec1],
-                cat2[ra2],
-                cat2[dec2],
-                epoch1=epoch1,
-                epoch2=epoch2,
-                pmra2=None if np.all(depoch == 0.0) else cat2[pmra2],
-                pmdec2=None if np.all(depoch == 0.0) else cat2[pmdec2],
+            idx1, idx2, sep = _xmatch_grouped(
+                np.asarray(cat1[ra1]),
+                np.asarray(cat1[dec1]),
+                np.asarray(cat1[field]),
+                ra2_shifted,
+                dec2_shifted,
+                np.asarray(cat2[field]),
                 maxdist=maxdist,
             )
 
-    else:
-        idx1, idx2, sep = xmatch(
-            cat1[ra1],
-            cat1[dec1],
-            cat2[ra2],
-            cat2[dec2],
-            epoch1=epoch1,
-            epoch2=epoch2,
-            pmra2=None if np.all(depoch == 0.0) else cat2[pmra2],
-            pmdec2=None if np.all(depoch == 0.0) else cat2[pmdec2],
-            maxdist=maxdist,
-        )
+        else:
+            idx1, idx2, sep = SkyIndex(ra2_shifted, dec2_shifted).match(
+                np.asarray(cat1[ra1]), np.asarray(cat1[dec1]), maxdist=maxdist
+            )
+
+        return idx1, idx2, sep
+
+
+def xmatch_stream(
+    cat1,
+    cat2,
+    output,
+    maxdist=2.0,
+    ra1="ra",
+    dec1="dec",
+    epoch1=2000.0,
+    ra2="ra",
+    dec2="dec",
+    epoch2=2000.0,
+    pmra2="pmra",
+    pmdec2="pmdec",
+    chunk_size=1048576,
+    cat2_chunk_size=None,
+    workers=1,
+):
+    """
+    Out-of-core cross-matching between two catalog files by RA/DEC coordiantes. Catalog 1 is read chunk by chunk
+    and matched to the index of catalog 2, matches are written to ``idx1``, ``idx2`` and ``sep`` (in degree) datasets
+    of a h5 file incrementally. Catalog 2 is also indexed block by block and the best match so far of every object in
+    catalog 1 is kept in temporary files on disk, so memory is bounded by the block size even if catalog 2 has hundreds
+    of millions of objects
+
+    :param cat1: Catalog 1, can be path to `.fits` or `.h5` or opened fits or h5 files
+    :type cat1: str
+    :param cat2: Catalog 2, can be path to `.fits` or `.h5` or opened fits or h5 files
+    :type cat2: str
+    :param output: path to the output h5 file
+    :type output: str
+    :param maxdist: Maximium distance in arcsecond
+    :type maxdist: float
+    :param ra1: Field for RA in Catalog 1
+    :type ra1: str
+    :param dec1: Field for DEC in Catalog 1
+    :type dec1: str
+    :param epoch1: Epoch for the first catalog
+    :type epoch1: float
+    :param ra2: Field for RA in Catalog 2
+    :type ra2: str
+    :param dec2: Field for DEC in Catalog 2
+    :type dec2: str
+    :param epoch2: Epoch for the second catalog
+    :type epoch2: float
+    :param pmra2: Field for RA proper motion in Catalog 2, only effective if `epoch1` not equals `epoch2`
+    :type pmra2: str
+    :param pmdec2: Field for DEC proper motion in Catalog 2, only effective if `epoch1` not equals `epoch2`
+    :type pmdec2: str
+    :param chunk_size: number of objects in catalog 1 read and matched at once
+    :type chunk_size: int
+    :param cat2_chunk_size: number of objects in catalog 2 indexed at once, None to use ``chunk_size``, -1 to index
+        the whole catalog 2 in memory at once
+    :type cat2_chunk_size: Union(int, NoneType)
+    :param workers: number of threads to query the index, -1 to use all CPUs
+    :type workers: int
+
+    :return: number of matches
+    :rtype: int
+    """
+    with _load_catalog(cat1) as cat1, _load_catalog(cat2) as cat2:
+        num_cat1 = cat1[ra1].shape[0]
+        num_cat2 = cat2[ra2].shape[0]
+        if cat2_chunk_size is None:
+            cat2_chunk_size = chunk_size
+        elif cat2_chunk_size == -1:
+            cat2_chunk_size = max(num_cat2, 1)
+        use_pm = np.any(epoch2 - epoch1 != 0.0)
+
+        def cat2_index(start):
+            stop = start + cat2_chunk_size
+            pmra2_chunk, pmdec2_chunk = None, None
+            if use_pm:
+                pmra2_chunk = np.asarray(cat2[pmra2][start:stop], dtype=np.float64)
+                pmdec2_chunk = np.asarray(cat2[pmdec2][start:stop], dtype=np.float64)
+            ra2_shifted, dec2_shifted = _epoch_shift(
+                np.asarray(cat2[ra2][start:stop], dtype=np.float64),
+                np.asarray(cat2[dec2][start:stop], dtype=np.float64),
+                epoch1,
+                epoch2,
+                pmra2_chunk,
+                pmdec2_chunk,
+            )
+            return SkyIndex(ra2_shifted, dec2_shifted)
+
+        def cat1_chunks():
+            for start in range(0, num_cat1, chunk_size):
+                yield start, cat1[ra1][start : start + chunk_size], cat1[dec1][
+                    start : start + chunk_size
+                ]
+
+        def match_chunk(index, ra, dec):
+            return index.match(
+                ra, dec, maxdist=maxdist, chunk_size=chunk_size, workers=workers
+            )
+
+        with h5py.File(output, "w") as F:
+            idx1_out, idx2_out, sep_out = (
+                F.create_dataset(
+                    name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True
+                )
+                for name, dtype in (
+                    ("idx1", np.int64),
+                    ("idx2", np.int64),
+                    ("sep", np.float64),
+                )
+            )
+            sep_out.attrs["unit"] = "deg"
+
+            if num_cat2 <= cat2_chunk_size:
+                index = cat2_index(0)
+                for start, ra, dec in cat1_chunks():
+                    m1, m2, sep = match_chunk(index, ra, dec)
+                    _h5_append(idx1_out, m1 + start)
+                    _h5_append(idx2_out, m2)
+                    _h5_append(sep_out, sep.deg)
+                return idx1_out.shape[0]
+
+            with tempfile.TemporaryDirectory(
+                dir=os.path.dirname(os.path.abspath(output))
+            ) as tempdir:
+                best_idx2 = np.lib.format.open_memmap(
+                    os.path.join(tempdir, "idx2.npy"),
+                    mode="w+",
+                    dtype=np.int64,
+                    shape=(num_cat1,),
+                )
+                best_sep = np.lib.format.open_memmap(
+                    os.path.join(tempdir, "sep.npy"),
+                    mode="w+",
+                    dtype=np.float64,
+                    shape=(num_cat1,),
+                )
+                best_idx2[:] = -1
+                best_sep[:] = np.inf
+
+                for cat2_start in range(0, num_cat2, cat2_chunk_size):
+                    index = cat2_index(cat2_start)
+                    for start, ra, dec in cat1_chunks():
+                        m1, m2, sep = match_chunk(index, ra, dec)
+                        m1 += start
+                        # earlier block wins on tie, the same as the nearest neighbour with the smallest index
+                        better = sep.deg < best_sep[m1]
+                        best_idx2[m1[better]] = m2[better] + cat2_start
+                        best_sep[m1[better]] = sep.deg[better]
 
-    return idx1, idx2, sep
+                for start in range(0, num_cat1, chunk_size):
+                    matched = np.flatnonzero(best_idx2[start : start + chunk_size] >= 0)
+                    _h5_append(idx1_out, matched + start)
+                    _h5_append(idx2_out, best_idx2[start : start + chunk_size][matched])
+                    _h5_append(sep_out, best_sep[start : start + chunk_size][matched])
+                del best_idx2, best_sep
+            return idx1_out.shape[0]
@@ -19,6 +19,7 @@ from astroNN.models.apogee_models import (
     ApokascEncoderDecoder,
     StarNet2017,
 )
+from astroNN.models.base_bayesian_cnn import BayesianCNNBase
 from astroNN.models.misc_models import Cifar10CNN, MNIST_BCNN
 from astroNN.nn.losses import losses_lookup
 from astroNN.nn.utilities import Normalizer
@@ -431,6 +432,9 @@ def load_folder(folder=None):
     astronn_model_obj.input_normalizer.std_labels = astronn_model_obj.input_std
     astronn_model_obj.labels_normalizer.mean_labels = astronn_model_obj.labels_mean
     astronn_model_obj.labels_normalizer.std_labels = astronn_model_obj.labels_std
+    if isinstance(astronn_model_obj, BayesianCNNBase):
+        # so the first prediction does not need to build the model for Monte Carlo inference
+        astronn_model_obj._warm_up_mc_inference()
     print("========================================================")
     print(f"Loaded astroNN model, model type: {astronn_model_obj.name} -> {identifier}")
     print("========================================================")
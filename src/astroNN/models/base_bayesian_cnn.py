@@ -3,7 +3,9 @@ import os
 import time
 import warnings
 from abc import ABC
+from contextlib import nullcontext
 
+import h5py
 import numpy as np
 from tqdm import tqdm
 import keras
@@ -40,6 +42,59 @@ ReduceLROnPlateau = keras.callbacks.ReduceLROnPlateau
 Adam = keras.optimizers.Adam
 
 
+def _zeros_error(shape):
+    """
+    Zero error for data without known error, broadcasted from a single row without allocating memory for the full shape
+
+    :param shape: shape of the data
+    :type shape: tuple
+    :return: read-only zeros
+    :rtype: ndarray
+    """
+    return np.broadcast_to(np.zeros(shape[1:], dtype=np.float32), shape)
+
+
+def _scale_error(err, std, out=None):
+    """
+    Scale known error by the standard deviation of the data, broadcasted error (e.g. from _zeros_error) stays
+    broadcasted without allocating memory for the full shape
+
+    :param err: error
+    :type err: ndarray
+    :param std: standard deviation of the data
+    :type std: Union(float, ndarray)
+    :param out: output float32 array for error which is not broadcasted, None to allocate a new one
+    :type out: Union(NoneType, ndarray)
+    :return: scaled error
+    :rtype: ndarray
+    """
+    err = np.asarray(err)
+    if err.ndim > 0 and err.strides[0] == 0:
+        return np.broadcast_to(np.divide(err[0], std, dtype=np.float32), err.shape)
+    if out is None:
+        out = np.empty(err.shape, dtype=np.float32)
+    return np.divide(err, std, out=out.reshape(err.shape))
+
+
+def _iter_chunks(data, chunk_size):
+    """
+    Iterate over data chunk by chunk, only one chunk is read into memory at a time
+
+    :param data: indexable array (e.g. h5py dataset or memory-mapped ndarray) or iterable of ndarray chunks
+    :type data: Union([h5py.Dataset, ndarray, iterable])
+    :param chunk_size: number of data in a chunk if data is indexable array
+    :type chunk_size: int
+    :return: chunks of at least 2D ndarray
+    :rtype: generator
+    """
+    if hasattr(data, "shape") and hasattr(data, "__getitem__"):
+        for i in range(0, data.shape[0], chunk_size):
+            yield np.atleast_2d(data[i : i + chunk_size])
+    else:
+        for chunk in data:
+            yield np.atleast_2d(chunk)
+
+
 class BayesianCNNDataGenerator(GeneratorBase):
     """
     To generate data to NN
@@ -52,6 +107,7 @@ class BayesianCNNDataGenerator(GeneratorBase):
     :type data: list
     :param sample_weight: Sample weights (if any)
     :type sample_weight: Union([NoneType, ndarray])
+    :param kwargs: ``index``, ``shuffle_block_size``, ``reuse_buffer``, ``workers``, ``use_multiprocessing`` and ``max_queue_size`` of GeneratorBase
     :History:
         | 2017-Dec-02 - Written - Henry Leung (University of Toronto)
         | 2019-Feb-17 - Updated - Henry Leung (University of Toronto)
@@ -64,12 +120,14 @@ class BayesianCNNDataGenerator(GeneratorBase):
         steps_per_epoch,
         data,
         sample_weight=None,
+        **kwargs,
     ):
         super().__init__(
             data=data,
             batch_size=batch_size,
             shuffle=shuffle,
             steps_per_epoch=steps_per_epoch,
+            **kwargs,
         )
         self.inputs = self.data[0]
         self.labels = self.data[1]
@@ -77,18 +135,23 @@ class BayesianCNNDataGenerator(GeneratorBase):
 
         # initial idx
         self.idx_list = self._get_exploration_order(
-            range(self.inputs["input"].shape[0])
+            self._get_rows(self.inputs["input"].shape[0])
         )
 
     def _data_generation(self, idx_list_temp):
-        x = self.get_idx_item(self.inputs, idx_list_temp)
+        slot = self.acquire_slot()
+        x = self.get_idx_item(self.inputs, idx_list_temp, slot=slot, name="inputs")
         if "labels_err" in x.keys():
             x.update({"labels_err": np.squeeze(x["labels_err"])})
-        y = {}
-        for name in self.labels.keys():
-            y.update({name: self.labels[name][idx_list_temp]})
+        y = self.get_idx_item(self.labels, idx_list_temp, slot=slot, name="labels")
         if self.sample_weight is not None:
-            return x, y, self.sample_weight[idx_list_temp]
+            return (
+                x,
+                y,
+                self.get_idx_item(
+                    self.sample_weight, idx_list_temp, slot=slot, name="sample_weight"
+                ),
+            )
         else:
             return x, y
 
@@ -100,63 +163,7 @@ class BayesianCNNDataGenerator(GeneratorBase):
     def on_epoch_end(self):
         # shuffle the list when epoch ends for the next epoch
         self.idx_list = self._get_exploration_order(
-            range(self.inputs["input"].shape[0])
-        )
-
-
-class BayesianCNNPredDataGenerator(GeneratorBase):
-    """
-    To generate data to NN for prediction
-
-    :param batch_size: batch size
-    :type batch_size: int
-    :param shuffle: Whether to shuffle batches or not
-    :type shuffle: bool
-    :param data: List of data to NN
-    :type data: list
-    :param pbar: tqdm progress bar
-    :type pbar: obj
-    :History:
-        | 2017-Dec-02 - Written - Henry Leung (University of Toronto)
-        | 2019-Feb-17 - Updated - Henry Leung (University of Toronto)
-    """
-
-    def __init__(
-        self, batch_size, shuffle, steps_per_epoch, data, pbar=None
-    ):
-        super().__init__(
-            data=data,
-            batch_size=batch_size,
-            shuffle=shuffle,
-            steps_per_epoch=steps_per_epoch,
-        )
-        self.inputs = self.data[0]
-        self.pbar = pbar
-
-        # initial idx
-        self.idx_list = self._get_exploration_order(
-            range(self.inputs[list(self.inputs.keys())[0]].shape[0])
-        )
-        self.current_idx = -1
-
-    def _data_generation(self, idx_list_temp):
-        # Generate data
-        x = self.get_idx_item(self.inputs, idx_list_temp)
-        return x
-
-    def __getitem__(self, index):
-        x = self._data_generation(
-            self.idx_list[index * self.batch_size : (index + 1) * self.batch_size]
-        )
-        if self.pbar and index > self.current_idx:
-            self.pbar.update(self.batch_size)
-        self.current_idx = index
-        return x
-
-    def on_epoch_end(self):
-        # shuffle the list when epoch ends for the next epoch
-        self.idx_list = self._get_exploration_order(
-            range(self.inputs[list(self.inputs.keys())[0]].shape[0])
+            self._get_rows(self.inputs["input"].shape[0])
         )
 
 
@@ -196,9 +203,21 @@ class BayesianCNNBase(NeuralNetBase, ABC):
         self.labels_norm_mode = 2
 
         self.keras_model_predict = None
+        # FastMCInference transformed model cached with the mc_num and keras_model_predict it is built from
+        self._mc_inference_cache = None
 
     def pre_training_checklist_child(self, input_data, labels, sample_weight):
+        """
+        Normalize data and labels, compile the model if needed and set up the training and validation generators
+        over the same normalized data, the two sets are split by the index arrays ``train_idx`` and ``val_idx``
+
+        :return: normalized data (with ``input_err`` and ``labels_err`` scaled by the standard deviation) and
+            labels of both training and validation set
+        :rtype: dict, dict
+        """
         input_data, labels = self.pre_training_checklist_master(input_data, labels)
+        # errors are not normalized but only scaled by the standard deviation of data and labels
+        errors = {name: input_data.pop(name) for name in ["input_err", "labels_err"]}
 
         # check if exists (existing means the model has already been trained (e.g. fine-tuning), so we do not need calculate mean/std again)
         if self.input_normalizer is None:
@@ -209,27 +228,36 @@ class BayesianCNNBase(NeuralNetBase, ABC):
                 mode=self.labels_norm_mode, verbose=self.verbose
             )
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            norm_data = self._normalize_training_data(self.input_normalizer, input_data)
             self.input_mean, self.input_std = (
                 self.input_normalizer.mean_labels,
                 self.input_normalizer.std_labels,
             )
-            norm_labels = self.labels_normalizer.normalize(labels)
+            norm_labels = self._normalize_training_data(self.labels_normalizer, labels)
             self.labels_mean, self.labels_std = (
                 self.labels_normalizer.mean_labels,
                 self.labels_normalizer.std_labels,
             )
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
-            norm_labels = self.labels_normalizer.normalize(labels, calc=False)
+            norm_data = self._normalize_training_data(
+                self.input_normalizer, input_data, calc=False
+            )
+            norm_labels = self._normalize_training_data(
+                self.labels_normalizer, labels, calc=False
+            )
 
         # No need to care about Magic number as loss function looks for magic num in y_true only
-        norm_data.update(
-            {
-                "input_err": (input_data["input_err"] / self.input_std["input"]).astype(np.float32),
-                "labels_err": (input_data["labels_err"] / self.labels_std["output"]).astype(np.float32),
-            }
-        )
+        # absent errors are broadcasted zeros, so nothing of the full data size is allocated for them
+        for name, std in [
+            ("input_err", self.input_std["input"]),
+            ("labels_err", self.labels_std["output"]),
+        ]:
+            err = errors[name]
+            norm_data[name] = _scale_error(
+                err,
+                std,
+                out=self._training_array(err.shape) if err.strides[0] != 0 else None,
+            )
         norm_labels.update({"variance_output": norm_labels["output"]})
 
         if (
@@ -237,43 +265,32 @@ class BayesianCNNBase(NeuralNetBase, ABC):
         ):  # only compile if there is no keras_model, e.g. fine-tuning does not required
             self.compile()
 
+        # training and validation set are kept as sorted index arrays of the same data, rows are gathered by generators
         if self.has_val:
-            self.train_idx, self.val_idx = train_test_split(
-                np.arange(self.num_train + self.val_num), test_size=self.val_size
+            self.train_idx, self.val_idx = (
+                np.sort(idx)
+                for idx in train_test_split(
+                    np.arange(self.num_train + self.val_num), test_size=self.val_size
+                )
             )
         else:
             self.train_idx = np.arange(self.num_train + self.val_num)
             # just dummy, to minimize modification needed
             self.val_idx = np.arange(self.num_train + self.val_num)[:2]
 
-        norm_data_training = {}
-        norm_data_val = {}
-        norm_labels_training = {}
-        norm_labels_val = {}
-        for name in norm_data.keys():
-            norm_data_training.update({name: norm_data[name][self.train_idx]})
-            norm_data_val.update({name: norm_data[name][self.val_idx]})
-        for name in norm_labels.keys():
-            norm_labels_training.update({name: norm_labels[name][self.train_idx]})
-            norm_labels_val.update({name: norm_labels[name][self.val_idx]})
-
-        if sample_weight is not None:
-            sample_weight_training = sample_weight[self.train_idx]
-            sample_weight_val = sample_weight[self.val_idx]
-        else:
-            sample_weight_training = None
-            sample_weight_val = None
-
         self.inv_model_precision = (2 * self.num_train * self.l2) / (
             self.length_scale**2 * (1 - self.dropout_rate)
         )
 
         self.training_generator = BayesianCNNDataGenerator(
-            data=[norm_data_training, norm_labels_training],
+            data=[norm_data, norm_labels],
             batch_size=self.batch_size,
             shuffle=True,
             steps_per_epoch=self.num_train // self.batch_size,
-            sample_weight=sample_weight_training,
+            sample_weight=sample_weight,
+            index=self.train_idx,
+            shuffle_block_size=self.shuffle_block_size,
+            reuse_buffer=True,
         )
 
         if self.has_val:
@@ -283,21 +300,16 @@ class BayesianCNNBase(NeuralNetBase, ABC):
                 else len(self.val_idx)
             )
             self.validation_generator = BayesianCNNDataGenerator(
-                data=[norm_data_val, norm_labels_val],
+                data=[norm_data, norm_labels],
                 batch_size=val_batchsize,
                 shuffle=False,
                 steps_per_epoch=max(self.val_num // self.batch_size, 1),
-                sample_weight=sample_weight_val,
+                sample_weight=sample_weight,
+                index=self.val_idx,
+                reuse_buffer=True,
             )
 
-        return (
-            norm_data_training,
-            norm_data_val,
-            norm_labels_training,
-            norm_labels_val,
-            sample_weight_training,
-            sample_weight_val,
-        )
+        return norm_data, norm_labels
 
     def compile(
         self,
@@ -533,6 +545,9 @@ class BayesianCNNBase(NeuralNetBase, ABC):
         inputs_err=None,
         labels_err=None,
         sample_weight=None,
+        workers=1,
+        use_multiprocessing=None,
+        max_queue_size=10,
     ):
         """
         Train a Bayesian neural network
@@ -547,17 +562,24 @@ class BayesianCNNBase(NeuralNetBase, ABC):
         :type labels_err: Union([NoneType, ndarray])
         :param sample_weight: Sample weights (if any)
         :type sample_weight: Union([NoneType, ndarray])
+        :param workers: Number of threads or processes to prefetch batches, 1 to generate batches in the main thread
+        :type workers: int
+        :param use_multiprocessing: Use processes instead of threads to prefetch batches, None to use ``Multiprocessing_Generator`` in astroNN configuration file
+        :type use_multiprocessing: Union([NoneType, bool])
+        :param max_queue_size: Maximum number of batches prefetched
+        :type max_queue_size: int
         :return: None
         :rtype: NoneType
         :History:
             | 2018-Jan-06 - Written - Henry Leung (University of Toronto)
             | 2018-Apr-12 - Updated - Henry Leung (University of Toronto)
         """
+        # zeros without allocating memory if no error
         if inputs_err is None:
-            inputs_err = np.zeros_like(input_data)
+            inputs_err = _zeros_error(np.shape(input_data))
 
         if labels_err is None:
-            labels_err = np.zeros_like(labels)
+            labels_err = _zeros_error(np.shape(labels))
 
         # TODO: allow named inputs too??
         input_data = {
@@ -568,16 +590,12 @@ class BayesianCNNBase(NeuralNetBase, ABC):
         labels = {"output": labels, "variance_output": labels}
 
         # Call the checklist to create astroNN folder and save parameters
-        (
-            norm_data_training,
-            norm_data_val,
-            norm_labels_training,
-            norm_labels_val,
-            sample_weight_training,
-            sample_weight_val,
-        ) = self.pre_training_checklist_child(input_data, labels, sample_weight)
-
-        # norm_data_training['labels_err'] = norm_data_training['labels_err'].filled(MAGIC_NUMBER).astype(np.float32)
+        self.pre_training_checklist_child(input_data, labels, sample_weight)
+        self._setup_generator_prefetch(
+            workers=workers,
+            use_multiprocessing=use_multiprocessing,
+            max_queue_size=max_queue_size,
+        )
 
         # TODO: fix the monitor name
         reduce_lr = ReduceLROnPlateau(
@@ -638,22 +656,18 @@ class BayesianCNNBase(NeuralNetBase, ABC):
         :type sample_weight: Union([NoneType, ndarray])
         :return: None
         :rtype: NoneType
-        :History:
-            | 2018-Aug-25 - Written - Henry Leung (University of Toronto)
+        :History: 2018-Aug-25 - Written - Henry Leung (University of Toronto)
         """
         self.has_model_check()
 
+        # zeros without allocating memory if no error
         if inputs_err is None:
-            inputs_err = np.zeros_like(input_data)
+            inputs_err = _zeros_error(np.shape(input_data))
 
         if labels_err is None:
-            labels_err = np.zeros_like(labels)
+            labels_err = _zeros_error(np.shape(labels))
 
-        input_data = {
-            "input": input_data,
-            "input_err": inputs_err,
-            "labels_err": labels_err,
-        }
+        input_data = {"input": input_data}
         labels = {"output": labels, "variance_output": labels}
 
         # check if exists (existing means the model has already been trained (e.g. fine-tuning), so we do not need calculate mean/std again)
@@ -682,8 +696,8 @@ class BayesianCNNBase(NeuralNetBase, ABC):
         # No need to care about Magic number as loss function looks for magic num in y_true only
         norm_data.update(
             {
-                "input_err": (input_data["input_err"] / self.input_std["input"]).astype(np.float32),
-                "labels_err": (input_data["labels_err"] / self.labels_std["output"]).astype(np.float32),
+                "input_err": _scale_error(inputs_err, self.input_std["input"]),
+                "labels_err": _scale_error(labels_err, self.labels_std["output"]),
             }
         )
         norm_labels.update({"variance_output": norm_labels["output"]})
@@ -775,91 +789,109 @@ class BayesianCNNBase(NeuralNetBase, ABC):
         if self.mc_num < 2:
             raise AttributeError("mc_num cannot be smaller than 2")
 
-        # if no error array then just zeros
-        if inputs_err is None:
-            inputs_err = np.zeros_like(input_data)
-        else:
-            inputs_err = np.atleast_2d(inputs_err)
-            inputs_err /= self.input_std["input"]
-
-        # TODO: better way to handle named input
-        if "input_err" in [i.name for i in self.keras_model.inputs]:
-            input_data = {"input": input_data, "input_err": inputs_err}
-        else:
-            input_data = {"input": input_data}
-        input_data = self.pre_testing_checklist_master(input_data)
-
-        if self.input_normalizer is not None:
-            input_array = self.input_normalizer.normalize(input_data, calc=False)
-        else:
-            # Prevent shallow copy issue
-            input_array = np.array(input_data)
-            input_array -= self.input_mean["input"]
-            input_array /= self.input_std["input"]
+        input_data = self.pre_testing_checklist_master({"input": input_data})
+        input_array = self._normalize_prediction_input(input_data["input"], inputs_err)
 
         total_test_num = input_data["input"].shape[0]  # Number of testing data
 
         if batch_size is None:
             batch_size = self.batch_size
 
-        # for number of training data smaller than batch_size
-        batch_size = np.min([total_test_num, batch_size])
-
-        # Due to the nature of how generator works, no overlapped prediction
-        data_gen_shape = (total_test_num // batch_size) * batch_size
-        remainder_shape = total_test_num - data_gen_shape  # Remainder from generator
-
-        norm_data_main = {}
-        norm_data_remainder = {}
-        for name in input_array.keys():
-            norm_data_main.update({name: input_array[name][:data_gen_shape]})
-            norm_data_remainder.update({name: input_array[name][data_gen_shape:]})
-
-        # Data Generator for prediction
         with tqdm(total=total_test_num, unit="sample") as pbar:
             pbar.set_postfix({"Monte-Carlo": self.mc_num})
             pbar.set_description_str("Prediction progress: ")
-
-            prediction_generator = BayesianCNNPredDataGenerator(
-                batch_size=batch_size,
-                shuffle=False,
-                steps_per_epoch=data_gen_shape // batch_size,
-                data=[norm_data_main],
-                pbar=pbar,
+            result = self._predict_on_batches(
+                self._mc_inference_model(), input_array, batch_size, pbar=pbar
             )
 
-            new = FastMCInference(self.mc_num, self.keras_model_predict).transformed_model
+        if not isinstance(result, dict):
+            raise TypeError("The output of the model must be a dictionary")
 
-            result = new.predict(prediction_generator, verbose=0)
+        return self._mc_prediction(result)
 
-            if not isinstance(result, dict):
-                raise TypeError("The output of the model must be a dictionary")
+    def _mc_inference_model(self):
+        """
+        Get FastMCInference transformed model of keras_model_predict for prediction. The model is cached so it and
+        its predict function are only built once and every batch shape is only traced once by the backend across
+        prediction calls. Weights are shared with keras_model_predict so weights updated by training or loading are
+        used directly, the model is only rebuilt if mc_num changed or keras_model_predict is replaced
 
-            if remainder_shape != 0:  # deal with remainder
-                remainder_generator = BayesianCNNPredDataGenerator(
-                    batch_size=remainder_shape,
-                    shuffle=False,
-                    steps_per_epoch=1,
-                    data=[norm_data_remainder],
-                )
-                pbar.update(remainder_shape)
-                remainder_result = new.predict(remainder_generator, verbose=0)
+        :return: FastMCInference transformed model
+        :rtype: keras.Model
+        """
+        if (
+            self._mc_inference_cache is None
+            or self._mc_inference_cache[0] != self.mc_num
+            or self._mc_inference_cache[1] is not self.keras_model_predict
+        ):
+            mc_model = FastMCInference(self.mc_num, self.keras_model_predict)
+            self._mc_inference_cache = (
+                self.mc_num,
+                self.keras_model_predict,
+                mc_model.transformed_model,
+            )
+        return self._mc_inference_cache[2]
 
-                # if it is a dict, then concatenate the values of the dict
-                if isinstance(result, dict):
-                    for key in result.keys():
-                        result[key] = np.concatenate(
-                            (result[key], remainder_result[key])
-                        )
+    def _warm_up_mc_inference(self, batch_size=None):
+        """
+        Build FastMCInference transformed model and its predict function by inferring a batch of zeros so the first
+        prediction call does not pay for it
 
-                # if remainder_shape == 1:
-                #     remainder_result = np.expand_dims(remainder_result, axis=0)
-                # result = np.concatenate((result, remainder_result))
+        :param batch_size: batch size to be warmed up, None to use the one of the model
+        :type batch_size: Union([NoneType, int])
+        """
+        self.has_model_check()
+        if batch_size is None:
+            batch_size = self.batch_size
+        # shape of data given to predict(), which do not have the trailing channel dimension added for the model
+        input_shape = tuple(self._input_shape["input"])
+        if len(input_shape) > 1 and input_shape[-1] == 1:
+            input_shape = input_shape[:-1]
+        self._mc_inference_model().predict_on_batch(
+            self._normalize_prediction_input(
+                np.zeros((batch_size,) + input_shape, dtype=np.float32)
+            )
+        )
 
-        # # in case only 1 test data point, in such case we need to add a dimension
-        # if result.ndim < 3 and batch_size == 1:
-        #     result = np.expand_dims(result, axis=0)
+    def _normalize_prediction_input(self, input_data, inputs_err=None):
+        """
+        Normalize input data (and its error if the model takes error) for prediction
 
+        :param input_data: Data to be inferred with neural network
+        :type input_data: ndarray
+        :param inputs_err: Error for input_data, same shape with input_data.
+        :type inputs_err: Union([NoneType, ndarray])
+        :return: normalized input data
+        :rtype: dict
+        """
+        if self.input_normalizer is not None:
+            input_array = self.input_normalizer.normalize(
+                {"input": input_data}, calc=False
+            )
+        else:
+            # Prevent shallow copy issue
+            input_array = {"input": np.array(input_data)}
+            input_array["input"] -= self.input_mean["input"]
+            input_array["input"] /= self.input_std["input"]
+
+        # TODO: better way to handle named input
+        # error is only scaled by the standard deviation of data as in training, zeros without allocating memory if no error
+        if "input_err" in [i.name for i in self.keras_model.inputs]:
+            if inputs_err is None:
+                inputs_err = _zeros_error(input_data.shape)
+            input_array["input_err"] = _scale_error(
+                np.atleast_2d(inputs_err), self.input_std["input"]
+            )
+        return input_array
+
+    def _mc_prediction(self, result):
+        """
+        Turn the output of Monte Carlo dropout inference to denormalized prediction and prediction uncertainty
+
+        :param result: output of FastMCInference transformed model
+        :type result: dict
+        :return: prediction and prediction uncertainty
+        """
         predictions = result["output"][:, :, 0]  # mean prediction
         mc_dropout_uncertainty = result["output"][:, :, 1] * (
             self.labels_std["output"] ** 2
@@ -924,168 +956,93 @@ class BayesianCNNBase(NeuralNetBase, ABC):
             "predictive": predictive_uncertainty,
         }
 
-    def predict_dataset(self, file):
-        class BayesianCNNPredDataGeneratorV2(GeneratorBase):
-            def __init__(
-                self,
-                batch_size,
-                shuffle,
-                steps_per_epoch,
-                pbar=None,
-                nn_model=None,
-            ):
-                super().__init__(
-                    batch_size=batch_size,
-                    shuffle=shuffle,
-                    steps_per_epoch=steps_per_epoch,
-                    data=None,
-                )
-                self.pbar = pbar
-
-                # initial idx
-                self.idx_list = self._get_exploration_order(range(len(file)))
-                self.current_idx = 0
-                self.nn_model = nn_model
-
-            def _data_generation(self, idx_list_temp):
-                # Generate data
-                inputs = self.nn_model.input_normalizer.normalize(
-                    {
-                        "input": file[idx_list_temp],
-                        "input_err": np.zeros_like(file[idx_list_temp]),
-                    },
-                    calc=False,
-                )
-                x = self.get_idx_item(inputs, np.arange(len(idx_list_temp)))
-                return x
-
-            def __getitem__(self, index):
-                x = self._data_generation(
-                    self.idx_list[
-                        index * self.batch_size : (index + 1) * self.batch_size
-                    ]
-                )
-                if self.pbar:
-                    self.pbar.update(self.batch_size)
-                return x
-
-            def on_epoch_end(self):
-                # shuffle the list when epoch ends for the next epoch
-                self.idx_list = self._get_exploration_order(range(len(file)))
-
+    def predict_dataset(
+        self, file, output=None, inputs_err=None, batch_size=None, chunk_size=65536
+    ):
+        """
+        Test model chunk by chunk with bounded memory, for data which do not fit in memory like a large catalog.
+        Only one chunk of data is read, normalized and inferred at a time, and prediction can be written to a file
+        incrementally
+
+        :param file: Data to be inferred with neural network, indexable array read by chunk (e.g. h5py dataset or
+            memory-mapped ndarray) or iterable of ndarray chunks (e.g. generator)
+        :type file: Union([h5py.Dataset, ndarray, iterable])
+        :param output: HDF5 file path to write prediction to datasets "prediction", "total", "model" and "predictive"
+            incrementally, None to return them
+        :type output: Union([NoneType, str, pathlib.Path])
+        :param inputs_err: Error for file in the same form as file, only used if model takes error
+        :type inputs_err: Union([NoneType, h5py.Dataset, ndarray, iterable])
+        :param batch_size: batch size, None to use the one of the model
+        :type batch_size: Union([NoneType, int])
+        :param chunk_size: number of data read at a time from indexable array
+        :type chunk_size: int
+        :return: prediction and prediction uncertainty if output is None, otherwise number of data inferred
+        :History: 2018-Jan-06 - Written - Henry Leung (University of Toronto)
+        """
         self.has_model_check()
 
         if self.mc_num < 2:
             raise AttributeError("mc_num cannot be smaller than 2")
 
-        total_test_num = len(file)  # Number of testing data
-
-        # for number of training data smaller than batch_size
-        if total_test_num < self.batch_size:
-            batch_size = total_test_num
-        else:
+        if batch_size is None:
             batch_size = self.batch_size
 
-        # Due to the nature of how generator works, no overlapped prediction
-        data_gen_shape = (total_test_num // batch_size) * batch_size
-        remainder_shape = total_test_num - data_gen_shape  # Remainder from generator
-
-        # Data Generator for prediction
-        with tqdm(total=total_test_num, unit="sample") as pbar:
-            pbar.set_postfix({"Monte-Carlo": self.mc_num})
-            prediction_generator = BayesianCNNPredDataGeneratorV2(
-                batch_size=batch_size,
-                shuffle=False,
-                steps_per_epoch=data_gen_shape // batch_size,
-                pbar=pbar,
-                nn_model=self,
-            )
-            new = FastMCInference(self.mc_num, self.keras_model_predict).transformed_model
-            result = np.asarray(new.predict(prediction_generator))
-
-            if remainder_shape != 0:  # deal with remainder
-                remainder_generator = BayesianCNNPredDataGeneratorV2(
-                    batch_size=remainder_shape,
-                    shuffle=False,
-                    steps_per_epoch=1,
-                    pbar=pbar,
-                    nn_model=self,
-                )
-                remainder_result = np.asarray(new.predict(remainder_generator))
-                if remainder_shape == 1:
-                    remainder_result = np.expand_dims(remainder_result, axis=0)
-                result = np.concatenate((result, remainder_result))
-
-        # in case only 1 test data point, in such case we need to add a dimension
-        if result.ndim < 3 and batch_size == 1:
-            result = np.expand_dims(result, axis=0)
-
-        half_first_dim = (
-            result.shape[1] // 2
-        )  # result.shape[1] is guarantee an even number, otherwise sth is wrong
-
-        predictions = result[:, :half_first_dim, 0]  # mean prediction
-        mc_dropout_uncertainty = result[:, :half_first_dim, 1] * (
-            self.labels_std["output"] ** 2
-        )  # model uncertainty
-        predictions_var = np.exp(result[:, half_first_dim:, 0]) * (
-            self.labels_std["output"] ** 2
-        )  # predictive uncertainty
-
-        if self.labels_normalizer is not None:
-            predictions = self.labels_normalizer.denormalize(
-                list_to_dict([self.keras_model.output_names[0]], predictions)
-            )
-            predictions = predictions["output"]
+        if inputs_err is None:
+            chunks = ((chunk, None) for chunk in _iter_chunks(file, chunk_size))
         else:
-            predictions *= self.labels_std["output"]
-            predictions += self.labels_mean["output"]
-
-        if self.task == "regression":
-            # Predictive variance
-            pred_var = (
-                predictions_var + mc_dropout_uncertainty
-            )  # epistemic plus aleatoric uncertainty
-            pred_uncertainty = np.sqrt(pred_var)  # Convert back to std error
-
-            # final correction from variance to standard derivation
-            mc_dropout_uncertainty = np.sqrt(mc_dropout_uncertainty)
-            predictive_uncertainty = np.sqrt(predictions_var)
-
-        elif self.task == "classification":
-            # we want entropy for classification uncertainty
-            predicted_class = np.argmax(predictions, axis=1)
-            mc_dropout_uncertainty = np.ones_like(predicted_class, dtype=float)
-            predictive_uncertainty = np.ones_like(predicted_class, dtype=float)
-
-            # center variance
-            predictions_var -= 1.0
-            for i in range(predicted_class.shape[0]):
-                all_prediction = np.array(predictions[i, :])
-                mc_dropout_uncertainty[i] = -np.sum(
-                    all_prediction * np.log(all_prediction)
+            # data and error must have the same number of chunks
+            chunks = zip(
+                _iter_chunks(file, chunk_size),
+                _iter_chunks(inputs_err, chunk_size),
+                strict=True,
+            )
+        new = self._mc_inference_model()
+
+        total_test_num = 0
+        results = []
+        # number of data is unknown for iterable of chunks
+        expected_num = file.shape[0] if hasattr(file, "shape") else None
+        output_file = h5py.File(output, "w") if output is not None else nullcontext()
+        with output_file as f, tqdm(total=expected_num, unit="sample") as pbar:
+            pbar.set_postfix({"Monte-Carlo": self.mc_num})
+            pbar.set_description_str("Prediction progress: ")
+            for chunk, err_chunk in chunks:
+                if err_chunk is not None and err_chunk.shape != chunk.shape:
+                    raise ValueError(
+                        f"Chunk of inputs_err with shape {err_chunk.shape} does not "
+                        f"match chunk of data with shape {chunk.shape}"
+                    )
+                input_array = self._normalize_prediction_input(chunk, err_chunk)
+                chunk_num = chunk.shape[0]
+                predictions, uncertainty = self._mc_prediction(
+                    self._predict_on_batches(new, input_array, batch_size)
                 )
-                predictive_uncertainty[i] = predictions_var[i, predicted_class[i]]
-
-            pred_uncertainty = mc_dropout_uncertainty + predictive_uncertainty
-            # We only want the predicted class back
-            predictions = predicted_class
-
-        elif self.task == "binary_classification":
-            # we want entropy for classification uncertainty, so need prediction in logits space
-            mc_dropout_uncertainty = -np.sum(predictions * np.log(predictions), axis=0)
-            # need to activate before round to int so that the prediction is always 0 or 1
-            predictions = np.rint(sigmoid(predictions))
-            predictive_uncertainty = predictions_var
-            pred_uncertainty = mc_dropout_uncertainty + predictions_var
-
-        else:
-            raise AttributeError("Unknown Task")
-
-        return predictions, {
-            "total": pred_uncertainty,
-            "model": mc_dropout_uncertainty,
-            "predictive": predictive_uncertainty,
+                if f is None:
+                    results.append((predictions, uncertainty))
+                else:
+                    # datasets are resizable so data of unknown length can be written chunk by chunk
+                    outputs = {"prediction": predictions, **uncertainty}
+                    for name, value in outputs.items():
+                        if name not in f:
+                            f.create_dataset(
+                                name,
+                                shape=(0,) + value.shape[1:],
+                                maxshape=(None,) + value.shape[1:],
+                                dtype=value.dtype,
+                                chunks=(min(chunk_num, batch_size),) + value.shape[1:],
+                            )
+                        f[name].resize(total_test_num + chunk_num, axis=0)
+                        f[name][total_test_num:] = value
+                total_test_num += chunk_num
+                pbar.update(chunk_num)
+
+        if output is not None:
+            return total_test_num
+        if len(results) == 0:
+            raise ValueError("No data to be inferred")
+        return np.concatenate([i[0] for i in results]), {
+            key: np.concatenate([i[1][key] for i in results])
+            for key in results[0][1].keys()
         }
 
     def evaluate(
@@ -1108,11 +1065,12 @@ class BayesianCNNBase(NeuralNetBase, ABC):
         """
         self.has_model_check()
 
+        # zeros without allocating memory if no error
         if inputs_err is None:
-            inputs_err = np.zeros_like(input_data)
+            inputs_err = _zeros_error(np.shape(input_data))
 
         if labels_err is None:
-            labels_err = np.zeros_like(labels)
+            labels_err = _zeros_error(np.shape(labels))
 
         input_data = {"input": input_data}
         labels = {"output": labels}
@@ -1141,8 +1099,8 @@ class BayesianCNNBase(NeuralNetBase, ABC):
             norm_labels = self.labels_normalizer.normalize(labels, calc=False)
 
         # No need to care about Magic number as loss function looks for magic num in y_true only
-        norm_input_err = inputs_err / self.input_std["input"]
-        norm_labels_err = labels_err / self.labels_std["output"]
+        norm_input_err = _scale_error(inputs_err, self.input_std["input"])
+        norm_labels_err = _scale_error(labels_err, self.labels_std["output"])
 
         if "input_err" in [i.name for i in self.keras_model.inputs]:
             norm_data.update(
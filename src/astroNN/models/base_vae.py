@@ -36,6 +36,7 @@ class CVAEDataGenerator(GeneratorBase):
     :type data: list
     :param sample_weight: Sample weights (if any)
     :type sample_weight: Union([NoneType, ndarray])
+    :param kwargs: ``index``, ``shuffle_block_size``, ``reuse_buffer``, ``workers``, ``use_multiprocessing`` and ``max_queue_size`` of GeneratorBase
     :History:
         | 2017-Dec-02 - Written - Henry Leung (University of Toronto)
         | 2019-Feb-17 - Updated - Henry Leung (University of Toronto)
@@ -48,12 +49,14 @@ class CVAEDataGenerator(GeneratorBase):
         steps_per_epoch,
         data,
         sample_weight=None,
+        **kwargs,
     ):
         super().__init__(
             data=data,
             batch_size=batch_size,
             shuffle=shuffle,
             steps_per_epoch=steps_per_epoch,
+            **kwargs,
         )
         self.inputs = self.data[0]
         self.recon_inputs = self.data[1]
@@ -61,14 +64,23 @@ class CVAEDataGenerator(GeneratorBase):
 
         # initial idx
         self.idx_list = self._get_exploration_order(
-            range(self.inputs["input"].shape[0])
+            self._get_rows(self.inputs["input"].shape[0])
         )
 
     def _data_generation(self, idx_list_temp):
-        x = self.get_idx_item(self.inputs, idx_list_temp)
-        y = self.get_idx_item(self.recon_inputs, idx_list_temp)
+        slot = self.acquire_slot()
+        x = self.get_idx_item(self.inputs, idx_list_temp, slot=slot, name="inputs")
+        y = self.get_idx_item(
+            self.recon_inputs, idx_list_temp, slot=slot, name="recon_inputs"
+        )
         if self.sample_weight is not None:
-            return x, y, self.sample_weight[idx_list_temp]
+            return (
+                x,
+                y,
+                self.get_idx_item(
+                    self.sample_weight, idx_list_temp, slot=slot, name="sample_weight"
+                ),
+            )
         else:
             return x, y
 
@@ -80,72 +92,7 @@ class CVAEDataGenerator(GeneratorBase):
     def on_epoch_end(self):
         # shuffle the list when epoch ends for the next epoch
         self.idx_list = self._get_exploration_order(
-            range(self.inputs["input"].shape[0])
-        )
-
-
-class CVAEPredDataGenerator(GeneratorBase):
-    """
-    To generate data to NN for prediction
-
-    :param batch_size: batch size
-    :type batch_size: int
-    :param shuffle: Whether to shuffle batches or not
-    :type shuffle: bool
-    :param data: List of data to NN
-    :type data: list
-    :param key_name: key_name for the input data, default to "input"
-    :type key_name: str
-    :param pbar: tqdm progress bar
-    :type pbar: obj
-    :History:
-        | 2017-Dec-02 - Written - Henry Leung (University of Toronto)
-        | 2019-Feb-17 - Updated - Henry Leung (University of Toronto)
-    """
-
-    def __init__(
-        self,
-        batch_size,
-        shuffle,
-        steps_per_epoch,
-        data,
-        key_name="input",
-        pbar=None,
-    ):
-        super().__init__(
-            data=data,
-            batch_size=batch_size,
-            shuffle=shuffle,
-            steps_per_epoch=steps_per_epoch,
-        )
-        self.inputs = self.data[0]
-        self.pbar = pbar
-        self.input_key_name = key_name
-
-        # initial idx
-        self.idx_list = self._get_exploration_order(
-            range(self.inputs[self.input_key_name].shape[0])
-        )
-        self.current_idx = -1
-
-    def _data_generation(self, idx_list_temp):
-        # Generate data
-        x = self.get_idx_item(self.inputs, idx_list_temp)
-        return x
-
-    def __getitem__(self, index):
-        x = self._data_generation(
-            self.idx_list[index * self.batch_size : (index + 1) * self.batch_size]
-        )
-        if self.pbar and index > self.current_idx:
-            self.pbar.update(self.batch_size)
-        self.current_idx = index
-        return x
-
-    def on_epoch_end(self):
-        # shuffle the list when epoch ends for the next epoch
-        self.idx_list = self._get_exploration_order(
-            range(self.inputs[self.input_key_name].shape[0])
+            self._get_rows(self.inputs["input"].shape[0])
         )
 
 
@@ -383,6 +330,13 @@ class ConvVAEBase(NeuralNetBase, ABC):
     def pre_training_checklist_child(
         self, input_data, input_recon_target, sample_weight
     ):
+        """
+        Normalize data and labels, compile the model if needed and set up the training and validation generators
+        over the same normalized data, the two sets are split by the index arrays ``train_idx`` and ``val_idx``
+
+        :return: normalized data and labels of both training and validation set
+        :rtype: dict, dict
+        """
         if self.task == "classification":
             raise RuntimeError("astroNN VAE does not support classification task")
         elif self.task == "binary_classification":
@@ -406,20 +360,24 @@ class ConvVAEBase(NeuralNetBase, ABC):
                 mode=self.labels_norm_mode, verbose=self.verbose
             )
 
-            norm_data = self.input_normalizer.normalize(input_data)
+            norm_data = self._normalize_training_data(self.input_normalizer, input_data)
             self.input_mean, self.input_std = (
                 self.input_normalizer.mean_labels,
                 self.input_normalizer.std_labels,
             )
-            norm_labels = self.labels_normalizer.normalize(input_recon_target)
+            norm_labels = self._normalize_training_data(
+                self.labels_normalizer, input_recon_target
+            )
             self.labels_mean, self.labels_std = (
                 self.labels_normalizer.mean_labels,
                 self.labels_normalizer.std_labels,
             )
         else:
-            norm_data = self.input_normalizer.normalize(input_data, calc=False)
-            norm_labels = self.labels_normalizer.normalize(
-                input_recon_target, calc=False
+            norm_data = self._normalize_training_data(
+                self.input_normalizer, input_data, calc=False
+            )
+            norm_labels = self._normalize_training_data(
+                self.labels_normalizer, input_recon_target, calc=False
             )
 
         if (
@@ -434,39 +392,28 @@ class ConvVAEBase(NeuralNetBase, ABC):
             norm_labels, self.keras_model.output_names
         )
 
+        # training and validation set are kept as sorted index arrays of the same data, rows are gathered by generators
         if self.has_val:
-            self.train_idx, self.val_idx = train_test_split(
-                np.arange(self.num_train + self.val_num), test_size=self.val_size
+            self.train_idx, self.val_idx = (
+                np.sort(idx)
+                for idx in train_test_split(
+                    np.arange(self.num_train + self.val_num), test_size=self.val_size
+                )
             )
         else:
             self.train_idx = np.arange(self.num_train + self.val_num)
             # just dummy, to minimize modification needed
             self.val_idx = np.arange(self.num_train + self.val_num)[:2]
 
-        norm_data_training = {}
-        norm_data_val = {}
-        norm_labels_training = {}
-        norm_labels_val = {}
-        for name in norm_data.keys():
-            norm_data_training.update({name: norm_data[name][self.train_idx]})
-            norm_data_val.update({name: norm_data[name][self.val_idx]})
-        for name in norm_labels.keys():
-            norm_labels_training.update({name: norm_labels[name][self.train_idx]})
-            norm_labels_val.update({name: norm_labels[name][self.val_idx]})
-
-        if sample_weight is not None:
-            sample_weight_training = sample_weight[self.train_idx]
-            sample_weight_val = sample_weight[self.val_idx]
-        else:
-            sample_weight_training = None
-            sample_weight_val = None
-
         self.training_generator = CVAEDataGenerator(
-            data=[norm_data_training, norm_labels_training],
+            data=[norm_data, norm_labels],
             batch_size=self.batch_size,
             shuffle=True,
             steps_per_epoch=self.num_train // self.batch_size,
-            sample_weight=sample_weight_training,
+            sample_weight=sample_weight,
+            index=self.train_idx,
+            shuffle_block_size=self.shuffle_block_size,
+            reuse_buffer=True,
         )
         if self.has_val:
             val_batchsize = (
@@ -475,16 +422,26 @@ class ConvVAEBase(NeuralNetBase, ABC):
                 else len(self.val_idx)
             )
             self.validation_generator = CVAEDataGenerator(
-                data=[norm_data_val, norm_labels_val],
+                data=[norm_data, norm_labels],
                 batch_size=val_batchsize,
                 shuffle=True,
                 steps_per_epoch=max(self.val_num // self.batch_size, 1),
-                sample_weight=sample_weight_val,
+                sample_weight=sample_weight,
+                index=self.val_idx,
+                reuse_buffer=True,
             )
 
-        return input_data, input_recon_target
+        return norm_data, norm_labels
 
-    def fit(self, input_data, input_recon_target, sample_weight=None):
+    def fit(
+        self,
+        input_data,
+        input_recon_target,
+        sample_weight=None,
+        workers=1,
+        use_multiprocessing=None,
+        max_queue_size=10,
+    ):
         """
         Train a Convolutional Autoencoder
 
@@ -494,6 +451,12 @@ class ConvVAEBase(NeuralNetBase, ABC):
         :type input_recon_target: ndarray
         :param sample_weight: Sample weights (if any)
         :type sample_weight: Union([NoneType, ndarray])
+        :param workers: Number of threads or processes to prefetch batches, 1 to generate batches in the main thread
+        :type workers: int
+        :param use_multiprocessing: Use processes instead of threads to prefetch batches, None to use ``Multiprocessing_Generator`` in astroNN configuration file
+        :type use_multiprocessing: Union([NoneType, bool])
+        :param max_queue_size: Maximum number of batches prefetched
+        :type max_queue_size: int
         :return: None
         :rtype: NoneType
         :History: 2017-Dec-06 - Written - Henry Leung (University of Toronto)
@@ -501,6 +464,11 @@ class ConvVAEBase(NeuralNetBase, ABC):
 
         # Call the checklist to create astroNN folder and save parameters
         self.pre_training_checklist_child(input_data, input_recon_target, sample_weight)
+        self._setup_generator_prefetch(
+            workers=workers,
+            use_multiprocessing=use_multiprocessing,
+            max_queue_size=max_queue_size,
+        )
 
         reduce_lr = ReduceLROnPlateau(
             monitor="loss",
@@ -678,57 +646,20 @@ class ConvVAEBase(NeuralNetBase, ABC):
 
         total_test_num = input_data["input"].shape[0]  # Number of testing data
 
-        # for number of training data smaller than batch_size
-        if total_test_num < self.batch_size:
-            self.batch_size = total_test_num
-
-        # Due to the nature of how generator works, no overlapped prediction
-        data_gen_shape = (total_test_num // self.batch_size) * self.batch_size
-        remainder_shape = total_test_num - data_gen_shape  # Remainder from generator
-
-        predictions = np.zeros((total_test_num, self._labels_shape["output"], 1))
-
-        norm_data_main = {}
-        norm_data_remainder = {}
-        for name in input_array.keys():
-            norm_data_main.update({name: input_array[name][:data_gen_shape]})
-            norm_data_remainder.update({name: input_array[name][data_gen_shape:]})
-
-        norm_data_main = self._tensor_dict_sanitize(
-            norm_data_main, [i.name for i in self.keras_model.inputs]
-        )
-        norm_data_remainder = self._tensor_dict_sanitize(
-            norm_data_remainder, [i.name for i in self.keras_model.inputs]
+        input_array = self._tensor_dict_sanitize(
+            input_array, [i.name for i in self.keras_model.inputs]
         )
 
-        # Data Generator for prediction
         with tqdm(total=total_test_num, unit="sample") as pbar:
             pbar.set_description_str("Prediction progress: ")
-            prediction_generator = CVAEPredDataGenerator(
-                batch_size=self.batch_size,
-                shuffle=False,
-                steps_per_epoch=total_test_num // self.batch_size,
-                data=[norm_data_main],
-                pbar=pbar,
+            predictions = self._predict_on_batches(
+                self.keras_model, input_array, self.batch_size, pbar=pbar
             )
-            result = self.keras_model.predict(prediction_generator, verbose=0)
-            if isinstance(result, dict):
-                result = result["output"]
-
-            if remainder_shape != 0:
-                remainder_generator = CVAEPredDataGenerator(
-                    batch_size=remainder_shape,
-                    shuffle=False,
-                    steps_per_epoch=1,
-                    data=[norm_data_remainder],
-                )
-                pbar.update(remainder_shape)
-                remainder_result = self.keras_model.predict(remainder_generator, verbose=0)
-                if isinstance(remainder_result, dict):
-                    remainder_result = remainder_result["output"]
-                result = np.concatenate((result, remainder_result))
-
-        predictions[:] = result
+        if isinstance(predictions, dict):
+            predictions = predictions["output"]
+        predictions = predictions.reshape(
+            (total_test_num, self._labels_shape["output"], 1)
+        )
 
         if self.labels_normalizer is not None:
             # TODO: handle named output in the future
@@ -763,63 +694,20 @@ class ConvVAEBase(NeuralNetBase, ABC):
 
         total_test_num = input_data["input"].shape[0]  # Number of testing data
 
-        # for number of training data smaller than batch_size
-        if total_test_num < self.batch_size:
-            self.batch_size = input_data["input"].shape[0]
-
-        # Due to the nature of how generator works, no overlapped prediction
-        data_gen_shape = (total_test_num // self.batch_size) * self.batch_size
-        remainder_shape = total_test_num - data_gen_shape  # Remainder from generator
-
-        norm_data_main = {}
-        norm_data_remainder = {}
-        for name in input_array.keys():
-            norm_data_main.update({name: input_array[name][:data_gen_shape]})
-            norm_data_remainder.update({name: input_array[name][data_gen_shape:]})
-
-        encoding_mean = np.zeros((total_test_num, self.latent_dim))
-        encoding_uncertainty = np.zeros((total_test_num, self.latent_dim))
-        encoding = np.zeros((total_test_num, self.latent_dim))
-
-        # Data Generator for prediction
         with tqdm(total=total_test_num, unit="sample") as pbar:
             pbar.set_description_str("Prediction progress: ")
-
-            prediction_generator = CVAEPredDataGenerator(
-                batch_size=self.batch_size,
-                shuffle=False,
-                steps_per_epoch=total_test_num // self.batch_size,
-                data=[norm_data_main],
-                pbar=pbar,
+            encoder_output = self._predict_on_batches(
+                self.keras_encoder, input_array, self.batch_size, pbar=pbar
             )
-            encoder_output = self.keras_encoder.predict(prediction_generator, verbose=0)
-            if isinstance(encoder_output, dict):
-                z_mean, z_log_var, z = encoder_output["z_mean"], encoder_output["z_log_var"], encoder_output["z"]
-            else:
-                z_mean, z_log_var, z = encoder_output
-
-            encoding_mean[:data_gen_shape] = z_mean
-            encoding_uncertainty[:data_gen_shape] = np.exp(0.5 * z_log_var)
-            encoding[:data_gen_shape] = z
-
-            if remainder_shape != 0:
-                # assume its caused by mono images, so need to expand dim by 1
-                for name in input_array.keys():
-                    if len(norm_data_remainder[name][0].shape) != len(
-                        self._input_shape[name]
-                    ):
-                        norm_data_remainder.update(
-                            {name: np.expand_dims(norm_data_remainder[name], axis=-1)}
-                        )
-                encoder_output = self.keras_encoder.predict(norm_data_remainder, verbose=0)
-                if isinstance(encoder_output, dict):
-                    z_mean, z_log_var, z = encoder_output["z_mean"], encoder_output["z_log_var"], encoder_output["z"]
-                else:
-                    z_mean, z_log_var, z = encoder_output
-                pbar.update(remainder_shape)
-                encoding_mean[data_gen_shape:] = z_mean
-                encoding_uncertainty[data_gen_shape:] = np.exp(0.5 * z_log_var)
-                encoding[data_gen_shape:] = z
+        if isinstance(encoder_output, dict):
+            encoding_mean, z_log_var, encoding = (
+                encoder_output["z_mean"],
+                encoder_output["z_log_var"],
+                encoder_output["z"],
+            )
+        else:
+            encoding_mean, z_log_var, encoding = encoder_output
+        encoding_uncertainty = np.exp(0.5 * z_log_var)
 
         return encoding_mean, encoding_uncertainty, encoding
 
@@ -837,18 +725,6 @@ class ConvVAEBase(NeuralNetBase, ABC):
 
         recon = np.asarray(self.keras_decoder.predict(z, batch_size=self.batch_size))
 
-        # total_test_num = z.shape[0]  # Number of testing data
-        # prediction_generator = CVAEPredDataGenerator(
-        #     batch_size=self.batch_size,
-        #     shuffle=False,
-        #     steps_per_epoch=total_test_num // self.batch_size,
-        #     data=[{"decoder_input": z}],
-        #     key_name="decoder_input",
-        # )
-        # recon = np.asarray(
-        #     self.keras_decoder.predict(prediction_generator, verbose=0)
-        # )
-
         recon_denorm = self.labels_normalizer.denormalize(
             list_to_dict(self.keras_decoder.output_names, recon)
         )["output"]
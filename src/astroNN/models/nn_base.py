@@ -3,6 +3,7 @@
 ###############################################################################
 import os
 import sys
+import tempfile
 import time
 import warnings
 import pathlib
@@ -13,7 +14,7 @@ import matplotlib.pyplot as plt
 import keras
 
 import astroNN
-from astroNN.config import _astroNN_MODEL_NAME, cpu_gpu_reader
+from astroNN.config import _astroNN_MODEL_NAME, cpu_gpu_reader, MULTIPROCESS_FLAG
 from astroNN.shared.nn_tools import cpu_fallback
 from astroNN.shared.nn_tools import folder_runnum
 from astroNN.config import (
@@ -39,6 +40,8 @@ class NeuralNetBase(ABC):
     :ivar folder_name: Folder name to be saved
     :ivar fullfilepath: Full file path
     :ivar batch_size: Batch size for training, by default 64
+    :ivar training_memmap_dir: Folder to keep normalized training data in temporary memory-mapped files instead of memory, by default None to keep in memory
+    :ivar shuffle_block_size: Shuffle blocks of this many contiguous rows and rows within each block instead of all rows for training, by default None to shuffle all rows
     :ivar autosave: Boolean to flag whether autosave model or not
 
     :ivar task: Task
@@ -72,6 +75,8 @@ class NeuralNetBase(ABC):
         self.folder_name = None
         self.fullfilepath = None
         self.batch_size = 64
+        self.shuffle_block_size = None
+        self.training_memmap_dir = None
         self.autosave = False
 
         # Hyperparameter
@@ -197,22 +202,76 @@ class NeuralNetBase(ABC):
 
         return tensor_dict
 
+    def _predict_on_batches(self, model, inputs, batch_size, pbar=None):
+        """
+        Predict batch by batch and write into preallocated arrays without concatenation. The last batch is padded
+        with zeros to the smallest power of 2 (up to batch_size) which fits, so there are only a few batch shapes
+        to be traced by the backend no matter how many data there are and no separate call for the remainder
+
+        :param model: Keras model
+        :type model: keras.Model
+        :param inputs: Normalized data to be inferred
+        :type inputs: dict
+        :param batch_size: batch size
+        :type batch_size: int
+        :param pbar: tqdm progress bar
+        :type pbar: obj
+        :return: prediction in the same structure as the output of the model
+        :rtype: Union([ndarray, dict, list])
+        """
+        total_num = inputs[list(inputs.keys())[0]].shape[0]
+        results = None
+        for start in range(0, total_num, batch_size):
+            num = min(batch_size, total_num - start)
+            if num == batch_size:
+                # contiguous rows are views without copy
+                batch = {
+                    name: value[start : start + num] for name, value in inputs.items()
+                }
+            else:
+                padded_num = min(batch_size, 1 << (num - 1).bit_length())
+                batch = {}
+                for name, value in inputs.items():
+                    batch[name] = np.zeros(
+                        (padded_num,) + value.shape[1:], dtype=value.dtype
+                    )
+                    batch[name][:num] = value[start : start + num]
+            output = model.predict_on_batch(batch)
+            if results is None:
+                results = keras.tree.map_structure(
+                    lambda x: np.empty((total_num,) + x.shape[1:], dtype=x.dtype),
+                    output,
+                )
+            for result, batch_output in zip(
+                keras.tree.flatten(results), keras.tree.flatten(output)
+            ):
+                result[start : start + num] = batch_output[:num]
+            if pbar:
+                pbar.update(num)
+        return results
+
     def pre_training_checklist_master(self, input_data, labels):
         # handle named inputs/outputs first
         try:
             self.input_names = list(input_data.keys())
-            # if input_data is a dict, cast all values to float32
-            input_data = {name: input_data[name].astype(np.float32) for name in self.input_names}
+            # if input_data is a dict, cast all values to float32, no copy if already float32
+            input_data = {
+                name: input_data[name].astype(np.float32, copy=False)
+                for name in self.input_names
+            }
         except AttributeError:
             self.input_names = ["input"]  # default input name in all astroNN models
-            input_data = {"input": input_data.astype(np.float32)}
+            input_data = {"input": input_data.astype(np.float32, copy=False)}
         try:
             self.output_names = list(labels.keys())
             # if labels is a dict, cast all values to float32
-            labels = {name: labels[name].astype(np.float32) for name in self.output_names}
+            labels = {
+                name: labels[name].astype(np.float32, copy=False)
+                for name in self.output_names
+            }
         except AttributeError:
             self.output_names = ["output"]  # default input name in all astroNN models
-            labels = {"output": labels.astype(np.float32)}
+            labels = {"output": labels.astype(np.float32, copy=False)}
 
         # assert all named input has the same number of data points
         # TODO: add detail error msg, add test
@@ -309,6 +368,82 @@ class NeuralNetBase(ABC):
 
         return input_data, labels
 
+    def _setup_generator_prefetch(
+        self, workers=1, use_multiprocessing=None, max_queue_size=10
+    ):
+        """
+        Set how the training and validation data generators prefetch batches, batches are gathered into a ring of
+        reusable preallocated buffers
+
+        :param workers: Number of threads or processes to prefetch batches, 1 to generate batches in the main thread
+        :type workers: int
+        :param use_multiprocessing: Use processes instead of threads, None to use ``Multiprocessing_Generator`` in astroNN configuration file
+        :type use_multiprocessing: Union([NoneType, bool])
+        :param max_queue_size: Maximum number of batches prefetched
+        :type max_queue_size: int
+        :return: None
+        :rtype: NoneType
+        """
+        if use_multiprocessing is None:
+            use_multiprocessing = MULTIPROCESS_FLAG
+        for generator in (self.training_generator, self.validation_generator):
+            if generator is not None:
+                generator.workers = workers
+                generator.use_multiprocessing = use_multiprocessing
+                generator.max_queue_size = max_queue_size
+
+    def _training_array(self, shape):
+        """
+        Empty float32 array for training data, in an anonymous temporary memory-mapped file in ``training_memmap_dir``
+        if set which is removed automatically once the array is gone
+
+        :param shape: shape of the array
+        :type shape: tuple
+        :return: empty array
+        :rtype: ndarray
+        """
+        if self.training_memmap_dir is None:
+            return np.empty(shape, dtype=np.float32)
+        return np.memmap(
+            tempfile.TemporaryFile(dir=self.training_memmap_dir),
+            dtype=np.float32,
+            mode="w+",
+            shape=shape,
+        )
+
+    def _normalize_training_data(self, normalizer, data, calc=True, block_size=65536):
+        """
+        Normalize named training data, normalized data are kept in temporary memory-mapped files in
+        ``training_memmap_dir`` if set so the whole normalized data never need to be in memory
+
+        :param normalizer: normalizer
+        :type normalizer: astroNN.nn.utilities.normalizer.Normalizer
+        :param data: named data
+        :type data: dict
+        :param calc: whether to calculate mean and standard deviation from data
+        :type calc: bool
+        :param block_size: number of rows to calculate mean and standard deviation at a time for memory-mapped files
+        :type block_size: int
+        :return: normalized data
+        :rtype: dict
+        """
+        if self.training_memmap_dir is None:
+            return normalizer.normalize(data, calc=calc)
+
+        num = data[list(data.keys())[0]].shape[0]
+        if calc:
+            for i in range(0, num, block_size):
+                normalizer.partial_fit(
+                    {name: data[name][i : i + block_size] for name in data.keys()}
+                )
+        out = {
+            name: self._training_array(
+                data[name].shape if data[name].ndim > 1 else (num, 1)
+            )
+            for name in data.keys()
+        }
+        return normalizer.normalize(data, calc=False, out=out)
+
     def pre_testing_checklist_master(self, input_data):
         if not isinstance(input_data, dict):
             input_data = {self.input_names[0]: np.atleast_2d(input_data)}
@@ -1 +1 @@
-from astroNN.nn.utilities.normalizer import Normalizer
+from astroNN.nn.utilities.normalizer import FrozenNormalizer, Normalizer
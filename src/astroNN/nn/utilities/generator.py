@@ -1,8 +1,21 @@
+import threading
+
 import numpy as np
 
 import keras
 
 
+def _contiguous_slice(idx):
+    """
+    Slice equivalent to the index if the index is contiguous rows, None otherwise
+    """
+    if isinstance(idx, slice) and idx.step in (None, 1):
+        return idx
+    if isinstance(idx, range) and (idx.step == 1 or len(idx) <= 1):
+        return slice(idx.start, idx.start + len(idx))
+    return None
+
+
 class GeneratorBase(keras.utils.PyDataset):
     """
     Top-level data generator class to generate batches
@@ -21,6 +34,18 @@ class GeneratorBase(keras.utils.PyDataset):
         steps per epoch
     np_rng: numpy.random.Generator, optional (default is None)
         numpy random generator
+    index: numpy.ndarray, optional (default is None)
+        rows of data to generate batches from (e.g. training or validation rows of the same data), rows are gathered
+        lazily for each batch so data do not need to be split in advance, None to use all rows
+    shuffle_block_size: int, optional (default is None)
+        if shuffle, shuffle the order of blocks of this many contiguous rows and the order of rows within each block
+        instead of all rows so every batch comes from one or two contiguous blocks (e.g. HDF5 chunks), None to shuffle all rows
+    reuse_buffer: bool, optional (default is False)
+        gather batches into a ring of preallocated buffers instead of allocating new arrays for every batch,
+        the ring is large enough to hold every batch prefetched by ``workers`` and ``max_queue_size``
+    **kwargs:
+        ``workers``, ``use_multiprocessing`` and ``max_queue_size`` of keras.utils.PyDataset to prefetch batches
+        in background threads or processes
 
     History
     -------
@@ -28,11 +53,26 @@ class GeneratorBase(keras.utils.PyDataset):
     2024-Sept-6 - Updated - Henry Leung (University of Toronto)
     """
 
-    def __init__(self, data, *, batch_size=64, shuffle=True, steps_per_epoch=None, np_rng=None, **kwargs):
+    def __init__(
+        self,
+        data,
+        *,
+        batch_size=64,
+        shuffle=True,
+        steps_per_epoch=None,
+        np_rng=None,
+        index=None,
+        shuffle_block_size=None,
+        reuse_buffer=False,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
         self.batch_size = batch_size
         self.data = data
         self.shuffle = shuffle
+        self.index = index
+        self.shuffle_block_size = shuffle_block_size
+        self.reuse_buffer = reuse_buffer
         
         if steps_per_epoch is None:  # all data should shae the same length
             self.steps_per_epoch = int(np.ceil(len(data[list(data.keys())[0]]) / batch_size))
@@ -44,24 +84,125 @@ class GeneratorBase(keras.utils.PyDataset):
         else:
             self.np_rng = np_rng
 
+        self._init_buffer_ring()
+
     def __len__(self):
         return self.steps_per_epoch
 
+    def __getstate__(self):
+        # lock cannot be pickled and buffers are not needed to be sent to worker processes
+        state = self.__dict__.copy()
+        del state["_buffer_lock"], state["_buffer_ring"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_buffer_ring()
+
+    def _get_rows(self, num):
+        # rows of data to generate batches from
+        if self.index is None:
+            return range(num)
+        return self.index
+
     def _get_exploration_order(self, idx_list):
-        # shuffle (if applicable) and find exploration order
+        # shuffle (if applicable) and find exploration order, unshuffled range is kept so batches are sliced without copy
         if self.shuffle:
-            idx_list = np.copy(idx_list)
-            self.np_rng.shuffle(idx_list)
+            idx_list = np.array(idx_list)
+            if self.shuffle_block_size is None:
+                self.np_rng.shuffle(idx_list)
+            else:
+                blocks = [
+                    idx_list[i : i + self.shuffle_block_size]
+                    for i in range(0, len(idx_list), self.shuffle_block_size)
+                ]
+                for block in blocks:  # views so shuffled in-place
+                    self.np_rng.shuffle(block)
+                if len(blocks) > 0:
+                    idx_list = np.concatenate(
+                        [blocks[i] for i in self.np_rng.permutation(len(blocks))]
+                    )
 
         return idx_list
-    
-    def get_idx_item(self, data, idx):
+
+    def _init_buffer_ring(self):
+        self._buffer_lock = threading.Lock()
+        self._buffer_ring = {}
+        self._buffer_counter = 0
+
+    @property
+    def ring_size(self):
+        """
+        Number of buffers in the ring, every batch which can be queued or in flight in the workers
+        plus the batch being consumed and the one before it
+        """
+        return max(self.max_queue_size, 0) + max(self.workers, 1) + 2
+
+    def acquire_slot(self):
+        """
+        Get the next slot of the buffer ring to be used by one batch, None if not reusing buffer
+        """
+        if not self.reuse_buffer:
+            return None
+        with self._buffer_lock:
+            slot = self._buffer_counter % self.ring_size
+            self._buffer_counter += 1
+        return slot
+
+    def _get_buffer(self, slot, name, array, num):
+        buffer = self._buffer_ring.get((slot, name))
+        shape = (max(self.batch_size, num),) + array.shape[1:]
+        if (
+            buffer is None
+            or buffer.shape[0] < num
+            or buffer.shape[1:] != shape[1:]
+            or buffer.dtype != array.dtype
+        ):
+            buffer = np.empty(shape, dtype=array.dtype)
+            self._buffer_ring[(slot, name)] = buffer
+        return buffer[:num]
+
+    def _gather(self, array, idx, slot, name):
+        contiguous = _contiguous_slice(idx)
+        if contiguous is not None:
+            # contiguous rows are returned as a view without copy
+            return array[contiguous]
+        idx = np.asarray(idx)
+        if not isinstance(array, np.ndarray):
+            # e.g. h5py dataset can only be read with increasing index, read sorted unique rows and reorder
+            unique_idx, inverse = np.unique(idx, return_inverse=True)
+            array, idx = array[unique_idx], inverse
+        if slot is None:
+            return array[idx]
+        out = self._get_buffer(slot, name, array, idx.shape[0])
+        # indices are always valid, mode="clip" avoids numpy gathering into a temporary buffer first
+        np.take(array, idx, axis=0, out=out, mode="clip")
+        return out
+
+    def get_idx_item(self, data, idx, slot=None, name=""):
         """
         Get batch data with index
+
+        Parameters
+        ----------
+        data: Union[dict, list, numpy.ndarray]
+            data to get batch from
+        idx: Union[numpy.ndarray, range, slice]
+            index of the batch, contiguous range or slice gives views of data without copy
+        slot: int, optional (default is None)
+            slot of the buffer ring from acquire_slot() to gather the batch into, None to allocate new arrays
+        name: str, optional (default is "")
+            name to identify the buffer of data within the slot if data from different sources are gathered into the same slot
         """
         if isinstance(data, dict):
-            return {key: data[key][idx] for key in data.keys()}
+            return {
+                key: self._gather(data[key], idx, slot, f"{name}/{key}")
+                for key in data.keys()
+            }
         elif isinstance(data, list):
-            return [data[i][idx] for i in range(len(data))]
+            return [
+                self._gather(data[i], idx, slot, f"{name}/{i}")
+                for i in range(len(data))
+            ]
         else:
-            return data[idx]
+            return self._gather(data, idx, slot, name)
@@ -1,6 +1,7 @@
 ###############################################################################
 #   normalizer.py: top-level class for normalizer
 ###############################################################################
+import types
 import warnings
 import numpy as np
 
@@ -8,6 +9,132 @@ from astroNN.config import MAGIC_NUMBER
 from astroNN.nn.numpy import sigmoid_inv, sigmoid
 from astroNN.shared.dict_tools import list_to_dict, to_iterable
 
+# number of elements transformed at once by _affine_transform(), small enough to stay in cache
+_TRANSFORM_BLOCK_SIZE = 65536
+
+
+def _masked_moments(data):
+    """
+    Count, mean and sum of squared deviation of every feature, magic number and NaN are ignored
+
+    :param data: data with shape (N, ...)
+    :type data: ndarray
+    :return: count, mean and sum of squared deviation with shape of a single data
+    :rtype: tuple
+    """
+    valid = (data != MAGIC_NUMBER) & ~np.isnan(data)
+    count = valid.sum(axis=0)
+    centered = np.where(valid, data, 0.0).astype(np.float64)
+    mean = centered.sum(axis=0) / np.maximum(count, 1)
+    centered -= mean
+    centered *= valid
+    return count, mean, np.square(centered, out=centered).sum(axis=0)
+
+
+def _affine_transform(data, mean, std, out, func=None, inverse=False):
+    """
+    Normalize or denormalize data block by block so masking and the affine transform are done in a single pass
+    over memory, magic number and NaN are set to magic number. ``out`` can be ``data`` itself to work in-place but
+    must not partially overlap with ``data``
+
+    :param data: data with shape (N, ...)
+    :type data: ndarray
+    :param mean: mean
+    :type mean: Union(float, ndarray)
+    :param std: standard deviation
+    :type std: Union(float, ndarray)
+    :param out: output array with the same shape as data
+    :type out: ndarray
+    :param func: custom function applied after normalization or before denormalization
+    :type func: Union(callable, NoneType)
+    :param inverse: whether to denormalize
+    :type inverse: bool
+    :return: out
+    :rtype: ndarray
+    """
+    mean, std = np.asarray(mean), np.asarray(std)
+    in_place = np.may_share_memory(data, out)
+    rows = max(1, _TRANSFORM_BLOCK_SIZE // max(1, int(np.prod(data.shape[1:]))))
+    for start in range(0, data.shape[0], rows):
+        data_block, out_block = data[start : start + rows], out[start : start + rows]
+        if data_block.dtype.kind != "f":
+            data_block = data_block.astype(np.float32)
+        magic_mask = (data_block == MAGIC_NUMBER) | np.isnan(data_block)
+        if inverse:
+            if func is not None:
+                out_block[...] = func(data_block)
+            elif not in_place:
+                np.copyto(out_block, data_block, casting="unsafe")
+            out_block *= std
+            out_block += mean
+        else:
+            np.subtract(data_block, mean, out=out_block, casting="unsafe")
+            out_block /= std
+            if func is not None:
+                out_block[...] = func(out_block)
+        np.copyto(out_block, MAGIC_NUMBER, where=magic_mask)
+    return out
+
+
+def _transform_data(params, data, out=None, inverse=False):
+    """
+    Normalize or denormalize data with mean, standard deviation and custom functions of every named data
+
+    :param params: mean, standard deviation, custom normalization function and custom denormalization function of
+        every named data, bare array data is named "Temp"
+    :type params: dict
+    :return: normalized or denormalized data
+    :rtype: Union(ndarray, dict)
+    """
+    dict_flag = type(data) is dict
+    data_dict = data if dict_flag else {"Temp": data}
+    if out is not None and not dict_flag:
+        out = {"Temp": out}
+
+    out_dict = {}
+    for name, data_array in data_dict.items():
+        data_array = np.asarray(data_array)
+        mean_labels, std_labels, norm_func, denorm_func = params[name]
+        if data_array.dtype == bool:  # no normalization can be done on bool
+            mean_labels, std_labels = 0.0, 1.0
+        if data_array.ndim == 1:
+            data_array = np.expand_dims(data_array, 1)
+        if out is None:
+            out_array = np.empty(data_array.shape, dtype=np.float32)
+        elif out[name].ndim == 1:
+            out_array = np.expand_dims(out[name], 1)
+        else:
+            out_array = out[name]
+        out_dict[name] = _affine_transform(
+            data_array,
+            mean_labels,
+            std_labels,
+            out_array,
+            func=denorm_func if inverse else norm_func,
+            inverse=inverse,
+        )
+
+    return out_dict if dict_flag else out_dict["Temp"]
+
+
+def _merge_moments(moments_a, moments_b):
+    """
+    Merge count, mean and sum of squared deviation of two sets of data (Chan et al. 1979)
+
+    :return: count, mean and sum of squared deviation of the merged data
+    :rtype: tuple
+    """
+    count_a, mean_a, m2_a = moments_a
+    count_b, mean_b, m2_b = moments_b
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    weight_b = count_b / np.maximum(count, 1)
+    return (
+        count,
+        mean_a + delta * weight_b,
+        m2_a + m2_b + delta**2 * count_a * weight_b,
+    )
+
 
 class Normalizer(object):
     """Top-level class for a normalizer"""
@@ -39,10 +166,13 @@ class Normalizer(object):
         self._custom_norm_func = None
         self._custom_denorm_func = None
 
+        # accumulated count, mean and sum of squared deviation of every feature for partial_fit()
+        self._moments = {}
+
     def mode_checker(self, data):
         if type(data) is not dict:
             dict_flag = False
-            data = {"Temp": data.astype(np.float32)}
+            data = {"Temp": data}
             self.mean_labels = {"Temp": self.mean_labels}
             self.std_labels = {"Temp": self.std_labels}
         else:
@@ -54,16 +184,16 @@ class Normalizer(object):
                 data.keys(), to_iterable(self.normalization_mode)
             )
         for name in data.keys():  # normalize data for each named inputs
-            if data[name].ndim == 1:
-                data_array = np.expand_dims(data[name], 1)
-            else:
-                data_array = np.array(data[name])
+            # only copy when data is not float32 already, data is never modified
+            data_array = np.asarray(data[name], dtype=np.float32)
+            if data_array.ndim == 1:
+                data_array = np.expand_dims(data_array, 1)
 
             self.normalization_mode.update(
                 {name: str(self.normalization_mode[name])}
             )  # just to prevent unnecessary type issue
 
-            if data_array.dtype == bool:
+            if np.asarray(data[name]).dtype == bool:
                 if self.normalization_mode[name] != "0":  # binary classification case
                     warnings.warn(
                         "Data type is detected as bool, setting normalization_mode to 0 which is "
@@ -121,14 +251,112 @@ class Normalizer(object):
                 self.std_labels.update({name: np.array([255.0])})
             else:
                 raise ValueError(f"Unknown Mode -> {self.normalization_mode[name]}")
-            master_data.update({name: data_array.astype(np.float32)})
+            master_data.update({name: data_array})
 
         return master_data, dict_flag
 
-    def normalize(self, data, calc=True):
+    def _transform_params(self, name, dict_flag):
+        """
+        Get mean, standard deviation and custom functions of a named data without changing the normalizer
+
+        :return: mean, standard deviation, custom normalization function and custom denormalization function
+        :rtype: tuple
+        """
+        if type(self.normalization_mode) is dict:
+            if name not in self.normalization_mode:
+                raise KeyError(
+                    f"No normalization mode for input '{name}', "
+                    f"known inputs are {list(self.normalization_mode.keys())}"
+                )
+            modes = [str(mode) for mode in self.normalization_mode.values()]
+            mode = str(self.normalization_mode[name])
+        else:
+            mode = str(self.normalization_mode)
+            modes = [mode]
+        mean_labels = self.mean_labels.get(name) if dict_flag else self.mean_labels
+        std_labels = self.std_labels.get(name) if dict_flag else self.std_labels
+
+        if mode == "0" or mode == "3s":
+            mean_labels, std_labels = 0.0, 1.0
+        elif mode == "255":
+            mean_labels, std_labels = 0.0, 255.0
+        # statistics not calculated for modes only center or only scale
+        if mean_labels is None or type(mean_labels) is dict:
+            mean_labels = 0.0
+        if std_labels is None or type(std_labels) is dict:
+            std_labels = 1.0
+
+        norm_func, denorm_func = self._custom_norm_func, self._custom_denorm_func
+        if "3s" in modes:
+            norm_func = sigmoid if norm_func is None else norm_func
+            denorm_func = sigmoid_inv if denorm_func is None else denorm_func
+        return mean_labels, std_labels, norm_func, denorm_func
+
+    def transform(self, data, out=None, inverse=False):
+        """
+        Normalize or denormalize data with the mean and standard deviation already calculated, the normalizer
+        is not changed so it is safe to be called from multiple data generator workers
+
+        :param data: data
+        :type data: Union(ndarray, dict)
+        :param out: output float32 array (or dict of arrays for named data) with the same shape as data, can be
+            data itself to work in-place, None to allocate a new float32 array
+        :type out: Union(ndarray, dict, NoneType)
+        :param inverse: whether to denormalize
+        :type inverse: bool
+        :return: normalized or denormalized data
+        :rtype: Union(ndarray, dict)
+        """
+        dict_flag = type(data) is dict
+        names = data.keys() if dict_flag else ["Temp"]
+        params = {name: self._transform_params(name, dict_flag) for name in names}
+        return _transform_data(params, data, out=out, inverse=inverse)
+
+    def freeze(self):
+        """
+        Create an immutable copy of the normalizer which can only normalize and denormalize with the mean and
+        standard deviation already calculated, safe to be shared across threads and processes
+
+        :return: frozen normalizer
+        :rtype: FrozenNormalizer
+        """
+        # bare array data is named "Temp" once the normalizer has been used
+        if type(self.normalization_mode) is dict:
+            dict_flag = "Temp" not in self.normalization_mode
+        else:
+            dict_flag = type(self.mean_labels) is dict and len(self.mean_labels) > 0
+        if dict_flag:
+            names = set(self.mean_labels.keys())
+            if type(self.normalization_mode) is dict:
+                names |= set(self.normalization_mode.keys())
+        else:
+            names = ["Temp"]
+        return FrozenNormalizer(
+            {name: self._transform_params(name, dict_flag) for name in names},
+            named=dict_flag,
+        )
+
+    def normalize(self, data, calc=True, out=None):
+        """
+        Normalize data
+
+        :param data: data
+        :type data: Union(ndarray, dict)
+        :param calc: whether to calculate mean and standard deviation from data, otherwise use the ones already
+            calculated without changing the normalizer
+        :type calc: bool
+        :param out: output float32 array (or dict of arrays for named data), can be data itself to work in-place
+        :type out: Union(ndarray, dict, NoneType)
+        :return: normalized data
+        :rtype: Union(ndarray, dict)
+        :History: 2018-Jan-06 - Written - Henry Leung (University of Toronto)
+        """
+        if calc is False:
+            return self.transform(data, out=out)
+
         data_array, dict_flag = self.mode_checker(data)
 
-        for name in data_array.keys():  # normalize data for each named inputs
+        for name in data_array.keys():  # calculate statistics for each named inputs
             magic_mask = [
                 (data_array[name] == MAGIC_NUMBER) | (np.isnan(data_array[name]))
             ]
@@ -142,85 +370,230 @@ class Normalizer(object):
             except KeyError:
                 self.std_labels.update({name: np.array([1.0])})
 
-            if (
-                calc is True
-            ):  # check if normalizing with predefine values or get a new one
-                if self.verbose > 0:
-                    print(
-                        f"""====Message from {self.__class__.__name__}====
+            if self.verbose > 0:
+                print(
+                    f"""====Message from {self.__class__.__name__}====
 You selected mode: {self.normalization_mode[name]}
 Featurewise Center: {self.featurewise_center}
 Datawise Center: {self.datasetwise_center} 
 Featurewise std Center: {self.featurewise_stdalization}
 Datawise std Center: {self.datasetwise_stdalization} 
 ====Message ends===="""
-                    )
+                )
+
+            # standard deviation does not depend on centering so data is never modified here
+            if self.featurewise_center[name] is True:
+                self.mean_labels.update(
+                    {
+                        name: np.ma.array(data_array[name], mask=magic_mask).mean(
+                            axis=0
+                        )
+                    }
+                )
+            elif self.datasetwise_center[name] is True:
+                self.mean_labels.update(
+                    {name: np.ma.array(data_array[name], mask=magic_mask).mean()}
+                )
+
+            if self.featurewise_stdalization[name] is True:
+                self.std_labels.update(
+                    {
+                        name: np.ma.array(data_array[name], mask=magic_mask).std(
+                            axis=0
+                        )
+                    }
+                )
+            elif self.datasetwise_stdalization[name] is True:
+                self.std_labels.update(
+                    {name: np.ma.array(data_array[name], mask=magic_mask).std()}
+                )
+
+        del data_array
+        if not dict_flag:
+            self.mean_labels = self.mean_labels["Temp"]
+            self.std_labels = self.std_labels["Temp"]
 
-                if self.featurewise_center[name] is True:
-                    self.mean_labels.update(
-                        {
-                            name: np.ma.array(data_array[name], mask=magic_mask).mean(
-                                axis=0
-                            )
-                        }
-                    )
-                    data_array[name] -= self.mean_labels[name]
-                elif self.datasetwise_center[name] is True:
-                    self.mean_labels.update(
-                        {name: np.ma.array(data_array[name], mask=magic_mask).mean()}
-                    )
-                    data_array[name] -= self.mean_labels[name]
-
-                if self.featurewise_stdalization[name] is True:
-                    self.std_labels.update(
-                        {
-                            name: np.ma.array(data_array[name], mask=magic_mask).std(
-                                axis=0
-                            )
-                        }
-                    )
-                    data_array[name] /= self.std_labels[name]
-                elif self.datasetwise_stdalization[name] is True:
-                    self.std_labels.update(
-                        {name: np.ma.array(data_array[name], mask=magic_mask).std()}
-                    )
-                    data_array[name] /= self.std_labels[name]
-                if self.normalization_mode[name] == "255":
-                    data_array[name] -= self.mean_labels[name]
-                    data_array[name] /= self.std_labels[name]
-            else:
-                data_array[name] -= self.mean_labels[name]
-                data_array[name] /= self.std_labels[name]
+        # normalize to out (or in-place) with the statistics just calculated
+        return self.transform(data, out=out)
 
-            if self._custom_norm_func is not None:
-                data_array.update({name: self._custom_norm_func(data_array[name])})
+    def denormalize(self, data, out=None):
+        """
+        Denormalize data with the mean and standard deviation already calculated, the normalizer is not changed
+
+        :param data: normalized data
+        :type data: Union(ndarray, dict)
+        :param out: output float32 array (or dict of arrays for named data), can be data itself to work in-place
+        :type out: Union(ndarray, dict, NoneType)
+        :return: denormalized data
+        :rtype: Union(ndarray, dict)
+        :History: 2018-Jan-06 - Written - Henry Leung (University of Toronto)
+        """
+        return self.transform(data, out=out, inverse=True)
 
-            np.place(data_array[name], magic_mask, MAGIC_NUMBER)
+    def _update_from_moments(self, name):
+        """
+        Update mean and standard deviation of a named data from accumulated moments
+        """
+        count, mean, m2 = self._moments[name]
+        if not isinstance(self.mean_labels.get(name), (np.ndarray, np.floating)):
+            self.mean_labels.update({name: np.array([0.0])})
+        if not isinstance(self.std_labels.get(name), (np.ndarray, np.floating)):
+            self.std_labels.update({name: np.array([1.0])})
+
+        # merge moments of all features for datasetwise statistics
+        total_count = count.sum()
+        total_mean = (count * mean).sum() / max(total_count, 1)
+        total_m2 = m2.sum() + (count * (mean - total_mean) ** 2).sum()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if self.featurewise_center[name] is True:
+                self.mean_labels.update({name: np.where(count > 0, mean, np.nan)})
+            elif self.datasetwise_center[name] is True:
+                self.mean_labels.update({name: total_mean})
+
+            if self.featurewise_stdalization[name] is True:
+                self.std_labels.update({name: np.sqrt(m2 / count)})
+            elif self.datasetwise_stdalization[name] is True:
+                self.std_labels.update({name: np.sqrt(total_m2 / total_count)})
+
+    def partial_fit(self, data):
+        """
+        Accumulate mean and standard deviation chunk by chunk so data larger than memory can be used, magic number
+        and NaN are ignored. Mean and standard deviation are updated after every call and data can be normalized
+        with ``normalize(data, calc=False)``
+
+        :param data: a chunk of data
+        :type data: Union(ndarray, dict)
+        :return: the normalizer itself
+        :rtype: Normalizer
+        """
+        data_array, dict_flag = self.mode_checker(data)
+        for name in data_array.keys():
+            moments = _masked_moments(data_array[name])
+            if name in self._moments:
+                moments = _merge_moments(self._moments[name], moments)
+            self._moments.update({name: moments})
+            self._update_from_moments(name)
 
         if not dict_flag:
-            data_array = data_array["Temp"]
             self.mean_labels = self.mean_labels["Temp"]
             self.std_labels = self.std_labels["Temp"]
 
-        return data_array
-
-    def denormalize(self, data):
-        data_array, dict_flag = self.mode_checker(data)
-        for name in data_array.keys():  # normalize data for each named inputs
-            magic_mask = [
-                (data_array[name] == MAGIC_NUMBER) | (np.isnan(data_array[name]))
-            ]
+        return self
 
-            if self._custom_denorm_func is not None:
-                data_array[name] = self._custom_denorm_func(data_array[name])
-            data_array[name] *= self.std_labels[name]
-            data_array[name] += self.mean_labels[name]
+    def merge(self, other):
+        """
+        Merge accumulated statistics from another normalizer with the same mode, for example one used by
+        ``partial_fit()`` on a different worker
 
-            np.place(data_array[name], magic_mask, MAGIC_NUMBER)
+        :param other: another normalizer
+        :type other: Normalizer
+        :return: the normalizer itself
+        :rtype: Normalizer
+        """
+        # bare array data is stored with name "Temp" during partial_fit()
+        dict_flag = "Temp" not in other._moments
+        if not dict_flag:
+            self.mean_labels = {"Temp": self.mean_labels}
+            self.std_labels = {"Temp": self.std_labels}
+        for name, moments in other._moments.items():
+            if name in self._moments:
+                moments = _merge_moments(self._moments[name], moments)
+            else:
+                for flags, other_flags in (
+                    (self.featurewise_center, other.featurewise_center),
+                    (self.datasetwise_center, other.datasetwise_center),
+                    (self.featurewise_stdalization, other.featurewise_stdalization),
+                    (self.datasetwise_stdalization, other.datasetwise_stdalization),
+                ):
+                    flags.update({name: other_flags[name]})
+            self._moments.update({name: moments})
+            self._update_from_moments(name)
 
         if not dict_flag:
-            data_array = data_array["Temp"]
             self.mean_labels = self.mean_labels["Temp"]
             self.std_labels = self.std_labels["Temp"]
 
-        return data_array
+        return self
+
+
+class FrozenNormalizer(object):
+    """
+    Immutable normalizer created by ``Normalizer.freeze()``, it only normalizes and denormalizes with the mean and
+    standard deviation of the normalizer when it was frozen
+    """
+
+    __slots__ = ("_params", "named")
+
+    def __init__(self, params, named=False):
+        """
+        To define a frozen normalizer
+
+        :param params: mean, standard deviation, custom normalization function and custom denormalization function
+            of every named data, bare array data is named "Temp"
+        :type params: dict
+        :param named: whether the normalizer is for named data
+        :type named: bool
+        """
+        frozen_params = {}
+        for name, (mean_labels, std_labels, norm_func, denorm_func) in params.items():
+            mean_labels, std_labels = np.array(mean_labels), np.array(std_labels)
+            mean_labels.flags.writeable = False
+            std_labels.flags.writeable = False
+            frozen_params[name] = (mean_labels, std_labels, norm_func, denorm_func)
+        object.__setattr__(self, "_params", types.MappingProxyType(frozen_params))
+        object.__setattr__(self, "named", named)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{self.__class__.__name__} is immutable")
+
+    def __reduce__(self):
+        return self.__class__, (dict(self._params), self.named)
+
+    @property
+    def mean_labels(self):
+        if self.named:
+            return {name: params[0] for name, params in self._params.items()}
+        return self._params["Temp"][0]
+
+    @property
+    def std_labels(self):
+        if self.named:
+            return {name: params[1] for name, params in self._params.items()}
+        return self._params["Temp"][1]
+
+    def _check_data(self, data):
+        if (type(data) is dict) != self.named:
+            raise TypeError(
+                f"This normalizer is for {'named' if self.named else 'bare array'} data"
+            )
+
+    def normalize(self, data, out=None):
+        """
+        Normalize data
+
+        :param data: data
+        :type data: Union(ndarray, dict)
+        :param out: output float32 array (or dict of arrays for named data), can be data itself to work in-place
+        :type out: Union(ndarray, dict, NoneType)
+        :return: normalized data
+        :rtype: Union(ndarray, dict)
+        """
+        self._check_data(data)
+        return _transform_data(self._params, data, out=out)
+
+    def denormalize(self, data, out=None):
+        """
+        Denormalize data
+
+        :param data: normalized data
+        :type data: Union(ndarray, dict)
+        :param out: output float32 array (or dict of arrays for named data), can be data itself to work in-place
+        :type out: Union(ndarray, dict, NoneType)
+        :return: denormalized data
+        :rtype: Union(ndarray, dict)
+        """
+        self._check_data(data)
+        return _transform_data(self._params, data, out=out, inverse=True)
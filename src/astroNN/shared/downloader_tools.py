@@ -2,10 +2,23 @@
 #   astroNN.shared.downloader_tools: shared download tools
 # ---------------------------------------------------------#
 
+import concurrent.futures
 import hashlib
+import http.client
+import json
+import os
+import threading
+import urllib.error
+import urllib.parse
 
 from tqdm import tqdm
 
+# keep-alive HTTP connections of each thread, keyed by (scheme, netloc)
+_THREAD_CONNECTIONS = threading.local()
+
+# sidecar file next to a downloaded file recording its size, mtime and hashes
+_HASH_SIDECAR_SUFFIX = ".astroNN_hash.json"
+
 
 class TqdmUpTo(tqdm):
     """
@@ -33,7 +46,20 @@ class TqdmUpTo(tqdm):
         self.update(b * bsize - self.n)  # will also set self.n = b * bsize
 
 
-def filehash(filename, block_size=65536, algorithm="sha256"):
+def _check_algorithm(algorithm):
+    """
+    Check if the hash algorithm is supported
+
+    :return: lower case algorithm name
+    :rtype: str
+    """
+    algorithm = algorithm.lower()
+    if algorithm not in hashlib.algorithms_guaranteed:
+        raise ValueError(f"{algorithm} is an unsupported hashing algorithm")
+    return algorithm
+
+
+def filehash(filename, block_size=1048576, algorithm="sha256"):
     """
     Computes the hash value for a file by using a specified hash algorithm.
 
@@ -43,15 +69,262 @@ def filehash(filename, block_size=65536, algorithm="sha256"):
     :type block_size: int
     :param algorithm: hash algorithms like 'sha256' or 'md5' etc.
     :type algorithm: str
-    :return: None
+    :return: hash in lower case
+    :rtype: str
     :History: 2019-Mar-12 - Written - Henry Leung (University of Toronto)
     """
-    algorithm = algorithm.lower()
-    if algorithm not in hashlib.algorithms_guaranteed:
-        raise ValueError(f"{algorithm} is an unsupported hashing algorithm")
-
-    func_algorithm = getattr(hashlib, algorithm)()
-    with open(filename, "rb") as f:
-        for block in iter(lambda: f.read(block_size), b""):
-            func_algorithm.update(block)
+    func_algorithm = getattr(hashlib, _check_algorithm(algorithm))()
+    # reuse a single buffer, hashlib releases the GIL on large blocks so files can be hashed in threads
+    buffer = memoryview(bytearray(block_size))
+    with open(filename, "rb", buffering=0) as f:
+        for n in iter(lambda: f.readinto(buffer), 0):
+            func_algorithm.update(buffer[:n])
     return func_algorithm.hexdigest()
+
+
+def _read_hash_sidecar(filename, stat):
+    """
+    Read hashes recorded in the sidecar file, empty if the file has been changed since the hashes were recorded
+    """
+    try:
+        with open(f"{filename}{_HASH_SIDECAR_SUFFIX}", "r") as f:
+            record = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(record, dict) or (
+        record.get("size"),
+        record.get("mtime_ns"),
+    ) != (stat.st_size, stat.st_mtime_ns):
+        return {}
+    return record.get("hashes", {})
+
+
+def _record_filehash(filename, algorithm, file_hash, stat=None):
+    """
+    Record the hash of a file in its sidecar file, silently skipped if the folder is not writable
+    """
+    if stat is None:
+        stat = os.stat(filename)
+    hashes = _read_hash_sidecar(filename, stat)
+    hashes[algorithm] = file_hash
+    sidecar = f"{filename}{_HASH_SIDECAR_SUFFIX}"
+    tempfilename = f"{sidecar}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tempfilename, "w") as f:
+            json.dump(
+                {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hashes": hashes},
+                f,
+            )
+        os.replace(tempfilename, sidecar)
+    except OSError:
+        if os.path.isfile(tempfilename):
+            os.remove(tempfilename)
+
+
+def cached_filehash(filename, algorithm="sha256", block_size=1048576):
+    """
+    Computes the hash value for a file, the hash is recorded in a sidecar file ``filename + '.astroNN_hash.json'``
+    together with the file size and modification time so an unchanged file is not hashed again in later calls
+
+    :param filename: filename
+    :type filename: str
+    :param algorithm: hash algorithms like 'sha256' or 'md5' etc.
+    :type algorithm: str
+    :param block_size: blocksize used to compute file hash
+    :type block_size: int
+    :return: hash in lower case
+    :rtype: str
+    """
+    algorithm = _check_algorithm(algorithm)
+    stat = os.stat(filename)
+    file_hash = _read_hash_sidecar(filename, stat).get(algorithm)
+    if file_hash is not None:
+        return file_hash
+
+    file_hash = filehash(filename, block_size=block_size, algorithm=algorithm)
+    # only record if the file was not changed while hashing
+    new_stat = os.stat(filename)
+    if (new_stat.st_size, new_stat.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+        _record_filehash(filename, algorithm, file_hash, stat=stat)
+    return file_hash
+
+
+def filehashes(filenames, algorithm="sha256", workers=None, block_size=1048576):
+    """
+    Computes the hash values for many files in parallel threads, files unchanged since last hashed are not hashed
+    again and every hash is recorded as soon as it is computed so an interrupted check resumes where it stopped
+
+    :param filenames: list of filenames
+    :type filenames: list[str]
+    :param algorithm: hash algorithms like 'sha256' or 'md5' etc.
+    :type algorithm: str
+    :param workers: number of threads, None to use the default of ``concurrent.futures.ThreadPoolExecutor``
+    :type workers: Union(int, NoneType)
+    :param block_size: blocksize used to compute file hash
+    :type block_size: int
+    :return: list of hash in lower case, in the same order as filenames
+    :rtype: list[str]
+    """
+    algorithm = _check_algorithm(algorithm)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(
+            executor.map(
+                lambda filename: cached_filehash(
+                    filename, algorithm=algorithm, block_size=block_size
+                ),
+                filenames,
+            )
+        )
+
+
+def _keep_alive_connection(scheme, netloc, timeout=60):
+    """
+    Get the keep-alive HTTP connection to a host for the current thread, connection is created if not exist
+
+    :param scheme: 'http' or 'https'
+    :type scheme: str
+    :param netloc: host and port
+    :type netloc: str
+    :param timeout: timeout in seconds
+    :type timeout: float
+    :return: connection
+    :rtype: http.client.HTTPConnection
+    """
+    if not hasattr(_THREAD_CONNECTIONS, "connections"):
+        _THREAD_CONNECTIONS.connections = {}
+    if (scheme, netloc) not in _THREAD_CONNECTIONS.connections:
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(netloc, timeout=timeout)
+        else:
+            connection = http.client.HTTPConnection(netloc, timeout=timeout)
+        _THREAD_CONNECTIONS.connections[(scheme, netloc)] = connection
+    return _THREAD_CONNECTIONS.connections[(scheme, netloc)]
+
+
+def _close_connection(scheme, netloc):
+    """
+    Close and forget the keep-alive HTTP connection to a host for the current thread
+    """
+    connections = getattr(_THREAD_CONNECTIONS, "connections", {})
+    connection = connections.pop((scheme, netloc), None)
+    if connection is not None:
+        connection.close()
+
+
+def _http_get(url, partfilename, headers, timeout, block_size, max_redirects=5):
+    """
+    Get a file with keep-alive connection, append to partially downloaded file if server supports range request
+    """
+    parsed = urllib.parse.urlsplit(url)
+    path = parsed.path + (f"?{parsed.query}" if parsed.query else "")
+    offset = os.path.getsize(partfilename) if os.path.isfile(partfilename) else 0
+    request_headers = dict(headers) if headers is not None else {}
+    if offset > 0:
+        request_headers["Range"] = f"bytes={offset}-"
+
+    connection = _keep_alive_connection(parsed.scheme, parsed.netloc, timeout=timeout)
+    connection.request("GET", path, headers=request_headers)
+    response = connection.getresponse()
+
+    if response.status in (301, 302, 303, 307, 308) and max_redirects > 0:
+        response.read()
+        redirect_url = urllib.parse.urljoin(url, response.getheader("Location"))
+        redirect_parsed = urllib.parse.urlsplit(redirect_url)
+        if headers is not None and (
+            (redirect_parsed.scheme, redirect_parsed.hostname, redirect_parsed.port)
+            != (parsed.scheme, parsed.hostname, parsed.port)
+        ):
+            # do not leak credentials to another host, the same as urllib and requests
+            headers = {
+                key: value
+                for key, value in headers.items()
+                if key.lower() not in ("authorization", "cookie")
+            }
+        return _http_get(
+            redirect_url, partfilename, headers, timeout, block_size, max_redirects - 1
+        )
+    if response.status == 416:
+        # partially downloaded file cannot be resumed, start over
+        response.read()
+        os.remove(partfilename)
+        return _http_get(url, partfilename, headers, timeout, block_size, max_redirects)
+    if response.status >= 400:
+        response.read()
+        raise urllib.error.HTTPError(
+            url, response.status, response.reason, response.headers, None
+        )
+    if response.status == 206:
+        content_range = response.getheader("Content-Range", "")
+        if not content_range.startswith(f"bytes {offset}-"):
+            response.read()
+            os.remove(partfilename)
+            raise http.client.HTTPException(f"Unexpected Content-Range {content_range}")
+
+    with open(partfilename, "ab" if response.status == 206 else "wb") as f:
+        for block in iter(lambda: response.read(block_size), b""):
+            f.write(block)
+
+
+def http_download(
+    url,
+    fullfilename,
+    file_hash=None,
+    algorithm="sha1",
+    retries=3,
+    headers=None,
+    timeout=60,
+    block_size=1048576,
+):
+    """
+    Download a file with the keep-alive HTTP connection of the current thread. Partially downloaded file is kept
+    as ``fullfilename + '.part'`` and resumed in later attempts, the file is verified with the hash if provided
+
+    :param url: URL
+    :type url: str
+    :param fullfilename: Full file name including path in local system
+    :type fullfilename: str
+    :param file_hash: expected hash of the file, None to skip checking
+    :type file_hash: Union(str, NoneType)
+    :param algorithm: hash algorithms like 'sha256' or 'md5' etc.
+    :type algorithm: str
+    :param retries: number of retries on connection error or hash mismatch
+    :type retries: int
+    :param headers: additional HTTP headers
+    :type headers: Union(dict, NoneType)
+    :param timeout: timeout in seconds
+    :type timeout: float
+    :param block_size: blocksize used to write the file
+    :type block_size: int
+    :return: full file path
+    :rtype: str
+    :raises urllib.error.HTTPError: if server responds with an error like 404
+    :raises ConnectionError: if the file cannot be downloaded correctly after all retries
+    """
+    parsed = urllib.parse.urlsplit(url)
+    partfilename = f"{fullfilename}.part"
+    error = None
+    for _ in range(retries + 1):
+        try:
+            _http_get(url, partfilename, headers, timeout, block_size)
+        except urllib.error.HTTPError:
+            raise
+        except (OSError, http.client.HTTPException) as emsg:
+            # connection could be closed by server, reconnect in next attempt
+            _close_connection(parsed.scheme, parsed.netloc)
+            error = emsg
+            continue
+        checksum = None
+        if file_hash is not None:
+            checksum = filehash(partfilename, algorithm=algorithm)
+            if checksum != file_hash.lower():
+                os.remove(partfilename)
+                error = "File corruption detected"
+                continue
+        os.replace(partfilename, fullfilename)
+        if checksum is not None:
+            _record_filehash(fullfilename, _check_algorithm(algorithm), checksum)
+        return fullfilename
+
+    raise ConnectionError(
+        f"Failed to download {url} after {retries + 1} attempts - {error}"
+    )
@@ -394,3 +394,213 @@ def test_apokasc_encoder_decoder(spectra_ci_data):
     cvae_net_loaded.max_epochs = 1
     cvae_net.callbacks = ErrorOnNaN()
     cvae_net_loaded.fit(xdata_vae, xdata_vae)
+
+
+def test_lazy_training_split(tmp_path):
+    """
+    Test training and validation data are split lazily by index over the same normalized data
+    """
+    rng = np.random.default_rng(5)
+    xdata = rng.normal(1.0, 0.1, (300, 7514)).astype(np.float32)
+    ydata = rng.normal(size=(300, 3)).astype(np.float32)
+
+    stats = []
+    for memmap_dir in [None, tmp_path]:
+        neuralnet = ApogeeBCNN()
+        neuralnet.training_memmap_dir = memmap_dir
+        norm_data, norm_labels = neuralnet.pre_training_checklist_child(
+            {
+                "input": xdata,
+                "input_err": np.full_like(xdata, 0.01),
+                "labels_err": np.full_like(ydata, 0.1),
+            },
+            {"output": ydata, "variance_output": ydata},
+            None,
+        )
+        generator = neuralnet.training_generator
+        # generators share the same normalized data and only keep index
+        assert generator.inputs is neuralnet.validation_generator.inputs
+        assert generator.inputs is norm_data and generator.labels is norm_labels
+        assert isinstance(generator.inputs["input"], np.memmap) == (
+            memmap_dir is not None
+        )
+        npt.assert_equal(
+            np.sort(np.concatenate([neuralnet.train_idx, neuralnet.val_idx])),
+            np.arange(300),
+        )
+        npt.assert_equal(np.sort(generator.idx_list), neuralnet.train_idx)
+
+        x, y = generator[0]
+        rows = generator.idx_list[: neuralnet.batch_size]
+        npt.assert_allclose(
+            x["input"],
+            (xdata[rows] - neuralnet.input_mean["input"])
+            / neuralnet.input_std["input"],
+            rtol=1e-4,
+            atol=1e-4,
+        )
+        npt.assert_allclose(
+            x["input_err"],
+            np.full_like(xdata[rows], 0.01) / neuralnet.input_std["input"],
+            rtol=1e-5,
+        )
+        stats.append((neuralnet.input_mean["input"], neuralnet.labels_std["output"]))
+
+    # statistics calculated chunk by chunk for memory-mapped data are the same
+    npt.assert_allclose(stats[0][0], stats[1][0], rtol=1e-5)
+    npt.assert_allclose(stats[0][1], stats[1][1], rtol=1e-5)
+
+
+def test_bcnn_without_errors():
+    """
+    Test no memory of the full data size is allocated for absent errors
+    """
+    from astroNN.models.base_bayesian_cnn import _zeros_error
+
+    rng = np.random.default_rng(6)
+    xdata = rng.normal(1.0, 0.1, (200, 300)).astype(np.float32)
+    ydata = rng.normal(size=(200, 2)).astype(np.float32)
+
+    neuralnet = ApogeeBCNN()
+    neuralnet.max_epochs = 1
+    neuralnet.mc_num = 2
+    neuralnet.fit(xdata, ydata)
+    for name in ["input_err", "labels_err"]:
+        err = neuralnet.training_generator.inputs[name]
+        assert err.strides[0] == 0 and not np.any(err)
+    x, y = neuralnet.training_generator[0]
+    npt.assert_equal(x["labels_err"], np.zeros((neuralnet.batch_size, 2)))
+
+    # known errors are only scaled by the standard deviation
+    neuralnet.fit_on_batch(xdata[:64], ydata[:64], labels_err=np.full((64, 2), 0.1))
+    neuralnet.pre_training_checklist_child(
+        {
+            "input": xdata,
+            "input_err": np.full_like(xdata, 0.1),
+            "labels_err": _zeros_error(ydata.shape),
+        },
+        {"output": ydata, "variance_output": ydata},
+        None,
+    )
+    npt.assert_allclose(
+        neuralnet.training_generator.inputs["input_err"],
+        0.1 / np.broadcast_to(neuralnet.input_std["input"], xdata.shape),
+    )
+    assert neuralnet.training_generator.inputs["labels_err"].strides[0] == 0
+
+    pred, pred_err = neuralnet.predict(xdata[:37])
+    assert pred.shape == (37, 2) and pred_err["total"].shape == (37, 2)
+    neuralnet.evaluate(xdata, ydata)
+
+
+def test_bcnn_predict_dataset(tmp_path):
+    """
+    Test streaming prediction chunk by chunk from h5py dataset, memory-mapped array and iterable
+    """
+    import h5py
+
+    rng = np.random.default_rng(7)
+    xdata = rng.normal(1.0, 0.1, (200, 300)).astype(np.float32)
+    ydata = rng.normal(size=(200, 2)).astype(np.float32)
+
+    neuralnet = ApogeeBCNN()
+    neuralnet.max_epochs = 1
+    neuralnet.mc_num = 2
+    neuralnet.fit(xdata, ydata)
+
+    with h5py.File(tmp_path / "input.h5", "w") as f:
+        f.create_dataset("spectra", data=xdata[:101])
+    with h5py.File(tmp_path / "input.h5", "r") as f:
+        num = neuralnet.predict_dataset(
+            f["spectra"], output=tmp_path / "output.h5", batch_size=16, chunk_size=40
+        )
+    assert num == 101
+    with h5py.File(tmp_path / "output.h5", "r") as f:
+        assert set(f.keys()) == {"prediction", "total", "model", "predictive"}
+        for name in f.keys():
+            assert f[name].shape == (101, 2)
+            assert np.all(np.isfinite(f[name][()]))
+
+    memmap = np.lib.format.open_memmap(
+        tmp_path / "input.npy", mode="w+", dtype=np.float32, shape=(101, 300)
+    )
+    memmap[:] = xdata[:101]
+    pred, pred_err = neuralnet.predict_dataset(memmap, chunk_size=40)
+    assert pred.shape == (101, 2) and pred_err["total"].shape == (101, 2)
+
+    pred, pred_err = neuralnet.predict_dataset(
+        iter([xdata[:30], xdata[30:37], xdata[37]])
+    )
+    assert pred.shape == (38, 2) and pred_err["model"].shape == (38, 2)
+
+    # error must be aligned with data
+    with pytest.raises(ValueError):
+        neuralnet.predict_dataset(
+            xdata[:10], inputs_err=iter([xdata[:4]]), chunk_size=4
+        )
+    with pytest.raises(ValueError):
+        neuralnet.predict_dataset(
+            iter([xdata[:10]]), inputs_err=iter([xdata[:4], xdata[4:10]])
+        )
+
+
+def test_bcnn_mc_inference_cache(tmp_path):
+    """
+    Test Monte Carlo inference model is cached across prediction and rebuilt when mc_num or model changes
+    """
+    rng = np.random.default_rng(8)
+    xdata = rng.normal(1.0, 0.1, (200, 300)).astype(np.float32)
+    ydata = rng.normal(size=(200, 2)).astype(np.float32)
+
+    neuralnet = ApogeeBCNN()
+    neuralnet.max_epochs = 1
+    neuralnet.mc_num = 2
+    neuralnet.fit(xdata, ydata)
+    neuralnet.predict(xdata[:10])
+    mc_model = neuralnet._mc_inference_model()
+    neuralnet.predict(xdata[:10])
+    neuralnet.predict_dataset(xdata[:10])
+    assert neuralnet._mc_inference_model() is mc_model
+
+    neuralnet.mc_num = 3
+    assert neuralnet._mc_inference_model() is not mc_model
+    pred, pred_err = neuralnet.predict(xdata[:10])
+    assert pred.shape == (10, 2)
+
+    neuralnet.save(name=str(tmp_path / "bcnn"))
+    neuralnet_loaded = load_folder(str(tmp_path / "bcnn"))
+    # warmed up on load
+    assert neuralnet_loaded._mc_inference_cache is not None
+    assert (
+        neuralnet_loaded._mc_inference_cache[1] is neuralnet_loaded.keras_model_predict
+    )
+
+
+def test_predict_on_batches():
+    """
+    Test prediction with padded last batch is the same as inferring all data at once
+    """
+    rng = np.random.default_rng(9)
+    xdata = rng.normal(size=(77, 5)).astype(np.float32)
+    input_tensor = keras.Input(shape=(5,), name="input")
+    model = keras.Model(
+        inputs=input_tensor,
+        outputs={
+            "output": keras.layers.Dense(3, name="output")(input_tensor),
+            "variance_output": keras.layers.Dense(2, name="variance_output")(
+                input_tensor
+            ),
+        },
+    )
+    expected = model.predict_on_batch({"input": xdata})
+
+    neuralnet = ApogeeBCNN()
+    result = neuralnet._predict_on_batches(model, {"input": xdata}, 32)
+    assert set(result.keys()) == {"output", "variance_output"}
+    for name in result.keys():
+        assert result[name].shape == (77, expected[name].shape[1])
+        npt.assert_allclose(result[name], expected[name], rtol=1e-5, atol=1e-6)
+
+    # single data smaller than batch size
+    result = neuralnet._predict_on_batches(model, {"input": xdata[:1]}, 32)
+    npt.assert_allclose(result["output"], expected["output"][:1], rtol=1e-5, atol=1e-6)
@@ -1,18 +1,32 @@
+import functools
+import os
+import hashlib
+import http.server
+import threading
+
 import numpy as np
 import numpy.testing as npt
 import pytest
 from astroNN.apogee import (
     apogee_continuum,
     apogee_default_dr,
+    bulk_spectra,
     aspcap_mask,
     bitmask_boolean,
+    bitmask_combine,
     bitmask_decompositor,
+    bitmask_planes,
     chips_split,
     combined_spectra,
+    continuum,
     gap_delete,
     visit_spectra,
+    wavelength_solution,
 )
 from astroNN.apogee.apogee_shared import apogeeid_digit
+from astroNN.apogee.downloader import _allstar_lookup, _load_allstar_slim
+from astroNN.shared.downloader_tools import http_download
+from astropy.table import Table
 
 
 def test_apogee_tools():
@@ -45,6 +59,40 @@ def test_apogee_tools():
     npt.assert_array_equal(bitmask_boolean([0, 1, 2], [0]), [[False, True, False]])
     with pytest.raises(ValueError):
         bitmask_decompositor(-1)
+    npt.assert_array_equal(bitmask_decompositor(2**0 + 2**5 + 2**13), [0, 5, 13])
+    assert bitmask_combine([0, 1, 12]) == 2**0 + 2**1 + 2**12
+    assert bitmask_combine(3) == 2**3
+
+    # whole bitmask arrays
+    rng = np.random.default_rng(0)
+    bitmask = rng.integers(0, 2**15, (10, 8575), dtype=np.int32)
+    boolean_output = bitmask_boolean(bitmask, [0, 1, 12])
+    assert boolean_output.shape == (10, 8575)
+    npt.assert_array_equal(boolean_output, (bitmask & 4099) != 0)
+    npt.assert_array_equal(
+        bitmask_boolean(bitmask.astype(np.uint64), [0, 1, 12]), boolean_output
+    )
+    planes = bitmask_planes(bitmask)
+    assert planes.shape == (15, 10, 8575)
+    npt.assert_array_equal(
+        np.sum(planes * (2 ** np.arange(15))[:, None, None], axis=0), bitmask
+    )
+    npt.assert_array_equal(bitmask_planes(bitmask, bits=12)[0], (bitmask & 4096) != 0)
+    with pytest.raises(ValueError):
+        bitmask_planes([-1, 1])
+    # bits wider than narrow dtypes
+    npt.assert_array_equal(
+        bitmask_boolean(np.array([0, 1, 255], dtype=np.uint8), [12]),
+        [[False, False, False]],
+    )
+    npt.assert_array_equal(
+        bitmask_boolean(np.array([1, -32768, 32767], dtype=np.int16), [15]),
+        [[False, True, False]],
+    )
+    npt.assert_array_equal(
+        bitmask_planes(np.array([1, 255], dtype=np.uint8), bits=[0, 12]),
+        [[True, True], [False, False]],
+    )
 
     # chips_split
     blue, green, red = chips_split(raw_spectra)
@@ -54,6 +102,23 @@ def test_apogee_tools():
     with pytest.raises(ValueError):
         chips_split(raw_spectra, dr=10)
 
+    # chips are views of the spectra, for both raw and gap deleted spectra
+    raw_spectra = np.arange(2 * 8575, dtype=float).reshape(2, 8575)
+    gap_deleted = gap_delete(raw_spectra, dr=17)
+    for spectra in [raw_spectra, gap_deleted]:
+        blue, green, red = chips_split(spectra, dr=17)
+        assert all(np.shares_memory(chip, spectra) for chip in (blue, green, red))
+        npt.assert_array_equal(np.concatenate((blue, green, red), axis=1), gap_deleted)
+    npt.assert_array_equal(
+        gap_deleted,
+        raw_spectra[:, np.r_[246:3274, 3585:6080, 6344:8335]],
+    )
+
+    # gap delete to preallocated buffer
+    out = np.zeros((2, 7514), dtype=np.float32)
+    assert gap_delete(raw_spectra, dr=17, out=out) is out
+    npt.assert_array_equal(out, gap_deleted.astype(np.float32))
+
 
 def test_apogee_continuum():
     raw_spectra = np.ones((10, 8575)) * 2
@@ -62,6 +127,66 @@ def test_apogee_continuum():
     cont_spectra, cont_spectra_arr = apogee_continuum(raw_spectra, raw_spectra_err)
     npt.assert_almost_equal(float(np.mean(cont_spectra)), 1.0)
 
+    # chunked and multiprocessing continuum should give the same results
+    rng = np.random.default_rng(0)
+    raw_spectra = rng.uniform(1.0, 2.0, (50, 8575))
+    raw_spectra_err = rng.uniform(0.01, 0.1, (50, 8575))
+    bitmask = rng.integers(0, 2**13, (50, 8575))
+    cont_spectra, cont_spectra_err = apogee_continuum(
+        raw_spectra, raw_spectra_err, bitmask=bitmask
+    )
+    for workers, chunk_size in [(1, 7), (2, 7), (2, None)]:
+        chunk_spectra, chunk_spectra_err = apogee_continuum(
+            raw_spectra,
+            raw_spectra_err,
+            bitmask=bitmask,
+            chunk_size=chunk_size,
+            workers=workers,
+        )
+        npt.assert_allclose(cont_spectra, chunk_spectra, rtol=1e-12)
+        npt.assert_allclose(cont_spectra_err, chunk_spectra_err, rtol=1e-12)
+
+    # write to preallocated output
+    out = (np.zeros((50, 7514)), np.zeros((50, 7514)))
+    chunk_spectra, _ = apogee_continuum(
+        raw_spectra, raw_spectra_err, bitmask=bitmask, chunk_size=16, out=out
+    )
+    assert chunk_spectra is out[0]
+    npt.assert_allclose(cont_spectra, out[0], rtol=1e-12)
+    npt.assert_allclose(cont_spectra_err, out[1], rtol=1e-12)
+
+
+def test_continuum_batch_fit():
+    # batched continuum fitting should agree with fitting spectrum one by one
+    rng = np.random.default_rng(42)
+    pix = np.arange(1000)
+    cont_mask = np.zeros(pix.shape[0], dtype=bool)
+    cont_mask[rng.choice(pix.shape[0], 100, replace=False)] = True
+    spectra = (1.0 + 0.3 * pix / 1000.0) * rng.uniform(1.0, 10.0, (20, 1))
+    spectra = spectra + rng.normal(0.0, 0.01, spectra.shape)
+    spectra_err = rng.uniform(0.01, 0.1, spectra.shape)
+    spectra[rng.random(spectra.shape) < 0.05] = np.nan
+
+    norm_spectra, norm_spectra_err = continuum(spectra, spectra_err, cont_mask, deg=2)
+    for spectrum, spectrum_err, norm_spectrum, norm_spectrum_err in zip(
+        spectra, spectra_err, norm_spectra, norm_spectra_err
+    ):
+        no_nan_mask = ~np.isnan(spectrum[cont_mask])
+        fit = np.polynomial.chebyshev.Chebyshev.fit(
+            x=pix[cont_mask][no_nan_mask],
+            y=spectrum[cont_mask][no_nan_mask],
+            w=1 / (np.square(spectrum_err) + 1e-8)[cont_mask][no_nan_mask],
+            deg=2,
+        )
+        npt.assert_allclose(norm_spectrum, spectrum / fit(pix), rtol=1e-10)
+        npt.assert_allclose(norm_spectrum_err, spectrum_err / fit(pix), rtol=1e-10)
+
+    # spectrum without any valid continuum pixel cannot be normalized
+    spectra[0] = np.nan
+    norm_spectra, _ = continuum(spectra, spectra_err, cont_mask, deg=2)
+    assert np.all(np.isnan(norm_spectra[0]))
+    assert np.all(np.isfinite(norm_spectra[1][~np.isnan(spectra[1])]))
+
 
 def test_apogee_digit_extractor():
     # Test apogeeid digit extractor
@@ -86,6 +211,24 @@ def test_aspcap_mask():
     # Make sure if element not found, the case is nicely handled
     with pytest.raises(ValueError):
         aspcap_mask("abc", 1)
+    assert aspcap_mask("abc", 14) is None
+
+    # masks are decoded once, writing to the returned mask does not change the cache
+    mask = aspcap_mask("Fe", dr=17)
+    npt.assert_array_equal(mask, aspcap_mask("fe", dr=14))
+    mask[:] = ~mask
+    npt.assert_array_equal(~mask, aspcap_mask("Fe", dr=17))
+
+
+def test_static_products_cache():
+    lambda_blue, lambda_green, lambda_red = wavelength_solution(dr=17)
+    assert lambda_blue.shape[0] + lambda_green.shape[0] + lambda_red.shape[0] == 7514
+    npt.assert_almost_equal(lambda_blue[0], 10.0 ** (4.179 + 246 * 6.0e-6))
+    # writing to the returned wavelength does not change the cache
+    lambda_blue *= 2.0
+    npt.assert_almost_equal(
+        wavelength_solution(dr=17)[0][0], 10.0 ** (4.179 + 246 * 6.0e-6)
+    )
 
 
 def test_apogee_combined_download():
@@ -152,3 +295,227 @@ def test_apogee_visit_download():
     # assert error if DR not supported
     with pytest.raises(ValueError):
         visit_spectra(dr=1, location=4406, apogee="2M19060637+4717296")
+
+
+def test_allstar_slim(tmp_path, monkeypatch):
+    """
+    Test slim allStar cache used to locate stars on SAS
+    """
+    fullfilename = str(tmp_path.joinpath("allStar-test.fits"))
+    Table(
+        {
+            "APOGEE_ID": ["2M3", "2M1", "2M2", "2M1"],
+            "TELESCOPE": ["apo25m", "apo25m", "apo1m", "lco25m"],
+            "FIELD": ["F3", "F1", "F2", "F1S"],
+            "LOCATION_ID": [3, 1, 2, 4],
+            "RA": [1.0, 2.0, 3.0, 4.0],
+            "K": np.array([10.0, 11.0, 12.0, 13.0], dtype=">f4"),
+            "TEFF": [5000.0, 5000.0, 5000.0, 5000.0],
+        }
+    ).write(fullfilename)
+
+    allstar_slim = _load_allstar_slim(fullfilename)
+    # columns are in allStar order
+    npt.assert_array_equal(allstar_slim["APOGEE_ID"], ["2M3", "2M1", "2M2", "2M1"])
+    npt.assert_array_equal(allstar_slim["RA"], [1.0, 2.0, 3.0, 4.0])
+    assert allstar_slim["K"].dtype == np.float32
+    # missing columns are filled, unused columns are not cached
+    assert np.all(np.isnan(allstar_slim["AK_TARG"]))
+    assert "TEFF" not in allstar_slim
+
+    # first entry in allStar order if telescope is not specified
+    assert _allstar_lookup(allstar_slim, "2M1") == (1, "F1", "apo25m")
+    assert _allstar_lookup(allstar_slim, "2M1", telescope="lco25m") == (
+        4,
+        "F1S",
+        "lco25m",
+    )
+    assert _allstar_lookup(allstar_slim, "2M3") == (3, "F3", "apo25m")
+    assert _allstar_lookup(allstar_slim, "2M2", telescope="apo25m") is None
+    assert _allstar_lookup(allstar_slim, "2M0") is None
+
+    # cache is on disk and loaded memory-mapped
+    allstar_slim = _load_allstar_slim(fullfilename)
+    assert isinstance(allstar_slim["APOGEE_ID"], np.memmap)
+    assert tmp_path.joinpath("allStar-test_astroNN_slim", "FIELD.npy").exists()
+
+    # existing cache is used without allStar file
+    import astroNN.apogee.downloader
+
+    folder, filename, _ = astroNN.apogee.downloader._allstar_path(17)
+    os.makedirs(tmp_path.joinpath(folder))
+    os.replace(fullfilename, tmp_path.joinpath(folder, filename))
+    _load_allstar_slim(str(tmp_path.joinpath(folder, filename)))
+    os.remove(tmp_path.joinpath(folder, filename))
+
+    def no_allstar(dr=None, flag=None):
+        raise AssertionError("allStar file should not be needed")
+
+    monkeypatch.setattr(astroNN.apogee.downloader, "apogee_env", lambda: str(tmp_path))
+    monkeypatch.setattr(astroNN.apogee.downloader, "allstar", no_allstar)
+    monkeypatch.setattr(astroNN.apogee.downloader, "_ALLSTAR_SLIM", {})
+    allstar_slim = astroNN.apogee.downloader._allstar_slim(17)
+    assert _allstar_lookup(allstar_slim, "2M2") == (2, "F2", "apo1m")
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Local stand-in of SAS, supports keep-alive connections and range requests
+    """
+
+    protocol_version = "HTTP/1.1"
+    requests_log = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.requests_log.append((self.path, self.headers.get("Range")))
+        range_header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if range_header is None or not os.path.isfile(path):
+            return super().do_GET()
+        with open(path, "rb") as f:
+            content = f.read()
+        start = int(range_header.split("=")[1].split("-")[0])
+        self.send_response(206)
+        self.send_header(
+            "Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}"
+        )
+        self.send_header("Content-Length", str(len(content) - start))
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+
+class RedirectRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Redirect ``/same`` to ``/file`` of the same server and ``/cross`` to ``/file`` of ``redirect_port``
+    """
+
+    protocol_version = "HTTP/1.1"
+    redirect_port = None
+    requests_log = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.requests_log.append(
+            (
+                self.server.server_address[1],
+                self.path,
+                self.headers.get("Authorization"),
+                self.headers.get("Cookie"),
+            )
+        )
+        if self.path in ("/same", "/cross"):
+            port = self.redirect_port
+            if self.path == "/same":
+                port = self.server.server_address[1]
+            self.send_response(302)
+            self.send_header("Location", f"http://127.0.0.1:{port}/file")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("Content-Length", "4")
+            self.end_headers()
+            self.wfile.write(b"data")
+
+
+def test_http_download_redirect(tmp_path):
+    """
+    Test credentials are only sent to redirect target on the same host
+    """
+    servers = [
+        http.server.ThreadingHTTPServer(("127.0.0.1", 0), RedirectRequestHandler)
+        for _ in range(2)
+    ]
+    RedirectRequestHandler.redirect_port = servers[1].server_address[1]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = servers[0].server_address[1]
+    headers = {
+        "Authorization": "Basic secret",
+        "Cookie": "session=secret",
+        "Accept": "*/*",
+    }
+    try:
+        for path in ("same", "cross"):
+            fullfilename = str(tmp_path.joinpath(path))
+            http_download(
+                f"http://127.0.0.1:{port}/{path}", fullfilename, headers=headers
+            )
+            assert open(fullfilename, "rb").read() == b"data"
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    log = RedirectRequestHandler.requests_log
+    assert (port, "/file", "Basic secret", "session=secret") in log
+    assert (servers[1].server_address[1], "/file", None, None) in log
+    # caller's headers are not modified
+    assert headers["Authorization"] == "Basic secret"
+
+
+def test_bulk_spectra(tmp_path, monkeypatch):
+    """
+    Test bulk spectra downloading against a local HTTP server
+    """
+    remote, local = tmp_path.joinpath("remote"), tmp_path.joinpath("local")
+    folder = "dr17/apogee/spectro/aspcap/dr17/synspec_rev1/apo25m/K06_078+16/"
+    remote.joinpath(folder).mkdir(parents=True)
+    apogee_ids = [f"2M0000000{i}+0000000" for i in range(5)]
+    hash_lines = []
+    for i, apogee_id in enumerate(apogee_ids[:4]):
+        content = np.random.default_rng(i).bytes(100000)
+        filename = f"aspcapStar-dr17-{apogee_id}.fits"
+        remote.joinpath(folder, filename).write_bytes(content)
+        # corrupted checksum for the last file
+        file_hash = hashlib.sha1(content if i != 3 else b"").hexdigest()
+        hash_lines.append(f"{file_hash}  {filename}")
+    remote.joinpath(folder, "dr17_synspec_apo25m_K06_078+16.sha1sum").write_text(
+        "\n".join(hash_lines)
+    )
+
+    # partially downloaded file should be resumed
+    local.joinpath(folder).mkdir(parents=True)
+    partial_content = remote.joinpath(folder, f"aspcapStar-dr17-{apogee_ids[1]}.fits")
+    local.joinpath(folder, f"aspcapStar-dr17-{apogee_ids[1]}.fits.part").write_bytes(
+        partial_content.read_bytes()[:5000]
+    )
+
+    monkeypatch.setenv("SDSS_LOCAL_SAS_MIRROR", str(local))
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(RangeRequestHandler, directory=str(remote))
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        with pytest.warns(UserWarning):
+            fullfilenames = bulk_spectra(
+                dr=17,
+                apogee=apogee_ids,
+                field="K06_078+16",
+                telescope="apo25m",
+                workers=2,
+                retries=1,
+                sas_url=f"http://127.0.0.1:{server.server_address[1]}/",
+            )
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    for i in range(3):
+        assert open(fullfilenames[i], "rb").read() == (
+            remote.joinpath(
+                folder, f"aspcapStar-dr17-{apogee_ids[i]}.fits"
+            ).read_bytes()
+        )
+    # checksum mismatch and file not found on server
+    assert fullfilenames[3] is False
+    assert fullfilenames[4] is False
+    assert (
+        f"/{folder}aspcapStar-dr17-{apogee_ids[1]}.fits",
+        "bytes=5000-",
+    ) in RangeRequestHandler.requests_log
@@ -27,6 +27,255 @@ def test_xmatch():
     assert len(idx_1) == len(idx_2)
     npt.assert_equal(sep, np.zeros_like(sep))
 
+
+def test_xmatch_index(tmp_path):
+    from astropy.table import Table
+    from astroNN.datasets import SkyIndex
+    from astroNN.datasets.xmatch import xmatch_cat
+
+    rng = np.random.default_rng(0)
+    ra2 = rng.uniform(0.0, 360.0, 5000)
+    dec2 = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, 5000)))
+    field2 = rng.integers(0, 3, 5000)
+    ra1 = np.append(ra2[:1000] + rng.normal(0.0, 1.0 / 3600.0, 1000), [np.nan, 10.0])
+    dec1 = np.append(dec2[:1000] + rng.normal(0.0, 1.0 / 3600.0, 1000), [10.0, 10.0])
+    field1 = np.append(field2[:1000], [0, 0])
+    field1[:100] = (field1[:100] + 1) % 3  # these can only be matched without field
+
+    # index is reusable and give the same result as xmatch
+    index = SkyIndex(ra2, dec2)
+    idx_1, idx_2, sep = xmatch(ra1, dec1, ra2, dec2, maxdist=2.0)
+    for result in (
+        index.match(ra1, dec1, maxdist=2.0),
+        index.match(ra1, dec1, maxdist=2.0, chunk_size=100),
+    ):
+        npt.assert_equal(result[0], idx_1)
+        npt.assert_equal(result[1], idx_2)
+        npt.assert_allclose(result[2].arcsec, sep.arcsec)
+    assert np.all(sep.arcsec < 2.0)
+    npt.assert_equal(idx_2, idx_1)  # nearest neighbour is the original object
+
+    # empty catalog 1 gives empty results
+    for result in (
+        xmatch(np.array([]), np.array([]), ra2, dec2),
+        index.match(np.array([]), np.array([])),
+    ):
+        assert result[0].shape == result[1].shape == result[2].shape == (0,)
+
+    # match only within the same field
+    cat1 = Table({"ra": ra1, "dec": dec1, "field": field1})
+    cat2 = Table({"ra": ra2, "dec": dec2, "field": field2})
+    cat1.write(tmp_path / "cat1.fits")
+    cat2.write(tmp_path / "cat2.FITS")
+    idx_1_field, idx_2_field, sep_field = xmatch_cat(
+        tmp_path / "cat1.fits", tmp_path / "cat2.FITS", maxdist=2.0, field="field"
+    )
+    npt.assert_equal(idx_1_field, idx_1[idx_1 >= 100])
+    npt.assert_equal(idx_2_field, idx_2[idx_1 >= 100])
+    npt.assert_equal(field1[idx_1_field], field2[idx_2_field])
+
+
+def test_xmatch_neighbours():
+    import astropy.coordinates as acoords
+    from astroNN.datasets import SkyIndex
+
+    rng = np.random.default_rng(2)
+    ra2, dec2 = rng.uniform(0.0, 1.0, 5000), rng.uniform(0.0, 1.0, 5000)
+    ra1, dec1 = rng.uniform(0.0, 1.0, 50), rng.uniform(0.0, 1.0, 50)
+    ra1[3] = np.nan
+    index = SkyIndex(ra2, dec2)
+    cat2 = acoords.SkyCoord(ra2, dec2, unit="deg")
+
+    # every pairs within radius in CSR-style arrays, same result in any chunk size
+    offsets, idx, sep = index.query_radius(ra1, dec1, maxdist=60.0)
+    offsets_chunk, idx_chunk, sep_chunk = index.query_radius(
+        ra1, dec1, maxdist=60.0, chunk_size=7
+    )
+    npt.assert_equal(offsets, offsets_chunk)
+    npt.assert_equal(idx, idx_chunk)
+    assert offsets.shape == (51,) and offsets[3] == offsets[4]
+    for i in [0, 1, 2, 4, 49]:
+        d = acoords.SkyCoord(ra1[i], dec1[i], unit="deg").separation(cat2).arcsec
+        expected = np.flatnonzero(d < 60.0)
+        npt.assert_equal(np.sort(idx[offsets[i] : offsets[i + 1]]), expected)
+        npt.assert_allclose(
+            sep[offsets[i] : offsets[i + 1]].arcsec, np.sort(d[expected])
+        )
+
+    # k-nearest neighbours
+    knn_idx, knn_sep = index.query_knn(ra1, dec1, k=3)
+    assert knn_idx.shape == knn_sep.shape == (50, 3)
+    d = acoords.SkyCoord(ra1[0], dec1[0], unit="deg").separation(cat2).arcsec
+    npt.assert_equal(knn_idx[0], np.argsort(d)[:3])
+    npt.assert_allclose(knn_sep[0].arcsec, np.sort(d)[:3])
+    npt.assert_equal(knn_idx[3], -1)
+    # nearest neighbour within radius is the same as match, no more neighbour is -1
+    knn_idx, knn_sep = index.query_knn(ra1, dec1, k=3, maxdist=30.0)
+    idx_1, idx_2, sep = index.match(ra1, dec1, maxdist=30.0)
+    npt.assert_equal(knn_idx[idx_1, 0], idx_2)
+    assert np.all(knn_idx[np.isinf(knn_sep.deg)] == -1)
+    npt.assert_equal(
+        np.sum(knn_idx >= 0, axis=1),
+        np.diff(index.query_radius(ra1, dec1, maxdist=30.0)[0]).clip(max=3),
+    )
+
+
+def test_xmatch_stream(tmp_path):
+    import h5py
+    from astropy.table import Table
+    from astroNN.datasets.xmatch import xmatch_stream
+
+    rng = np.random.default_rng(1)
+    ra2 = rng.uniform(0.0, 360.0, 3000)
+    dec2 = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, 3000)))
+    pmra2, pmdec2 = rng.normal(0.0, 100.0, 3000), rng.normal(0.0, 100.0, 3000)
+    ra1 = np.append(
+        ra2[::3] + rng.normal(0.0, 1.0 / 3600.0, 1000), rng.uniform(0.0, 360.0, 500)
+    )
+    dec1 = np.append(
+        dec2[::3] + rng.normal(0.0, 1.0 / 3600.0, 1000), rng.uniform(-90.0, 90.0, 500)
+    )
+    with h5py.File(tmp_path / "cat1.h5", "w") as F:
+        F.create_dataset("ra", data=ra1)
+        F.create_dataset("dec", data=dec1)
+    Table({"ra": ra2, "dec": dec2, "pmra": pmra2, "pmdec": pmdec2}).write(
+        tmp_path / "cat2.fits"
+    )
+
+    for epoch2 in (2000.0, 2015.5):
+        idx_1, idx_2, sep = xmatch(
+            ra1, dec1, ra2, dec2, epoch2=epoch2, pmra2=pmra2, pmdec2=pmdec2, maxdist=2.0
+        )
+        # whole catalog 2 indexed at once, or block by block
+        for cat2_chunk_size in (-1, None, 700):
+            num = xmatch_stream(
+                tmp_path / "cat1.h5",
+                tmp_path / "cat2.fits",
+                tmp_path / "matches.h5",
+                epoch2=epoch2,
+                chunk_size=256,
+                cat2_chunk_size=cat2_chunk_size,
+            )
+            assert num == idx_1.shape[0]
+            with h5py.File(tmp_path / "matches.h5", "r") as F:
+                npt.assert_equal(F["idx1"][()], idx_1)
+                npt.assert_equal(F["idx2"][()], idx_2)
+                npt.assert_allclose(F["sep"][()], sep.deg)
+    # temporary files are cleaned up
+    assert sorted(os.listdir(tmp_path)) == ["cat1.h5", "cat2.fits", "matches.h5"]
+    # catalog opened from a path is closed even on error so it can be opened for writing again
+    from astroNN.datasets.xmatch import xmatch_cat
+
+    # traceback kept in excinfo holds the frames which opened the catalog
+    with pytest.raises(KeyError) as excinfo:
+        xmatch_cat(tmp_path / "cat1.h5", tmp_path / "cat2.fits", field="field")
+    with h5py.File(tmp_path / "cat1.h5", "a"):
+        pass
+
+
+def test_h5loader(tmp_path, monkeypatch):
+    import h5py
+    import astroNN.datasets.h5
+    from astroNN.datasets import H5Loader
+
+    rng = np.random.default_rng(0)
+    num = 500
+    spectra = rng.normal(size=(num, 30))
+    teff = rng.normal(size=num)
+    logg = rng.normal(size=num)
+    logg[rng.choice(num, 50, replace=False)] = -9999.0
+    in_flag = rng.integers(0, 2, num)
+    with h5py.File(tmp_path / "test.h5", "w") as F:
+        F.create_dataset("spectra", data=spectra, chunks=(16, 30))
+        F.create_dataset("spectra_err", data=spectra * 0.1)
+        F.create_dataset("teff", data=teff)
+        F.create_dataset("teff_err", data=teff * 0.1)
+        F.create_dataset("logg", data=logg, chunks=(32,))
+        F.create_dataset("logg_err", data=logg * 0.1)
+        F.create_dataset("in_flag", data=in_flag)
+
+    # small blocks to read across many blocks
+    monkeypatch.setattr(astroNN.datasets.h5, "_H5_BLOCK_BYTES", 1000)
+    monkeypatch.chdir(tmp_path)
+    loader = H5Loader("test", target=["teff", "logg"])
+    loader.load_err = True
+    loader.exclude9999 = True
+    idx = np.where((logg != -9999.0) & (in_flag == 0))[0]
+
+    x, y, x_err, y_err = loader.load()
+    npt.assert_equal(x, spectra[idx])
+    npt.assert_equal(x_err, spectra[idx] * 0.1)
+    npt.assert_equal(y, np.column_stack((teff, logg))[idx])
+    npt.assert_equal(y_err, np.column_stack((teff, logg))[idx] * 0.1)
+    npt.assert_equal(loader.load_entry("in_flag"), in_flag[idx])
+
+    # lazy batches give the same rows in the same order
+    batches = list(loader.batches(batch_size=64))
+    assert len(batches) == int(np.ceil(idx.shape[0] / 64))
+    for i in range(4):
+        npt.assert_equal(
+            np.concatenate([b[i] for b in batches]), (x, y, x_err, y_err)[i]
+        )
+
+    # labels in requested dtype and layout
+    loader.dtype = np.float32
+    loader.order = "F"
+    x, y, x_err, y_err = loader.load()
+    assert x.dtype == y.dtype == x_err.dtype == y_err.dtype == np.float32
+    assert y.flags.f_contiguous and y_err.flags.f_contiguous
+    npt.assert_equal(y, np.column_stack((teff, logg))[idx].astype(np.float32))
+    npt.assert_equal(
+        y_err, (np.column_stack((teff, logg))[idx] * 0.1).astype(np.float32)
+    )
+    loader.dtype = None
+    loader.order = "C"
+
+    # single target gives 1D labels
+    loader.target = ["teff"]
+    x, y, x_err, y_err = loader.load()
+    npt.assert_equal(y, teff[in_flag == 0])
+    npt.assert_equal(y_err, teff[in_flag == 0] * 0.1)
+    loader.target = ["teff", "logg"]
+
+    loader.exclude9999 = False
+    loader.load_combined = True
+    loader.load_err = False
+    in_flag_idx = np.where(in_flag == 0)[0]
+    x, y = loader.load()
+    npt.assert_equal(x, spectra[in_flag_idx])
+
+    # allowed index is cached until the file is changed
+    assert loader.load_allowed_index() is loader.load_allowed_index()
+    assert not loader.load_allowed_index().flags.writeable
+    loader.load_combined = None
+    assert loader.load_allowed_index().shape == (0,)
+    loader.exclude9999 = True
+    npt.assert_equal(loader.load_allowed_index(), np.where(logg != -9999.0)[0])
+    with h5py.File(tmp_path / "test.h5", "r+") as F:
+        F["teff"][0] = -9999.0
+    os.utime(tmp_path / "test.h5", ns=(0, 0))
+    npt.assert_equal(
+        loader.load_allowed_index(),
+        np.where((logg != -9999.0) & (np.arange(num) != 0))[0],
+    )
+
+    # in_flag is not needed without load_combined
+    with h5py.File(tmp_path / "test.h5", "r+") as F:
+        del F["in_flag"]
+    npt.assert_equal(
+        loader.load_allowed_index(),
+        np.where((logg != -9999.0) & (np.arange(num) != 0))[0],
+    )
+
+    # contiguous rows are read directly, mixed with scattered rows
+    with h5py.File(tmp_path / "test.h5", "r") as F:
+        rows = np.concatenate((np.arange(10, 100), [120, 150, 151, 499]))
+        npt.assert_equal(
+            astroNN.datasets.h5._h5_read_rows(F["spectra"], rows), spectra[rows]
+        )
+        assert astroNN.datasets.h5._h5_read_rows(F["spectra"], []).shape == (0, 30)
+
+
 @pytest.mark.parametrize("module_name", ["galaxy10", "galaxy10sdss"])
 def test_galaxy10(module_name):
     g10_module = importlib.import_module(f"astroNN.datasets.{module_name}")
@@ -46,6 +295,7 @@ def test_galaxy10(module_name):
         galaxy10cls_lookup(11)
     galaxy10_confusion(np.ones((10, 10)))
 
+
 def test_data():
     os.path.isdir(datapath())
     data_description()
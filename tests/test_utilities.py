@@ -8,7 +8,7 @@ from astroNN.config import MAGIC_NUMBER, config_path
 from astroNN.datasets.h5 import h5name_check
 from astroNN.nn.utilities.normalizer import Normalizer
 from astroNN.shared import pylab_style
-from astroNN.shared.downloader_tools import filehash
+from astroNN.shared.downloader_tools import cached_filehash, filehash, filehashes
 from astroNN.shared.nn_tools import cpu_fallback
 
 
@@ -37,6 +37,46 @@ def test_checksum():
         filehash(test_data_path, algorithm="sha123")
 
 
+def test_cached_checksum(tmp_path):
+    filenames = []
+    for i in range(4):
+        filename = tmp_path / f"file_{i}.bin"
+        filename.write_bytes(np.random.default_rng(i).bytes(3_000_000 + i))
+        filenames.append(str(filename))
+    expected = [filehash(f, algorithm="sha1") for f in filenames]
+
+    # parallel hashing gives the same hashes in the same order and records them in sidecar files
+    assert filehashes(filenames, algorithm="SHA1", workers=2) == expected
+    assert all(os.path.isfile(f"{f}.astroNN_hash.json") for f in filenames)
+
+    # unchanged file is not hashed again, only the recorded hash is used
+    with open(f"{filenames[0]}.astroNN_hash.json") as f:
+        record = f.read()
+    with open(f"{filenames[0]}.astroNN_hash.json", "w") as f:
+        f.write(record.replace(expected[0], "recorded"))
+    assert cached_filehash(filenames[0], algorithm="sha1") == "recorded"
+    # different algorithm is hashed and recorded alongside
+    assert cached_filehash(filenames[0], algorithm="md5") == filehash(
+        filenames[0], algorithm="md5"
+    )
+    assert cached_filehash(filenames[0], algorithm="sha1") == "recorded"
+
+    # changed file is hashed again
+    with open(filenames[0], "ab") as f:
+        f.write(b"changed")
+    assert cached_filehash(filenames[0], algorithm="sha1") == filehash(
+        filenames[0], algorithm="sha1"
+    )
+
+    # broken sidecar file is ignored
+    with open(f"{filenames[1]}.astroNN_hash.json", "w") as f:
+        f.write("{not json")
+    assert cached_filehash(filenames[1], algorithm="sha1") == expected[1]
+
+    with pytest.raises(ValueError):
+        cached_filehash(filenames[0], algorithm="sha123")
+
+
 def test_normalizer():
     data = np.random.normal(0, 1, (100, 10))
     magic_idx = (10, 5)
@@ -95,6 +135,252 @@ def test_normalizer():
         errorous_norm.normalize(data)
 
 
+def test_normalizer_partial_fit():
+    rng = np.random.default_rng(0)
+    data = rng.normal(3.0, 2.0, (1000, 7))
+    data[rng.random(data.shape) < 0.1] = MAGIC_NUMBER
+    data[5, 2] = np.nan
+
+    for mode in [1, 2]:
+        normer = Normalizer(mode=mode, verbose=0)
+        norm_data = normer.normalize(data)
+
+        # accumulate chunk by chunk gives the same statistics
+        partial_normer = Normalizer(mode=mode, verbose=0)
+        for chunk in np.array_split(data, 7):
+            partial_normer.partial_fit(chunk)
+        npt.assert_allclose(partial_normer.mean_labels, normer.mean_labels, rtol=1e-5)
+        npt.assert_allclose(partial_normer.std_labels, normer.std_labels, rtol=1e-5)
+        npt.assert_allclose(
+            partial_normer.normalize(data, calc=False), norm_data, atol=1e-4
+        )
+
+        # statistics from different workers can be merged
+        normer_a = Normalizer(mode=mode, verbose=0).partial_fit(data[:300])
+        normer_b = Normalizer(mode=mode, verbose=0).partial_fit(data[300:])
+        normer_a.merge(normer_b)
+        npt.assert_allclose(normer_a.mean_labels, partial_normer.mean_labels)
+        npt.assert_allclose(normer_a.std_labels, partial_normer.std_labels)
+
+    # named data
+    images = rng.integers(0, 256, (20, 5, 5))
+    normer = Normalizer(mode={"input": 2, "aux": 1}, verbose=0)
+    normer.normalize({"input": images, "aux": data})
+    partial_normer = Normalizer(mode={"input": 2, "aux": 1}, verbose=0)
+    partial_normer.partial_fit({"input": images[:10], "aux": data[:400]})
+    partial_normer.partial_fit({"input": images[10:], "aux": data[400:]})
+    for name in ["input", "aux"]:
+        npt.assert_allclose(
+            partial_normer.mean_labels[name], normer.mean_labels[name], rtol=1e-5
+        )
+        npt.assert_allclose(
+            partial_normer.std_labels[name], normer.std_labels[name], rtol=1e-5
+        )
+
+
+def test_normalizer_out():
+    rng = np.random.default_rng(1)
+    data = rng.normal(3.0, 2.0, (300, 20))
+    data[rng.random(data.shape) < 0.1] = MAGIC_NUMBER
+    data[7, 3] = np.nan
+    normer = Normalizer(mode=2, verbose=0)
+    norm_data = normer.normalize(data)
+    mean_labels, std_labels = normer.mean_labels.copy(), normer.std_labels.copy()
+
+    # normalize to a preallocated buffer or in-place without changing the normalizer
+    buffer = np.empty(data.shape, dtype=np.float32)
+    assert normer.normalize(data, calc=False, out=buffer) is buffer
+    npt.assert_allclose(buffer, norm_data, atol=1e-5)
+    buffer = data.astype(np.float32)
+    normer.normalize(buffer, calc=False, out=buffer)
+    npt.assert_allclose(buffer, norm_data, atol=1e-5)
+    npt.assert_equal(buffer[7, 3], MAGIC_NUMBER)
+    normer.denormalize(buffer, out=buffer)
+    good = (data != MAGIC_NUMBER) & ~np.isnan(data)
+    npt.assert_allclose(buffer[good], data[good], atol=1e-4)
+    npt.assert_equal(normer.mean_labels, mean_labels)
+    npt.assert_equal(normer.std_labels, std_labels)
+
+    # calculate statistics and normalize in-place
+    buffer = data.astype(np.float32)
+    normer = Normalizer(mode=2, verbose=0)
+    assert normer.normalize(buffer, out=buffer) is buffer
+    npt.assert_allclose(buffer, norm_data, atol=1e-5)
+    npt.assert_allclose(normer.mean_labels, mean_labels, rtol=1e-6)
+    npt.assert_allclose(normer.std_labels, std_labels, rtol=1e-6)
+
+    # named data with 1D data
+    labels = rng.normal(size=300)
+    normer = Normalizer(mode={"input": 2, "labels": 1}, verbose=0)
+    norm_data = normer.normalize({"input": data, "labels": labels})
+    out = {
+        "input": np.empty(data.shape, dtype=np.float32),
+        "labels": np.empty(300, dtype=np.float32),
+    }
+    norm_data_out = normer.normalize(
+        {"input": data, "labels": labels}, calc=False, out=out
+    )
+    npt.assert_allclose(out["input"], norm_data["input"], atol=1e-5)
+    npt.assert_allclose(out["labels"], norm_data["labels"][:, 0], atol=1e-5)
+    assert norm_data_out["labels"].shape == (300, 1)
+
+
+def test_frozen_normalizer():
+    import concurrent.futures
+    import pickle
+
+    rng = np.random.default_rng(2)
+    data = rng.normal(3.0, 2.0, (200, 30))
+    data[rng.random(data.shape) < 0.1] = MAGIC_NUMBER
+    normer = Normalizer(mode=2, verbose=0)
+    norm_data = normer.normalize(data)
+    frozen = normer.freeze()
+
+    npt.assert_allclose(frozen.normalize(data), norm_data, atol=1e-5)
+    npt.assert_allclose(frozen.denormalize(norm_data), normer.denormalize(norm_data))
+    # the frozen normalizer is not affected by changes to the original one
+    normer.normalize(data * 2.0)
+    npt.assert_allclose(frozen.normalize(data), norm_data, atol=1e-5)
+    # immutable and can be pickled to be sent to other processes
+    with pytest.raises(AttributeError):
+        frozen.named = True
+    with pytest.raises(ValueError):
+        frozen.mean_labels[0] = 0.0
+    with pytest.raises(TypeError):
+        frozen.normalize({"input": data})
+    npt.assert_allclose(
+        pickle.loads(pickle.dumps(frozen)).normalize(data), norm_data, atol=1e-5
+    )
+
+    # safe to be shared across threads
+    chunks = [data * (i + 1) for i in range(16)]
+    expected = [frozen.normalize(chunk) for chunk in chunks]
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(frozen.normalize, chunks * 4))
+    for i, result in enumerate(results):
+        npt.assert_equal(result, expected[i % 16])
+
+    # named data
+    normer = Normalizer(mode={"input": 2, "aux": 0}, verbose=0)
+    norm_data = normer.normalize({"input": data, "aux": data})
+    frozen = normer.freeze()
+    assert frozen.named and sorted(frozen.mean_labels) == ["aux", "input"]
+    norm_data_frozen = frozen.normalize({"input": data, "aux": data})
+    for name in ["input", "aux"]:
+        npt.assert_allclose(norm_data_frozen[name], norm_data[name], atol=1e-5)
+    # unknown named data is not silently passed through
+    with pytest.raises(KeyError, match="labels"):
+        normer.normalize({"labels": data}, calc=False)
+    with pytest.raises(KeyError, match="labels"):
+        normer.denormalize({"input": data, "labels": data})
+
+
+def test_generator_buffer_ring():
+    import concurrent.futures
+    import pickle
+    from astroNN.models.base_cnn import CNNDataGenerator
+
+    rng = np.random.default_rng(3)
+    inputs = {"input": rng.normal(size=(100, 20, 1)).astype(np.float32)}
+    labels = {"output": rng.normal(size=(100, 3)).astype(np.float32)}
+    sample_weight = rng.random(100)
+    generator = CNNDataGenerator(
+        batch_size=16,
+        shuffle=True,
+        steps_per_epoch=6,
+        data=[inputs, labels],
+        sample_weight=sample_weight,
+        reuse_buffer=True,
+        workers=4,
+        max_queue_size=3,
+    )
+    assert generator.ring_size == 9
+
+    def expected(i):
+        idx = generator.idx_list[i * 16 : (i + 1) * 16]
+        return inputs["input"][idx], labels["output"][idx], sample_weight[idx]
+
+    x, y, w = generator[0]
+    npt.assert_equal(x["input"], expected(0)[0])
+    npt.assert_equal(y["output"], expected(0)[1])
+    npt.assert_equal(w, expected(0)[2])
+    # buffers are reused after going around the ring but not before
+    batches = [generator[i % 6] for i in range(generator.ring_size)]
+    assert not any(
+        np.shares_memory(x["input"], batch[0]["input"]) for batch in batches[:-1]
+    )
+    assert np.shares_memory(x["input"], batches[-1][0]["input"])
+
+    # batches prefetched in threads are correct as long as no more than the ring size are in flight
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        batches = list(executor.map(generator.__getitem__, range(6)))
+    for i, (x, y, w) in enumerate(batches):
+        npt.assert_equal(x["input"], expected(i)[0])
+        npt.assert_equal(y["output"], expected(i)[1])
+        npt.assert_equal(w, expected(i)[2])
+
+    # can be sent to worker processes
+    generator_copy = pickle.loads(pickle.dumps(generator))
+    npt.assert_equal(generator_copy[1][0]["input"], expected(1)[0])
+    assert generator_copy.workers == 4 and generator_copy.max_queue_size == 3
+
+
+def test_generator_contiguous(tmp_path):
+    import h5py
+    from astroNN.models.base_cnn import CNNDataGenerator
+
+    rng = np.random.default_rng(4)
+    inputs = {"input": rng.normal(size=(100, 20)).astype(np.float32)}
+    labels = {"output": rng.normal(size=(100, 3)).astype(np.float32)}
+
+    # unshuffled batches are views of the data
+    generator = CNNDataGenerator(
+        batch_size=16,
+        shuffle=False,
+        steps_per_epoch=6,
+        data=[inputs, labels],
+        reuse_buffer=True,
+    )
+    x, y = generator[1]
+    assert np.shares_memory(x["input"], inputs["input"])
+    assert np.shares_memory(y["output"], labels["output"])
+    npt.assert_equal(y["output"], labels["output"][16:32])
+
+    # block shuffle only shuffles within blocks and the order of blocks
+    generator = CNNDataGenerator(
+        batch_size=16,
+        shuffle=True,
+        steps_per_epoch=6,
+        data=[inputs, labels],
+        shuffle_block_size=32,
+    )
+    idx_list = generator.idx_list
+    npt.assert_equal(np.sort(idx_list), np.arange(100))
+    assert not np.all(idx_list == np.arange(100))
+    # rows of every block stay together
+    assert np.count_nonzero(np.diff(idx_list // 32)) == 3
+    x, y = generator[0]
+    npt.assert_equal(x["input"], inputs["input"][idx_list[:16]])
+
+    # shuffled batches can be read from h5py dataset
+    with h5py.File(tmp_path / "data.h5", "w") as f:
+        f.create_dataset("input", data=inputs["input"], chunks=(32, 20))
+        f.create_dataset("output", data=labels["output"])
+    with h5py.File(tmp_path / "data.h5", "r") as f:
+        generator = CNNDataGenerator(
+            batch_size=16,
+            shuffle=True,
+            steps_per_epoch=6,
+            data=[{"input": f["input"]}, {"output": f["output"]}],
+            shuffle_block_size=32,
+        )
+        for reuse_buffer in [False, True]:
+            generator.reuse_buffer = reuse_buffer
+            x, y = generator[2]
+            npt.assert_equal(x["input"], inputs["input"][generator.idx_list[32:48]])
+            npt.assert_equal(y["output"], labels["output"][generator.idx_list[32:48]])
+
+
 def test_cpu_gpu_management():
     cpu_fallback(flag=True)
     cpu_fallback(flag=False)